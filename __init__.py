@@ -40,19 +40,7 @@ if WAIT_FOR_DEBUGGER_ATTACHED:
     debugpy.wait_for_client()
 
 # handle loading of dependencies
-def get_addon_dir() -> str:
-    addon_dir: str = os.path.dirname(__file__)
-    return addon_dir
-
-
-def get_user_data_dir() -> str:
-    user_data_dir: str = os.path.join(get_addon_dir(), USER_DATA_DIR)
-    return user_data_dir
-
-
-def get_user_file(filename: str) -> str:
-    user_file: str = os.path.join(get_user_data_dir(), filename)
-    return user_file
+from .addon_files import get_addon_dir
 
 
 def get_packages_dir() -> str:
@@ -83,318 +71,36 @@ loaded_addon_packages(get_packages_dir())
 
 
 # regular entry
-import json
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from aqt import mw
+from aqt import gui_hooks
 from aqt.utils import showInfo
 from aqt.qt import qconnect
 from aqt.addons import AddonManager
-from anki.decks import DeckManager, DeckDict
-from anki.cards import Card, CardId
-from anki.notes import Note
-from anki.collection import Collection
 from anki.hooks import wrap
-from PyQt6.QtGui import QAction, QIcon
-from PyQt6.QtWidgets import QApplication, QLabel, QVBoxLayout, QWidget, QLineEdit, QPushButton, QHBoxLayout, QLayout, QFrame, QMessageBox, QFileDialog
-from PyQt6.QtCore import Qt
-from types import SimpleNamespace
+from PyQt6.QtGui import QAction
+from PyQt6.QtWidgets import (
+    QApplication, QLabel, QVBoxLayout, QWidget, QLineEdit, QPushButton, QHBoxLayout, QLayout, QFileDialog, QSpinBox, QCheckBox, QComboBox)
+from concurrent.futures import Future
+from .addon_config import (
+    AddonConfig, MAX_FETCH_WORKER_COUNT, MAX_AUTO_SYNC_INTERVAL_MINUTES, MIN_HTTP_TIMEOUT_SECONDS, MAX_HTTP_TIMEOUT_SECONDS)
+from .addon_files import ADDON_NAME, GOOGLE_API_TOKEN_FILE, get_user_file, load_addon_config, save_addon_config
+from .auto_sync import auto_sync_scheduler, token_refresher
+from .deck_sync import set_card_change_logging, set_text_normalization
+from .google_connection import clear_credentials, MAX_HTTP_POOL_SIZE
+from .google_sheets import clear_google_services, warm_up_google_services
+from .gui_utils import get_icon, show_error
+from .import_window import goosheesy_import
 from typing import Any
-from typing import Dict
-from typing import List
 from typing import Optional
-from typing import TYPE_CHECKING
-
-if TYPE_CHECKING:
-    from googleapiclient._apis.drive.v3.schemas import FileList
-    from googleapiclient._apis.drive.v3.resources import DriveResource
-    from googleapiclient._apis.drive.v3.schemas import File
-    from googleapiclient._apis.drive.v3.resources import FileListHttpRequest
-    from googleapiclient._apis.sheets.v4.resources import SheetsResource
-    from googleapiclient._apis.sheets.v4.resources import BatchUpdateSpreadsheetRequest
-    from googleapiclient._apis.sheets.v4.resources import SheetProperties
-    from googleapiclient._apis.sheets.v4.resources import AddSheetRequest
-    from googleapiclient._apis.sheets.v4.resources import AddSheetResponse
-else:
-    DriveResource = Any
-    SheetsResource = Any
-
-type RemoteDeck = Dict[str, str]
-
-APPLICATION_SCOPES: List[str] = [
-    "https://www.googleapis.com/auth/drive",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive.metadata",
-    "https://www.googleapis.com/auth/drive.metadata.readonly",
-    "https://www.googleapis.com/auth/spreadsheets"
-]
-
-USER_DATA_DIR: str = "user_files"
-ADDON_NAME: str = "goosheesy"
-ADDON_CONFIG: str = ADDON_NAME + ".json"
+
 LOG_FILENAME: str = "goosheesy.log"
+LOG_MAX_BYTES: int = 5 * 1024 * 1024
+LOG_BACKUP_COUNT: int = 3
 VERSION_FILE: str = "version.txt"
-GOOGLE_API_CREDENTIALS_FILE = "credentials.json"
-GOOGLE_API_TOKEN_FILE = "token.json"
-
-def get_icon() -> QIcon:
-    icon_path = os.path.join(get_addon_dir(), "icon.png")
-    return QIcon(icon_path)
-
-
-def show_message_box(icon: QMessageBox.Icon, title: str, message: str) -> None:
-    message_box = QMessageBox()
-    message_box.setIcon(icon)
-    message_box.setText(message)
-    message_box.setWindowTitle(title)
-    message_box.setWindowIcon(get_icon())
-    message_box.setStandardButtons(QMessageBox.StandardButton.Ok)
-    message_box.exec()
-
-
-def show_info(title: str, message: str) -> None:
-    return show_message_box(QMessageBox.Icon.Information, title, message)
-
-
-def show_error(title: str, message: str) -> None:
-    return show_message_box(QMessageBox.Icon.Critical, title, message)
-
-
-# ============================================================================================
-# TODO extract all Google Sheets logic to a separate Python file
-class NoCredentialsException(Exception):
-    """Application failed to get credentials for Google API"""
-
-    def __init__(self, *args, msg='No credentials for Google API', **kwargs):
-        super().__init__(msg, *args, **kwargs)
-
-
-def get_credentials(credentials_file: str):
-    """Returns user authorization credentials (token) for Google API. Performs user authentication in browser if needed"""
-
-    # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
-    import google.auth
-    import google.oauth2.credentials
-    import google.auth.external_account_authorized_user
-    from google.auth.transport.requests import Request
-    from google_auth_oauthlib.flow import InstalledAppFlow
-
-    type Credentials = google.auth.external_account_authorized_user.Credentials | google.oauth2.credentials.Credentials
-    creds: Optional[Credentials] = None
-
-    # TODO rewrite with OS keyring API access, both for credentials.json and token.json
-
-    # credentials_path: str = get_user_file(GOOGLE_API_CREDENTIALS_FILE)
-
-    # The file token.json stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    token_path = get_user_file(GOOGLE_API_TOKEN_FILE)
-    logging.debug("Token path: %s", token_path)
-
-    if os.path.exists(token_path):
-        creds = google.oauth2.credentials.Credentials.from_authorized_user_file(token_path, APPLICATION_SCOPES)
-
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(credentials_file, APPLICATION_SCOPES)
-            creds = flow.run_local_server(port=0)
-
-        if not creds:
-            raise NoCredentialsException()
-
-        # Save the credentials for the next run
-        with open(token_path, "w", encoding="utf8") as token:
-            token.write(creds.to_json())
-
-    if not creds:
-        raise NoCredentialsException()
-
-    return creds
-
-
-def find_spreadsheets(drive_service: DriveResource, target_substring: str) -> List[str]:
-    """Find in the specified Google Drive account all Google Spreadsheets whose name contains the specified substring"""
-
-    # https://developers.google.com/workspace/drive/api/guides/mime-types
-    GOOGLE_SPREADSHEET_MIME_TYPE: str = "application/vnd.google-apps.spreadsheet"
-
-    ids: List[str] = []
-    next_page_token: str = ""
-
-    logging.debug("Starting search for spreadsheets with name with substring: %s", target_substring)
-    while True:
-        files: DriveResource.FilesResource = drive_service.files()
-        request: FileListHttpRequest = files.list(
-            pageToken=next_page_token,
-            pageSize=10, fields="nextPageToken, files(id, name)",
-            q=f"mimeType='{GOOGLE_SPREADSHEET_MIME_TYPE}' and 'me' in owners and trashed=false and name contains '{target_substring}'")
-        
-        results: FileList = request.execute()
-        next_page_token = results.get("nextPageToken")  # type: ignore
-        items = results.get("files", [])
-
-        # if not items:
-        #     print("No files found.")
-        #     raise Exception(
-        #         f"No spreadsheets found with name {target_substring}")
-
-        logging.debug("Next chunk of files:")
-        for item in items:
-            spreadsheest_name: str = item['name']  # type: ignore
-            spreadsheet_id: str = item['id']  # type: ignore
-            logging.debug("Spreadsheet name: %s, spreadsheet ID: %s", spreadsheest_name, spreadsheet_id)
-            ids.append(spreadsheet_id)
-
-        if not next_page_token:
-            break
-
-        # except HttpError as error:
-            # TODO(developer) - Handle errors from drive API.
-            # print(f"An error occurred: {error}")
-            # break;
-
-    return ids
-
-
-class AddonConfig:
-    def __init__(self, credentials_file: str, sync_config_file: str):
-        self.credentials_file = credentials_file
-        self.sync_config_file = sync_config_file
-
-    credentials_file: str
-    sync_config_file: str
-
-
-def get_google_sheets_deck(drive_service: DriveResource, sheets_service: SheetsResource, spreadsheet_name: str, sheet_name:str) -> RemoteDeck:
-    """Go to Google Sheets spreadsheet sheet and gather all cards from there."""
-
-    spreadsheet_ids: List[str] = find_spreadsheets(drive_service, spreadsheet_name)
-    spreadsheet_id: str = spreadsheet_ids[0]
-
-    # final_sheet_metadata = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    # sheets = final_sheet_metadata.get('sheets', '')
-    sheet: SheetsResource.SpreadsheetsResource = sheets_service.spreadsheets()
-    result = (
-        sheet.values()
-        .get(spreadsheetId=spreadsheet_id, range=f"{sheet_name}!A:B")
-        .execute()
-    )
-    values = result.get("values", [])
-
-    deck: RemoteDeck = {}
-
-    for row in values:
-        if len(row) < 2:
-            logging.debug("Skipping not full line.")
-            continue
-
-        CARD_KEY_COLUMN_INDEX = 0
-        CARD_VALUE_COLUMN_INDEX = 1
-
-        card_key: str = row[CARD_KEY_COLUMN_INDEX]
-        card_value: str = row[CARD_VALUE_COLUMN_INDEX]
-        deck[card_key] = card_value
-
-    return deck
-
-# ============================================================================================
-
-def sync_deck(config: AddonConfig, spreadsheet_name: str, sheet_name: str, anki_deck_name: str):
-    """Update local Anki deck with cards from remote deck: 
-          * Iterate over existing Anki cards and find matching card in the remote deck:
-             * If the card description differs, update it
-             * If the card is absent in the remote deck, delete it from Anki deck
-          * Add new cards from the remote deck which are absent in the Anki deck
-    """
-
-    # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
-    from googleapiclient import discovery
-    from googleapiclient.discovery import Resource
-
-    credentials = get_credentials(config.credentials_file)
-    sheets_service: SheetsResource = discovery.build("sheets", "v4", credentials=credentials)
-    drive_service: DriveResource = discovery.build("drive", "v3", credentials=credentials)
-    remote_deck: RemoteDeck = get_google_sheets_deck(drive_service, sheets_service, spreadsheet_name, sheet_name)
-
-    deck_id = mw.col.decks.id_for_name(anki_deck_name)
-    if deck_id is None:
-        show_error("Error", f"Failed to find Anki deck: {anki_deck_name}")
-        return
-    
-    card_ids = mw.col.decks.cids(deck_id)
-
-    removed_card_count = 0
-    added_card_count = 0
-    updated_card_count = 0
-
-    for card_id in card_ids:
-        card: Card = mw.col.get_card(card_id)
-        card_note: Note = card.note()
-        card_key: str = card_note['Front']
-        remote_card_value = remote_deck.get(card_key)
-        if remote_card_value is None:
-            logging.info("The card is absent in remote deck, deleting it from the Anki deck, card key: %s", card_key)
-            mw.col.remove_notes_by_card([card_id])
-            removed_card_count = removed_card_count + 1
-        else:
-            anki_card_value = card.note()['Back']
-            if not remote_card_value == anki_card_value:
-                logging.info("Updating description for the card: %s, before: %s, after: %s", card_key, anki_card_value, remote_card_value)
-                card_note['Back'] = remote_card_value
-                mw.col.update_note(card_note)
-                updated_card_count = updated_card_count + 1
-
-    for card_key, card_value in remote_deck.items():
-        query = f'deck:"{anki_deck_name}" front:"{card_key}"'
-        cids = mw.col.find_cards(query)
-        if not cids:
-            logging.info("Creating new card: %s", card_key)
-            deck_id = mw.col.decks.id_for_name(anki_deck_name)
-            model = mw.col.models.by_name("Basic")
-            note = mw.col.new_note(model)
-            note["Front"] = card_key
-            note["Back"] = card_value
-            mw.col.add_note(note, deck_id)
-            added_card_count = added_card_count + 1
-            logging.info("Added new card: %s", card_key)
-
-    logging.info("Finished syncing deck: %s", anki_deck_name)
-    show_info(f"Success - {anki_deck_name}", f"Synced dech {anki_deck_name}, new cards added: {added_card_count}, updated cards: {updated_card_count}, deleted cards: {removed_card_count}")
-
-
-def try_sync_deck(config: AddonConfig, spreadsheet_name: str, sheet_name: str, anki_deck_name: str):
-    try:
-        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
-        sync_deck(config, spreadsheet_name, sheet_name, anki_deck_name)
-    except Exception as error:
-        QApplication.restoreOverrideCursor()
-        show_error("Error", f"Failed to sync sheet: '{spreadsheet_name}'-'{sheet_name}' with deck '{anki_deck_name}', {type(error).__name__} - {error}")
-    QApplication.restoreOverrideCursor()
-
-
-def get_addon_config_path() -> str:
-    addon_config: str = get_user_file(ADDON_CONFIG)
-    return addon_config
-
-
-def load_addon_config() -> AddonConfig:
-    """Load add-on configuration from JSON file"""
-    addon_config_file: str = get_addon_config_path()
-    logging.info("Loading local addon config from: %s", addon_config_file)
-
-    config: AddonConfig = AddonConfig("", "")
-    if not os.path.exists(addon_config_file):
-        return config
-
-    with open(addon_config_file, "r", encoding="utf8") as data:
-        config_json = json.load(data, object_hook=lambda d: SimpleNamespace(**d))
-
-    config.credentials_file = getattr(config_json, "credentials_file", "")
-    config.sync_config_file = getattr(config_json, "sync_config_file", "")
-
-    return config
+# let Anki finish opening the profile before the warm-up competes with it
+PREWARM_DELAY_MS: int = 3000
 
 
 def select_file() -> str | None:
@@ -409,20 +115,6 @@ def select_file() -> str | None:
     return None
 
 
-def save_addon_config(config: AddonConfig):
-    """Save add-on configuration into JSON file"""
-
-    addon_config_file: str = get_addon_config_path()
-    logging.info("Saving add-on configuration to %s", addon_config_file)
-
-    config_json: Any = {}
-    config_json["credentials_file"] = config.credentials_file
-    config_json["sync_config_file"] = config.sync_config_file
-
-    with open(addon_config_file, "w+", encoding="utf8") as json_file:
-        json.dump(config_json, json_file, indent=4)    
-
-
 def goosheesy_settings():
     """Opens GUI window with add-on settings"""
     mw.settingsWidget = widget = QWidget()
@@ -484,11 +176,108 @@ def goosheesy_settings():
     sync_config_row.addWidget(select_sync_config_button)
     layout.addLayout(sync_config_row)
 
+    # number of spreadsheets fetched in parallel
+    fetch_worker_count_label = QLabel("Spreadsheets fetched in parallel:")
+    fetch_worker_count_spinbox = QSpinBox()
+    fetch_worker_count_spinbox.setRange(1, MAX_FETCH_WORKER_COUNT)
+    fetch_worker_count_spinbox.setValue(config.fetch_worker_count)
+
+    fetch_worker_count_row = QHBoxLayout()
+    fetch_worker_count_row.addWidget(fetch_worker_count_label)
+    fetch_worker_count_row.addWidget(fetch_worker_count_spinbox)
+    fetch_worker_count_row.addStretch()
+    layout.addLayout(fetch_worker_count_row)
+
+    # pooled keep-alive connections to Google APIs
+    http_pool_size_label = QLabel("Connections to Google kept open:")
+    http_pool_size_spinbox = QSpinBox()
+    http_pool_size_spinbox.setRange(1, MAX_HTTP_POOL_SIZE)
+    http_pool_size_spinbox.setValue(config.http_pool_size)
+    http_timeout_label = QLabel("Request timeout, seconds:")
+    http_timeout_spinbox = QSpinBox()
+    http_timeout_spinbox.setRange(MIN_HTTP_TIMEOUT_SECONDS, MAX_HTTP_TIMEOUT_SECONDS)
+    http_timeout_spinbox.setValue(config.http_timeout_seconds)
+
+    http_row = QHBoxLayout()
+    http_row.addWidget(http_pool_size_label)
+    http_row.addWidget(http_pool_size_spinbox)
+    http_row.addWidget(http_timeout_label)
+    http_row.addWidget(http_timeout_spinbox)
+    http_row.addStretch()
+    layout.addLayout(http_row)
+
+    # connection to Google prepared in background after the profile opens
+    prewarm_checkbox = QCheckBox("Prepare connection to Google Sheets in background after the profile opens")
+    prewarm_checkbox.setChecked(config.prewarm_google_services)
+    layout.addWidget(prewarm_checkbox)
+
+    # cell values as shown in the sheet, or raw numbers which make smaller responses for numeric sheets
+    value_render_label = QLabel("Cell values:")
+    value_render_combobox = QComboBox()
+    value_render_combobox.addItem("Formatted, as shown in the sheet", "FORMATTED_VALUE")
+    value_render_combobox.addItem("Unformatted, numbers without formatting", "UNFORMATTED_VALUE")
+    value_render_combobox.setCurrentIndex(max(0, value_render_combobox.findData(config.value_render_option)))
+
+    value_render_row = QHBoxLayout()
+    value_render_row.addWidget(value_render_label)
+    value_render_row.addWidget(value_render_combobox)
+    value_render_row.addStretch()
+    layout.addLayout(value_render_row)
+
+    # automatic sync of the changed spreadsheets
+    auto_sync_checkbox = QCheckBox("Sync changed spreadsheets automatically in background, every minutes:")
+    auto_sync_checkbox.setChecked(config.auto_sync_enabled)
+    auto_sync_interval_spinbox = QSpinBox()
+    auto_sync_interval_spinbox.setRange(1, MAX_AUTO_SYNC_INTERVAL_MINUTES)
+    auto_sync_interval_spinbox.setValue(config.auto_sync_interval_minutes)
+
+    auto_sync_row = QHBoxLayout()
+    auto_sync_row.addWidget(auto_sync_checkbox)
+    auto_sync_row.addWidget(auto_sync_interval_spinbox)
+    auto_sync_row.addStretch()
+    layout.addLayout(auto_sync_row)
+
+    # per-card log lines instead of one summary per deck
+    log_card_changes_checkbox = QCheckBox("Log every created, updated and deleted card")
+    log_card_changes_checkbox.setChecked(config.log_card_changes)
+    layout.addWidget(log_card_changes_checkbox)
+
+    # formatting differences between the sheet and the notes which don't make the notes updated
+    normalization_label = QLabel("Ignore differences in:")
+    normalize_html_checkbox = QCheckBox("HTML tags and entities")
+    normalize_html_checkbox.setChecked(config.normalize_html)
+    normalize_whitespace_checkbox = QCheckBox("whitespace")
+    normalize_whitespace_checkbox.setChecked(config.normalize_whitespace)
+    normalize_unicode_checkbox = QCheckBox("Unicode normalization form")
+    normalize_unicode_checkbox.setChecked(config.normalize_unicode)
+
+    normalization_row = QHBoxLayout()
+    normalization_row.addWidget(normalization_label)
+    normalization_row.addWidget(normalize_html_checkbox)
+    normalization_row.addWidget(normalize_whitespace_checkbox)
+    normalization_row.addWidget(normalize_unicode_checkbox)
+    normalization_row.addStretch()
+    layout.addLayout(normalization_row)
+
     # apply and close buttons
     def on_apply():
         config.credentials_file = credentials_textbox.text()
         config.sync_config_file = sync_config_textbox.text()
+        config.fetch_worker_count = fetch_worker_count_spinbox.value()
+        config.prewarm_google_services = prewarm_checkbox.isChecked()
+        config.value_render_option = value_render_combobox.currentData()
+        config.auto_sync_enabled = auto_sync_checkbox.isChecked()
+        config.auto_sync_interval_minutes = auto_sync_interval_spinbox.value()
+        config.log_card_changes = log_card_changes_checkbox.isChecked()
+        config.http_pool_size = http_pool_size_spinbox.value()
+        config.http_timeout_seconds = http_timeout_spinbox.value()
+        config.normalize_html = normalize_html_checkbox.isChecked()
+        config.normalize_whitespace = normalize_whitespace_checkbox.isChecked()
+        config.normalize_unicode = normalize_unicode_checkbox.isChecked()
         save_addon_config(config)
+        set_card_change_logging(config.log_card_changes)
+        set_text_normalization(config.get_text_normalization())
+        auto_sync_scheduler.start(config)
         widget.close()
 
     def on_close():
@@ -510,134 +299,112 @@ def goosheesy_settings():
     widget.show()
 
 
-def goosheesy_import():
-    """Opens GUI window with configured decks for synchronization, executes process of syncing."""
+# set when the add-on is being deleted, so the warm-up finishing later doesn't keep the services
+_addon_deleted: bool = False
 
-    if mw is None:
-        logging.error("mw is None.")
-        return
 
-    col: Collection | None = mw.col
-    if col is None:
-        logging.error("Collection mw.col is None.")
-        return
+def prewarm_google_services() -> None:
+    """Import the Google client modules, load the token and build the services in background,
+       so the first sync doesn't pay for them on the GUI thread"""
 
-    decks: DeckManager = col.decks
-    if decks is None:
-        logging.error("DeckManager mw.col.decks is None.")
+    config: AddonConfig = load_addon_config()
+    if not config.prewarm_google_services or _addon_deleted:
         return
 
-    config: AddonConfig = load_addon_config()
+    def on_done(future: Future):
+        try:
+            future.result()
+        except Exception as error:
+            # the sync prepares everything again and reports the problem to the user
+            logging.warning("Failed to prepare Google services in background: %s - %s", type(error).__name__, error)
 
-    if not os.path.exists(config.credentials_file) or not os.path.exists(config.sync_config_file):
-        show_error("Error - Configuration files missing or not exist", "Configure sheets and decks first in the 'Settings for Google Sheets import' menu!")
-        return
+        if _addon_deleted:
+            clear_google_services()
 
-    # current_directory = os.getcwd()
-    # backup_dir = os.path.join(current_directory, "backups")
-    # logging.info("Starting creating database backup in %s", backup_dir)
-    # if not os.path.exists(backup_dir):
-    #     os.makedirs(backup_dir)
-    # col.create_backup(backup_folder=backup_dir, force=True, wait_for_completion=True)
-    # logging.info("Backup created.")
-
-    logging.info("Path to the Anki collections database file: %s", col.path)
-    logging.info("Showing available decks:")
-    for d in decks.all_names_and_ids():
-        logging.info("Id: %s %s", d.id, d.name)
-
-    mw.importWidget = widget = QWidget()
-    widget.setWindowTitle("Import from Google Sheets")
-    widget.setWindowIcon(get_icon())
-    layout = QVBoxLayout(widget)
-    layout.setSizeConstraint(QLayout.SizeConstraint.SetFixedSize)
+    mw.taskman.run_in_background(
+        lambda: warm_up_google_services(get_user_file(GOOGLE_API_TOKEN_FILE), config.get_transport_options()),
+        on_done,
+        uses_collection=False)
 
-    logging.info("Loading sync config: %s.", config.sync_config_file)
-    with open(config.sync_config_file, "r", encoding="utf8") as data:
-        import_config_json = json.load(data, object_hook=lambda d: SimpleNamespace(**d))
-
-    for spreadsheet_settings in import_config_json.synchronization_map:
-        line = QFrame()
-        line.setFrameShape(QFrame.Shape.HLine)
-        line.setFrameShadow(QFrame.Shadow.Sunken)
-        layout.addWidget(line)
-
-        spreadsheet_name = spreadsheet_settings.spreadsheet_name
-        spreadsheet_label = QLabel(f"Spreadsheet: {spreadsheet_name}")
-        spreadsheet_label.setStyleSheet("font-weight: bold;")
-        layout.addWidget(spreadsheet_label)
-
-        for sheet_settings in spreadsheet_settings.sheets:
-            sheet_name = sheet_settings.sheet_name
-            anki_deck_name = sheet_settings.deck_name
-
-            sheet_label = QLabel(f"Sheet: {sheet_name} -> Deck: {anki_deck_name}")
-
-            anki_deck: DeckDict | None = decks.by_name(anki_deck_name)
-            if anki_deck is None:
-                sheet_label.setStyleSheet("color: red;") 
-
-            def on_sync_one_deck(
-                _checked: bool,
-                spreadsheet_name: str = spreadsheet_name,
-                sheet_name: str = sheet_name,
-                anki_deck_name: str = anki_deck_name,
-            ):
-                try_sync_deck(config, spreadsheet_name, sheet_name, anki_deck_name)
-
-            sync_button = QPushButton("Sync")
-            sync_button.setFixedWidth(100)
-            qconnect(sync_button.clicked, on_sync_one_deck)
-
-            row = QHBoxLayout()
-            row.addWidget(sheet_label)
-            row.addWidget(sync_button)
-            layout.addLayout(row)
-
-    line = QFrame()
-    line.setFrameShape(QFrame.Shape.HLine)
-    line.setFrameShadow(QFrame.Shadow.Sunken)
-    layout.addWidget(line)
-
-    def on_sync_all():
-        for spreadsheet_settings in import_config_json.synchronization_map:
-            for sheet_settings in spreadsheet_settings.sheets:
-                try_sync_deck(config, spreadsheet_settings.spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name)
-
-    sync_all_button = QPushButton("Sync all")
-    qconnect(sync_all_button.clicked, on_sync_all)
-    layout.addWidget(sync_all_button)
 
-    widget.resize(widget.sizeHint())
-    widget.adjustSize()
-    widget.show()
+def on_profile_did_open() -> None:
+    mw.progress.single_shot(PREWARM_DELAY_MS, prewarm_google_services, False)
+    auto_sync_scheduler.start(load_addon_config())
+    token_refresher.start()
+
+
+def on_profile_will_close() -> None:
+    auto_sync_scheduler.stop()
+    token_refresher.stop()
 
 
 def on_addon_delete(_manager: AddonManager, addon_name: str, *args: Any, **kwargs: Any) -> None:
+    global _addon_deleted
+
     if addon_name == ADDON_NAME:
-        for h in list(logging.getLogger().handlers):
-            h.close()
-            logging.getLogger().removeHandler(h)
+        _addon_deleted = True
+        auto_sync_scheduler.stop()
+        token_refresher.stop()
+        clear_google_services()
+        clear_credentials()
+        stop_logging()
 
 
-def main() -> None:
-    """Entry point for add-on initialization."""
+# writes the log records queued by all threads, so that they never wait for the disk
+_log_listener: Optional[QueueListener] = None
+_log_queue_handler: Optional[QueueHandler] = None
+
+
+def start_logging() -> None:
+    """Log to the rotating log file and to stdout through a queue, the handlers run on the thread of the queue listener"""
+    global _log_listener, _log_queue_handler
 
     log_file: str = get_user_file(LOG_FILENAME)
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
 
     log_formatter = logging.Formatter(u"%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
-    root_logger = logging.getLogger()
 
-    file_handler = logging.FileHandler(log_file, encoding="utf8")
+    file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf8")
     file_handler.setFormatter(log_formatter)
-    root_logger.addHandler(file_handler)
 
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(log_formatter)
-    root_logger.addHandler(console_handler)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _log_listener.start()
+
+    _log_queue_handler = QueueHandler(log_queue)
+    logging.getLogger().addHandler(_log_queue_handler)
+
+
+def stop_logging() -> None:
+    """Writes the queued records and closes the log file, so that the add-on folder can be deleted"""
+    global _log_listener, _log_queue_handler
+
+    if _log_queue_handler is not None:
+        logging.getLogger().removeHandler(_log_queue_handler)
+        _log_queue_handler.close()
+        _log_queue_handler = None
+
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+def main() -> None:
+    """Entry point for add-on initialization."""
+
+    start_logging()
+    config: AddonConfig = load_addon_config()
+    set_card_change_logging(config.log_card_changes)
+    set_text_normalization(config.get_text_normalization())
 
     AddonManager.deleteAddon = wrap(AddonManager.deleteAddon, on_addon_delete, "before") # type: ignore[method-assign]
+    gui_hooks.profile_did_open.append(on_profile_did_open)
+    gui_hooks.profile_will_close.append(on_profile_will_close)
 
     version_file: str = os.path.join(get_addon_dir(), VERSION_FILE)
     with open(version_file, 'r', encoding='utf8') as file:
@@ -0,0 +1,138 @@
+"""
+Add-on settings (goosheesy.json) and the sync configuration (import_config.json), shared by the add-on and the command-line sync.
+
+"""
+
+import json
+import logging
+import os.path
+from types import SimpleNamespace
+from typing import Any
+from typing import List
+from typing import Set
+from .deck_sync import TextNormalization
+from .google_connection import DEFAULT_HTTP_POOL_SIZE, DEFAULT_HTTP_TIMEOUT_SECONDS, HttpTransportOptions
+from .google_sheets import FETCH_MODES, VALUE_RENDER_OPTIONS, SheetReadOptions
+
+DEFAULT_FETCH_WORKER_COUNT: int = 4
+MAX_FETCH_WORKER_COUNT: int = 16
+DEFAULT_AUTO_SYNC_INTERVAL_MINUTES: int = 15
+MAX_AUTO_SYNC_INTERVAL_MINUTES: int = 24 * 60
+MIN_HTTP_TIMEOUT_SECONDS: int = 5
+MAX_HTTP_TIMEOUT_SECONDS: int = 600
+
+
+class AddonConfig:
+    def __init__(self, credentials_file: str, sync_config_file: str):
+        self.credentials_file = credentials_file
+        self.sync_config_file = sync_config_file
+        self.fetch_worker_count = DEFAULT_FETCH_WORKER_COUNT
+        self.prewarm_google_services = False
+        self.value_render_option = VALUE_RENDER_OPTIONS[0]
+        self.auto_sync_enabled = False
+        self.auto_sync_interval_minutes = DEFAULT_AUTO_SYNC_INTERVAL_MINUTES
+        self.log_card_changes = False
+        self.http_pool_size = DEFAULT_HTTP_POOL_SIZE
+        self.http_timeout_seconds = DEFAULT_HTTP_TIMEOUT_SECONDS
+        self.normalize_html = True
+        self.normalize_whitespace = True
+        self.normalize_unicode = True
+
+    credentials_file: str
+    sync_config_file: str
+    fetch_worker_count: int
+    # off by default, the warmed up Google modules can't be unloaded and block removing the add-on until Anki restarts
+    prewarm_google_services: bool
+    value_render_option: str
+    auto_sync_enabled: bool
+    auto_sync_interval_minutes: int
+    # log every changed card instead of one summary per deck
+    log_card_changes: bool
+    http_pool_size: int
+    http_timeout_seconds: int
+    # differences of card keys and values which don't make the note updated
+    normalize_html: bool
+    normalize_whitespace: bool
+    normalize_unicode: bool
+
+    def get_transport_options(self) -> HttpTransportOptions:
+        return HttpTransportOptions(self.http_pool_size, self.http_timeout_seconds)
+
+    def get_text_normalization(self) -> TextNormalization:
+        return TextNormalization(self.normalize_html, self.normalize_whitespace, self.normalize_unicode)
+
+
+def read_addon_config(addon_config_file: str) -> AddonConfig:
+    """Load add-on configuration from JSON file, missing settings get their defaults"""
+
+    config: AddonConfig = AddonConfig("", "")
+    if not os.path.exists(addon_config_file):
+        return config
+
+    with open(addon_config_file, "r", encoding="utf8") as data:
+        config_json = json.load(data, object_hook=lambda d: SimpleNamespace(**d))
+
+    config.credentials_file = getattr(config_json, "credentials_file", "")
+    config.sync_config_file = getattr(config_json, "sync_config_file", "")
+    config.fetch_worker_count = getattr(config_json, "fetch_worker_count", DEFAULT_FETCH_WORKER_COUNT)
+    config.prewarm_google_services = getattr(config_json, "prewarm_google_services", False)
+    config.value_render_option = getattr(config_json, "value_render_option", VALUE_RENDER_OPTIONS[0])
+    config.auto_sync_enabled = getattr(config_json, "auto_sync_enabled", False)
+    config.auto_sync_interval_minutes = getattr(config_json, "auto_sync_interval_minutes", DEFAULT_AUTO_SYNC_INTERVAL_MINUTES)
+    config.log_card_changes = getattr(config_json, "log_card_changes", False)
+    config.http_pool_size = getattr(config_json, "http_pool_size", DEFAULT_HTTP_POOL_SIZE)
+    config.http_timeout_seconds = getattr(config_json, "http_timeout_seconds", DEFAULT_HTTP_TIMEOUT_SECONDS)
+    config.normalize_html = getattr(config_json, "normalize_html", True)
+    config.normalize_whitespace = getattr(config_json, "normalize_whitespace", True)
+    config.normalize_unicode = getattr(config_json, "normalize_unicode", True)
+    if config.value_render_option not in VALUE_RENDER_OPTIONS:
+        logging.warning("Unknown value render option %s, using %s", config.value_render_option, VALUE_RENDER_OPTIONS[0])
+        config.value_render_option = VALUE_RENDER_OPTIONS[0]
+
+    return config
+
+
+def write_addon_config(config: AddonConfig, addon_config_file: str) -> None:
+    """Save add-on configuration into JSON file"""
+
+    config_json: Any = {}
+    config_json["credentials_file"] = config.credentials_file
+    config_json["sync_config_file"] = config.sync_config_file
+    config_json["fetch_worker_count"] = config.fetch_worker_count
+    config_json["prewarm_google_services"] = config.prewarm_google_services
+    config_json["value_render_option"] = config.value_render_option
+    config_json["auto_sync_enabled"] = config.auto_sync_enabled
+    config_json["auto_sync_interval_minutes"] = config.auto_sync_interval_minutes
+    config_json["log_card_changes"] = config.log_card_changes
+    config_json["http_pool_size"] = config.http_pool_size
+    config_json["http_timeout_seconds"] = config.http_timeout_seconds
+    config_json["normalize_html"] = config.normalize_html
+    config_json["normalize_whitespace"] = config.normalize_whitespace
+    config_json["normalize_unicode"] = config.normalize_unicode
+
+    with open(addon_config_file, "w+", encoding="utf8") as json_file:
+        json.dump(config_json, json_file, indent=4)
+
+
+def load_synchronization_map(sync_config_file: str) -> List[Any]:
+    """Load the spreadsheets and their sheets to sync from the import_config.json file"""
+
+    logging.info("Loading sync config: %s.", sync_config_file)
+    with open(sync_config_file, "r", encoding="utf8") as data:
+        import_config_json = json.load(data, object_hook=lambda d: SimpleNamespace(**d))
+    return import_config_json.synchronization_map
+
+
+def load_sheet_read_options(config: AddonConfig, sync_config_file: str) -> SheetReadOptions:
+    """Read options from the add-on settings, with the spreadsheets which have "fetch_mode": "csv_export" in the sync config"""
+
+    csv_export_spreadsheet_names: Set[str] = set()
+    for spreadsheet_settings in load_synchronization_map(sync_config_file):
+        fetch_mode: str = getattr(spreadsheet_settings, "fetch_mode", FETCH_MODES[0])
+        if fetch_mode not in FETCH_MODES:
+            logging.warning(
+                "Unknown fetch mode %s of spreadsheet '%s', using %s", fetch_mode, spreadsheet_settings.spreadsheet_name, FETCH_MODES[0])
+        elif fetch_mode == "csv_export":
+            csv_export_spreadsheet_names.add(spreadsheet_settings.spreadsheet_name)
+
+    return SheetReadOptions(config.value_render_option, csv_export_spreadsheet_names=csv_export_spreadsheet_names)
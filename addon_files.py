@@ -0,0 +1,57 @@
+"""
+Files of the add-on: the user files kept in the add-on folder, and the add-on configuration.
+
+"""
+
+import logging
+import os.path
+
+from .addon_config import AddonConfig, read_addon_config, write_addon_config
+
+USER_DATA_DIR: str = "user_files"
+ADDON_NAME: str = "goosheesy"
+ADDON_CONFIG: str = ADDON_NAME + ".json"
+GOOGLE_API_CREDENTIALS_FILE = "credentials.json"
+GOOGLE_API_TOKEN_FILE = "token.json"
+SPREADSHEET_ID_CACHE_FILE: str = "spreadsheet_ids.json"
+SYNC_STATE_FILE: str = "sync_state.json"
+SNAPSHOT_DATABASE_FILE: str = "sync_snapshots.db"
+SYNC_METRICS_FILE: str = "sync_metrics.jsonl"
+DRIVE_CHANGES_CURSOR_FILE: str = "drive_changes.json"
+SYNC_HISTORY_FILE: str = "sync_history.json"
+SYNC_PLAN_FILE: str = "sync_plan.json"
+
+
+def get_addon_dir() -> str:
+    addon_dir: str = os.path.dirname(__file__)
+    return addon_dir
+
+
+def get_user_data_dir() -> str:
+    user_data_dir: str = os.path.join(get_addon_dir(), USER_DATA_DIR)
+    return user_data_dir
+
+
+def get_user_file(filename: str) -> str:
+    user_file: str = os.path.join(get_user_data_dir(), filename)
+    return user_file
+
+
+def get_addon_config_path() -> str:
+    addon_config: str = get_user_file(ADDON_CONFIG)
+    return addon_config
+
+
+def load_addon_config() -> AddonConfig:
+    """Load add-on configuration from JSON file"""
+    addon_config_file: str = get_addon_config_path()
+    logging.info("Loading local addon config from: %s", addon_config_file)
+    return read_addon_config(addon_config_file)
+
+
+def save_addon_config(config: AddonConfig):
+    """Save add-on configuration into JSON file"""
+
+    addon_config_file: str = get_addon_config_path()
+    logging.info("Saving add-on configuration to %s", addon_config_file)
+    write_addon_config(config, addon_config_file)
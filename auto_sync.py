@@ -0,0 +1,181 @@
+"""
+Background tasks of the add-on: the automatic sync of the changed spreadsheets and the refresh of the Google token.
+
+"""
+
+import logging
+import os
+from aqt import mw
+from concurrent.futures import Future
+from .addon_config import AddonConfig, load_synchronization_map
+from .addon_files import GOOGLE_API_TOKEN_FILE, SPREADSHEET_ID_CACHE_FILE, DRIVE_CHANGES_CURSOR_FILE, get_user_file, load_addon_config
+from .deck_sync import DeckSyncResult
+from .google_connection import load_saved_credentials, refresh_credentials_ahead, HttpTransportOptions
+from .google_sheets import GoogleServices, SpreadsheetIdCache, get_google_services, get_drive_changes_start_token, list_changed_file_ids
+from .headless_sync import SpreadsheetSettings
+from .sync_runner import is_sync_running, start_sync
+from .sync_state import DriveChangesCursor
+from typing import Any
+from typing import List
+from typing import Set
+
+# the first automatic sync waits until the warm-up has prepared the services
+AUTO_SYNC_FIRST_POLL_DELAY_MS: int = 10000
+# how often the expiry of the access token is checked, it is refreshed in background shortly before it expires
+TOKEN_REFRESH_CHECK_INTERVAL_MS: int = 60 * 1000
+
+
+def find_changed_spreadsheets(spreadsheet_names: List[str], transport_options: HttpTransportOptions) -> Set[str]:
+    """Called from a background thread, returns the configured spreadsheets changed since the previous poll of the Drive changes feed.
+       On the first poll all spreadsheets are returned, unchanged sheets are then skipped cheaply by the sync itself."""
+
+    credentials = load_saved_credentials(get_user_file(GOOGLE_API_TOKEN_FILE))
+    if credentials is None:
+        # automatic sync never opens the browser login, the first sync has to be started by the user
+        logging.info("Automatic sync skipped: no saved Google token, run a sync manually first")
+        return set()
+
+    services: GoogleServices = get_google_services(credentials, transport_options)
+    cursor: DriveChangesCursor = DriveChangesCursor(get_user_file(DRIVE_CHANGES_CURSOR_FILE))
+    changed_names: Set[str] = set(spreadsheet_names)
+
+    if cursor.page_token is None:
+        cursor.page_token = get_drive_changes_start_token(services)
+    else:
+        try:
+            changed_file_ids, cursor.page_token = list_changed_file_ids(services, cursor.page_token)
+        except Exception as error:
+            # e.g. the page token expired, start the feed anew and check every spreadsheet once
+            logging.warning("Failed to list Drive changes, syncing all spreadsheets: %s - %s", type(error).__name__, error)
+            cursor.page_token = get_drive_changes_start_token(services)
+        else:
+            id_cache: SpreadsheetIdCache = SpreadsheetIdCache(get_user_file(SPREADSHEET_ID_CACHE_FILE))
+            # spreadsheets with unknown IDs are synced, which also resolves their IDs
+            changed_names = {
+                spreadsheet_name for spreadsheet_name in spreadsheet_names
+                if id_cache.get(spreadsheet_name) is None or id_cache.get(spreadsheet_name) in changed_file_ids}
+            changed_names.update(name for name in cursor.pending_spreadsheet_names if name in spreadsheet_names)
+
+    # the spreadsheets stay pending until their sync finishes without errors
+    cursor.pending_spreadsheet_names = sorted(changed_names)
+    cursor.save()
+    logging.info("Spreadsheets changed since the previous poll: %s", cursor.pending_spreadsheet_names)
+    return changed_names
+
+
+def on_automatic_sync_finished(results: List[DeckSyncResult]):
+    cursor: DriveChangesCursor = DriveChangesCursor(get_user_file(DRIVE_CHANGES_CURSOR_FILE))
+    cursor.pending_spreadsheet_names = sorted({result.spreadsheet_name for result in results if result.error is not None})
+    try:
+        cursor.save()
+    except OSError as error:
+        logging.error("Failed to save Drive changes cursor: %s", error)
+
+
+class AutoSyncScheduler:
+    """Opt-in automatic sync: after the profile opens and then at the configured interval polls the Drive changes feed
+       with one request, and syncs in background the decks of the spreadsheets which changed"""
+
+    def __init__(self):
+        self.timer = None
+        self.poll_running = False
+
+    timer: Any
+    poll_running: bool
+
+    def start(self, config: AddonConfig):
+        self.stop()
+        if not config.auto_sync_enabled:
+            return
+
+        logging.info("Automatic sync every %s minutes", config.auto_sync_interval_minutes)
+        self.timer = mw.progress.timer(config.auto_sync_interval_minutes * 60 * 1000, self.poll, True, True, parent=mw)
+        mw.progress.single_shot(AUTO_SYNC_FIRST_POLL_DELAY_MS, self.poll, True)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer.deleteLater()
+            self.timer = None
+
+    def poll(self):
+        if self.timer is None or self.poll_running or is_sync_running():
+            return
+
+        config: AddonConfig = load_addon_config()
+        if not config.auto_sync_enabled or not os.path.exists(config.sync_config_file):
+            return
+
+        try:
+            spreadsheets: List[SpreadsheetSettings] = [
+                (spreadsheet_settings.spreadsheet_name, spreadsheet_settings.sheets)
+                for spreadsheet_settings in load_synchronization_map(config.sync_config_file)]
+        except Exception as error:
+            # e.g. the sync config is being edited, the next poll reads it again
+            logging.error("Automatic sync skipped, failed to load sync config: %s - %s", type(error).__name__, error)
+            return
+
+        self.poll_running = True
+        mw.taskman.run_in_background(
+            lambda: find_changed_spreadsheets([spreadsheet_name for spreadsheet_name, _ in spreadsheets], config.get_transport_options()),
+            lambda future: self.on_poll_done(config, spreadsheets, future),
+            uses_collection=False)
+
+    def on_poll_done(self, config: AddonConfig, spreadsheets: List[SpreadsheetSettings], future: Future):
+        self.poll_running = False
+        try:
+            changed_names: Set[str] = future.result()
+        except Exception as error:
+            logging.error("Failed to poll Drive changes: %s - %s", type(error).__name__, error)
+            return
+
+        changed_spreadsheets: List[SpreadsheetSettings] = [
+            (spreadsheet_name, sheets_settings) for spreadsheet_name, sheets_settings in spreadsheets if spreadsheet_name in changed_names]
+        if changed_spreadsheets and self.timer is not None:
+            start_sync(config, changed_spreadsheets, False, automatic=True, on_finished=on_automatic_sync_finished)
+
+
+auto_sync_scheduler: AutoSyncScheduler = AutoSyncScheduler()
+
+
+class TokenRefresher:
+    """Refreshes in background the access token of the credentials in use before it expires,
+       so that syncs always find a valid token and never wait for the refresh"""
+
+    def __init__(self):
+        self.timer = None
+        self.refresh_running = False
+
+    timer: Any
+    refresh_running: bool
+
+    def start(self):
+        self.stop()
+        self.timer = mw.progress.timer(TOKEN_REFRESH_CHECK_INTERVAL_MS, self.check, True, False, parent=mw)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer.deleteLater()
+            self.timer = None
+
+    def check(self):
+        if self.timer is None or self.refresh_running:
+            return
+
+        self.refresh_running = True
+        mw.taskman.run_in_background(
+            lambda: refresh_credentials_ahead(get_user_file(GOOGLE_API_TOKEN_FILE)),
+            self.on_check_done,
+            uses_collection=False)
+
+    def on_check_done(self, future: Future):
+        self.refresh_running = False
+        try:
+            future.result()
+        except Exception as error:
+            # the next sync refreshes the expired token itself and reports the problem to the user
+            logging.warning("Failed to refresh Google token in background: %s - %s", type(error).__name__, error)
+
+
+token_refresher: TokenRefresher = TokenRefresher()
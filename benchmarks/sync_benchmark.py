@@ -0,0 +1,471 @@
+"""
+Offline benchmark of the sheet to deck sync.
+
+Google Drive and Google Sheets are replaced with in-memory stand-ins serving synthetic sheets,
+and decks are synced into a temporary Anki collection on disk. For every sheet size the benchmark runs:
+    * full - the first sync into the empty deck
+    * incremental - sync after a part of the rows changed in the sheet
+    * incremental-full-diff - the same kind of change, synced with the whole deck compared ("Force full sync")
+    * no-op - sync when neither the sheet nor the deck changed
+The sheets are read with the values API, or as CSV exports with --fetch-mode csv_export.
+A second table compares the size and parse time of values API responses and CSV exports of the same sheets.
+
+Requires the anki package in the Python environment, e.g. the one Anki is installed into:
+    python benchmarks/sync_benchmark.py --rows 1000 10000 100000 --change-ratio 0.01
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+ADDON_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDON_PACKAGE: str = "goosheesy"
+
+# the add-on modules are loaded without the add-on __init__.py, which needs the running Anki GUI
+if ADDON_PACKAGE not in sys.modules:
+    addon_package = types.ModuleType(ADDON_PACKAGE)
+    addon_package.__path__ = [ADDON_DIR]
+    sys.modules[ADDON_PACKAGE] = addon_package
+
+from anki.collection import Collection  # noqa: E402
+from goosheesy.deck_sync import DeckSyncResult  # noqa: E402
+from goosheesy.deck_sync import RemoteDeck  # noqa: E402
+from goosheesy.google_connection import RequestStats  # noqa: E402
+from goosheesy.google_sheets import (  # noqa: E402
+    FETCH_MODES, SHEET_ROWS_CHUNK_SIZE, SheetReadOptions, SpreadsheetIdCache, add_remote_card, iter_csv_rows)
+from goosheesy.headless_sync import sync_collection  # noqa: E402
+from goosheesy.sync_metrics import SyncMetrics  # noqa: E402
+from goosheesy.sync_state import SnapshotStore, SyncStateStore  # noqa: E402
+
+SPREADSHEET_NAME: str = "Benchmark spreadsheet"
+SHEET_NAME: str = "Benchmark sheet"
+DECK_NAME: str = "Benchmark deck"
+FETCH_WORKER_COUNT: int = 4
+
+
+class FakeRequest:
+    """Stand-in for the googleapiclient request, executed by FakeGoogleServices"""
+
+    def __init__(self, response: Callable[[], Any]):
+        self.response = response
+
+    response: Callable[[], Any]
+
+
+class FakeGoogleServices:
+    """Stand-in for GoogleServices serving the spreadsheets from memory, counting requests and response bytes.
+       The same object plays the Drive files resource and the Sheets spreadsheets and values resources.
+       Bytes are counted as JSON before and after gzip compression, which the add-on requests for every response."""
+
+    def __init__(self):
+        self.sheets = self
+        self.drive = self
+        self.spreadsheets_data = {}
+        self.versions = {}
+        self.request_count = 0
+        self.received_bytes = 0
+        self.compressed_bytes = 0
+        self.accounting_seconds = 0.0
+        self.lock = threading.Lock()
+
+    sheets: Any
+    drive: Any
+    # spreadsheet ID -> sheet name -> rows
+    spreadsheets_data: Dict[str, Dict[str, List[List[str]]]]
+    versions: Dict[str, int]
+    request_count: int
+    received_bytes: int
+    compressed_bytes: int
+    # time spent on counting bytes, which is excluded from the measured wall time
+    accounting_seconds: float
+    lock: threading.Lock
+
+    def put_sheet(self, spreadsheet_id: str, sheet_name: str, rows: List[List[str]]) -> None:
+        self.spreadsheets_data.setdefault(spreadsheet_id, {})[sheet_name] = rows
+        self.versions[spreadsheet_id] = self.versions.get(spreadsheet_id, 0) + 1
+
+    def execute(self, request: FakeRequest) -> Any:
+        response = request.response()
+        accounting_start: float = time.perf_counter()
+        self.count_response(json.dumps(response).encode("utf8"), accounting_start)
+        return response
+
+    def export_sheet_csv(self, spreadsheet_id: str, sheet_id: int) -> bytes:
+        content: bytes = format_csv(list(self.spreadsheets_data[spreadsheet_id].values())[sheet_id])
+        self.count_response(content, time.perf_counter())
+        return content
+
+    def count_response(self, content: bytes, accounting_start: float) -> None:
+        compressed_size: int = len(gzip.compress(content, compresslevel=6))
+        with self.lock:
+            self.request_count += 1
+            self.received_bytes += len(content)
+            self.compressed_bytes += compressed_size
+            self.accounting_seconds += time.perf_counter() - accounting_start
+
+    def get_request_stats(self) -> RequestStats:
+        stats: RequestStats = RequestStats()
+        with self.lock:
+            stats.request_count = self.request_count
+            stats.received_bytes = self.received_bytes
+        return stats
+
+    # Drive files resource
+    def files(self) -> "FakeGoogleServices":
+        return self
+
+    def list(self, **kwargs) -> FakeRequest:
+        return FakeRequest(lambda: {"files": [{"id": spreadsheet_id, "name": spreadsheet_id} for spreadsheet_id in self.spreadsheets_data]})
+
+    # Drive files.get and Sheets spreadsheets.get
+    def get(self, fileId: Optional[str] = None, spreadsheetId: Optional[str] = None, fields: str = "") -> FakeRequest:
+        if spreadsheetId is not None:
+            return FakeRequest(lambda: {"sheets": [
+                {"properties": {"sheetId": sheet_id, "title": sheet_name, "gridProperties": {"rowCount": max(1000, len(rows))}}}
+                for sheet_id, (sheet_name, rows) in enumerate(self.spreadsheets_data[spreadsheetId].items())]})
+
+        assert fileId is not None
+        return FakeRequest(lambda: {"version": str(self.versions[fileId]), "modifiedTime": f"2000-01-01T00:00:{self.versions[fileId]}Z"})
+
+    # Sheets spreadsheets and values resources
+    def spreadsheets(self) -> "FakeGoogleServices":
+        return self
+
+    def values(self) -> "FakeGoogleServices":
+        return self
+
+    def batchGet(self, spreadsheetId: str, ranges: List[str], fields: str = "", **kwargs) -> FakeRequest:
+        # the only field mask the add-on uses for values leaves out the A1 notation of the ranges
+        if fields == "valueRanges(values)":
+            return FakeRequest(lambda: {"valueRanges": [
+                {"values": self.get_range_values(spreadsheetId, sheet_range)} for sheet_range in ranges]})
+        return FakeRequest(lambda: {"valueRanges": [
+            {"range": sheet_range, "majorDimension": "ROWS", "values": self.get_range_values(spreadsheetId, sheet_range)}
+            for sheet_range in ranges]})
+
+    def get_range_values(self, spreadsheet_id: str, sheet_range: str) -> List[List[str]]:
+        quoted_sheet_name, cells = sheet_range.rsplit("!", 1)
+        rows: List[List[str]] = self.spreadsheets_data[spreadsheet_id][quoted_sheet_name[1:-1].replace("''", "'")]
+
+        # windows like A1:B5000, a plain A:B range returns the whole sheet
+        first_cell, last_cell = cells.split(":")
+        if first_cell[1:].isdigit() and last_cell[1:].isdigit():
+            return rows[int(first_cell[1:]) - 1:int(last_cell[1:])]
+        return rows
+
+
+class CollectionOperationCounter:
+    """Counts database queries and note calls of the collection made by the sync"""
+
+    COUNTED_COLLECTION_METHODS: List[str] = ["get_note", "new_note", "add_notes", "update_notes", "remove_notes"]
+    COUNTED_DATABASE_METHODS: List[str] = ["all", "first", "scalar", "list", "execute"]
+
+    def __init__(self, col: Collection):
+        self.counts = {}
+        for method_name in self.COUNTED_COLLECTION_METHODS:
+            setattr(col, method_name, self.wrap(method_name, getattr(col, method_name)))
+        for method_name in self.COUNTED_DATABASE_METHODS:
+            setattr(col.db, method_name, self.wrap(f"db.{method_name}", getattr(col.db, method_name)))
+
+    counts: Dict[str, int]
+
+    def wrap(self, name: str, method: Callable) -> Callable:
+        def counted_method(*args, **kwargs):
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return method(*args, **kwargs)
+        return counted_method
+
+    def reset(self) -> None:
+        self.counts = {}
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+class BenchmarkSyncer:
+    """Runs the headless sync of the add-on, the same as the command-line sync, against the stand-in services.
+       It resolves and fetches the spreadsheet, skips it if unchanged, then plans the deck sync
+       (from the snapshot if the deck didn't change) and applies it."""
+
+    def __init__(self, work_dir: str, services: FakeGoogleServices, read_options: SheetReadOptions):
+        self.col = Collection(os.path.join(work_dir, "collection.anki2"))
+        self.col.decks.id(DECK_NAME)
+        self.services = services
+        self.id_cache = SpreadsheetIdCache(os.path.join(work_dir, "spreadsheet_ids.json"))
+        self.state_store = SyncStateStore(os.path.join(work_dir, "sync_state.json"))
+        self.snapshot_store = SnapshotStore(os.path.join(work_dir, "sync_snapshots.db"))
+        self.operation_counter = CollectionOperationCounter(self.col)
+        self.read_options = read_options
+
+    col: Collection
+    services: FakeGoogleServices
+    id_cache: SpreadsheetIdCache
+    state_store: SyncStateStore
+    snapshot_store: SnapshotStore
+    operation_counter: CollectionOperationCounter
+    read_options: SheetReadOptions
+
+    def sync(self, force_full_sync: bool) -> str:
+        """Returns the outcome of the sync: skipped, or the numbers of added, updated and removed cards"""
+
+        sheets_settings: List[Any] = [types.SimpleNamespace(sheet_name=SHEET_NAME, deck_name=DECK_NAME)]
+        result: DeckSyncResult = sync_collection(
+            self.col, self.services, [(SPREADSHEET_NAME, sheets_settings)],  # type: ignore
+            self.id_cache, self.state_store, self.snapshot_store, FETCH_WORKER_COUNT, self.read_options, force_full_sync, SyncMetrics())[0]
+
+        if result.error is not None:
+            raise RuntimeError(result.error)
+        if result.skipped:
+            return "skipped"
+        return f"added {result.added_card_count}, updated {result.updated_card_count}, removed {result.removed_card_count}"
+
+    def close(self) -> None:
+        self.snapshot_store.close()
+        self.col.close()
+
+
+def generate_rows(row_count: int) -> List[List[str]]:
+    return [[f"word {row_index}", f"translation {row_index}"] for row_index in range(row_count)]
+
+
+def format_csv(rows: List[List[str]]) -> bytes:
+    """Returns the rows as the export endpoint of Google Sheets formats them"""
+
+    content = io.StringIO()
+    csv.writer(content, lineterminator="\r\n").writerows(rows)
+    return content.getvalue().encode("utf8")
+
+
+def change_rows(rows: List[List[str]], change_ratio: float, revision: int) -> List[List[str]]:
+    """Changes values of change_ratio of the rows and replaces half as many rows with new ones"""
+
+    changed_rows: List[List[str]] = [list(row) for row in rows]
+    changed_count: int = max(1, int(len(rows) * change_ratio))
+    step: int = max(1, len(rows) // changed_count)
+
+    for row_index in range(0, len(rows), step)[:changed_count]:
+        changed_rows[row_index][1] = f"translation {row_index}, revision {revision}"
+    for row_index in range(step // 2, len(rows), step * 2)[:changed_count // 2]:
+        changed_rows[row_index] = [f"new word {row_index}, revision {revision}", f"translation {row_index}"]
+
+    return changed_rows
+
+
+class Measurement:
+    """Cost of one sync scenario"""
+
+    def __init__(self, row_count: int, scenario: str):
+        self.row_count = row_count
+        self.scenario = scenario
+        self.outcome = ""
+        self.wall_time_seconds = 0.0
+        self.api_request_count = 0
+        self.received_bytes = 0
+        self.compressed_bytes = 0
+        self.collection_operation_count = 0
+        self.collection_operations = {}
+        self.peak_memory_bytes: Optional[int] = None
+
+    row_count: int
+    scenario: str
+    outcome: str
+    wall_time_seconds: float
+    api_request_count: int
+    received_bytes: int
+    compressed_bytes: int
+    collection_operation_count: int
+    collection_operations: Dict[str, int]
+    peak_memory_bytes: Optional[int]
+
+
+def run_scenarios(row_count: int, change_ratio: float, trace_memory: bool, fetch_mode: str) -> List[Measurement]:
+    """Runs all scenarios for the sheet of row_count rows in a fresh collection"""
+
+    work_dir: str = tempfile.mkdtemp(prefix="goosheesy-benchmark-")
+    services: FakeGoogleServices = FakeGoogleServices()
+    services.put_sheet(SPREADSHEET_NAME, SHEET_NAME, generate_rows(row_count))
+    read_options: SheetReadOptions = SheetReadOptions(
+        csv_export_spreadsheet_names={SPREADSHEET_NAME} if fetch_mode == "csv_export" else set())
+    syncer: BenchmarkSyncer = BenchmarkSyncer(work_dir, services, read_options)
+    measurements: List[Measurement] = []
+
+    def measure(scenario: str, force_full_sync: bool) -> None:
+        measurement: Measurement = Measurement(row_count, scenario)
+        services.request_count = 0
+        services.received_bytes = 0
+        services.compressed_bytes = 0
+        services.accounting_seconds = 0.0
+        syncer.operation_counter.reset()
+
+        if trace_memory:
+            tracemalloc.start()
+        start_time: float = time.perf_counter()
+        measurement.outcome = syncer.sync(force_full_sync)
+        measurement.wall_time_seconds = time.perf_counter() - start_time - services.accounting_seconds
+        if trace_memory:
+            measurement.peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        measurement.api_request_count = services.request_count
+        measurement.received_bytes = services.received_bytes
+        measurement.compressed_bytes = services.compressed_bytes
+        measurement.collection_operation_count = syncer.operation_counter.total()
+        measurement.collection_operations = dict(syncer.operation_counter.counts)
+        measurements.append(measurement)
+
+    try:
+        measure("full", False)
+
+        rows: List[List[str]] = services.spreadsheets_data[SPREADSHEET_NAME][SHEET_NAME]
+        services.put_sheet(SPREADSHEET_NAME, SHEET_NAME, change_rows(rows, change_ratio, 1))
+        measure("incremental", False)
+
+        rows = services.spreadsheets_data[SPREADSHEET_NAME][SHEET_NAME]
+        services.put_sheet(SPREADSHEET_NAME, SHEET_NAME, change_rows(rows, change_ratio, 2))
+        measure("incremental-full-diff", True)
+
+        measure("no-op", False)
+    finally:
+        syncer.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return measurements
+
+
+class FormatMeasurement:
+    """Size and parse time of one sheet downloaded in one of the fetch modes"""
+
+    def __init__(self, row_count: int, fetch_mode: str, received_bytes: int, compressed_bytes: int, parse_seconds: float):
+        self.row_count = row_count
+        self.fetch_mode = fetch_mode
+        self.received_bytes = received_bytes
+        self.compressed_bytes = compressed_bytes
+        self.parse_seconds = parse_seconds
+
+    row_count: int
+    fetch_mode: str
+    received_bytes: int
+    compressed_bytes: int
+    parse_seconds: float
+
+
+def compare_fetch_modes(row_count: int) -> List[FormatMeasurement]:
+    """Measures the responses of the values API, in windows as the add-on requests them, and the CSV export of the same sheet.
+       Parse time covers decoding the response and gathering the cards of the deck."""
+
+    rows: List[List[str]] = generate_rows(row_count)
+
+    value_windows: List[bytes] = [
+        json.dumps({"valueRanges": [{"values": rows[first_row:first_row + SHEET_ROWS_CHUNK_SIZE]}]}).encode("utf8")
+        for first_row in range(0, max(1, len(rows)), SHEET_ROWS_CHUNK_SIZE)]
+    parse_start: float = time.perf_counter()
+    values_deck: RemoteDeck = {}
+    for content in value_windows:
+        for value_range in json.loads(content)["valueRanges"]:
+            for row in value_range.get("values", []):
+                add_remote_card(values_deck, row)
+    values_parse_seconds: float = time.perf_counter() - parse_start
+
+    csv_content: bytes = format_csv(rows)
+    parse_start = time.perf_counter()
+    csv_deck: RemoteDeck = {}
+    for row in iter_csv_rows(csv_content):
+        add_remote_card(csv_deck, row)
+    csv_parse_seconds: float = time.perf_counter() - parse_start
+
+    if not csv_deck == values_deck:
+        raise RuntimeError("Decks parsed from the values API and from the CSV export differ")
+
+    return [
+        FormatMeasurement(row_count, "values", sum(len(content) for content in value_windows),
+                          sum(len(gzip.compress(content, compresslevel=6)) for content in value_windows), values_parse_seconds),
+        FormatMeasurement(row_count, "csv_export", len(csv_content), len(gzip.compress(csv_content, compresslevel=6)), csv_parse_seconds),
+    ]
+
+
+def format_table(measurements: List[Measurement]) -> str:
+    header: Tuple[str, ...] = (
+        "rows", "scenario", "wall time, s", "API requests", "received, KiB", "gzipped, KiB", "collection ops", "peak memory, MiB",
+        "outcome")
+    lines: List[Tuple[str, ...]] = [header]
+    for measurement in measurements:
+        peak_memory: str = "-" if measurement.peak_memory_bytes is None else f"{measurement.peak_memory_bytes / 2**20:.1f}"
+        lines.append((
+            str(measurement.row_count), measurement.scenario, f"{measurement.wall_time_seconds:.3f}", str(measurement.api_request_count),
+            f"{measurement.received_bytes / 2**10:.1f}", f"{measurement.compressed_bytes / 2**10:.1f}",
+            str(measurement.collection_operation_count), peak_memory, measurement.outcome))
+
+    return align_columns(lines)
+
+
+def format_fetch_mode_table(measurements: List[FormatMeasurement]) -> str:
+    header: Tuple[str, ...] = ("rows", "fetch mode", "received, KiB", "gzipped, KiB", "parse time, s")
+    lines: List[Tuple[str, ...]] = [header]
+    for measurement in measurements:
+        lines.append((
+            str(measurement.row_count), measurement.fetch_mode, f"{measurement.received_bytes / 2**10:.1f}",
+            f"{measurement.compressed_bytes / 2**10:.1f}", f"{measurement.parse_seconds:.3f}"))
+
+    return align_columns(lines)
+
+
+def align_columns(lines: List[Tuple[str, ...]]) -> str:
+    header: Tuple[str, ...] = lines[0]
+    widths: List[int] = [max(len(line[column]) for line in lines) for column in range(len(header))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmark of syncing a sheet into an Anki deck")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000], help="sizes of the synthetic sheet")
+    parser.add_argument("--change-ratio", type=float, default=0.01, help="part of the rows changed before the incremental syncs")
+    parser.add_argument("--skip-memory", action="store_true", help="don't trace peak memory, it slows down the measured syncs")
+    parser.add_argument("--fetch-mode", choices=FETCH_MODES, default=FETCH_MODES[0], help="how the synced sheet is downloaded")
+    parser.add_argument("--json", dest="json_file", help="also write the measurements to the JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    measurements: List[Measurement] = []
+    format_measurements: List[FormatMeasurement] = []
+    for row_count in args.rows:
+        # wall time is measured without memory tracing, peak memory in a separate run of the same scenarios
+        timed_measurements: List[Measurement] = run_scenarios(row_count, args.change_ratio, False, args.fetch_mode)
+        if not args.skip_memory:
+            traced_measurements: List[Measurement] = run_scenarios(row_count, args.change_ratio, True, args.fetch_mode)
+            for timed_measurement, traced_measurement in zip(timed_measurements, traced_measurements):
+                timed_measurement.peak_memory_bytes = traced_measurement.peak_memory_bytes
+        measurements.extend(timed_measurements)
+        format_measurements.extend(compare_fetch_modes(row_count))
+
+    print(format_table(measurements))
+    print()
+    print(format_fetch_mode_table(format_measurements))
+
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf8") as json_file:
+            json.dump({
+                "syncs": [vars(measurement) for measurement in measurements],
+                "fetch_modes": [vars(measurement) for measurement in format_measurements],
+            }, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,775 @@
+"""
+Diff engine for one-way syncing of a remote deck into an Anki deck.
+
+The whole Anki deck is loaded with one bulk read, the changes are computed in memory,
+and every kind of change is applied with a single bulk collection call.
+When a snapshot of the previous sync is available, only the rows changed since then are read from the deck.
+Card keys and values are compared after normalization, so formatting added by the Anki editor doesn't count as a change.
+
+"""
+
+import hashlib
+import html
+import logging
+import re
+import threading
+import unicodedata
+from anki.collection import AddNoteRequest, Collection
+from anki.dbproxy import DBProxy
+from anki.decks import DeckId
+from anki.errors import NotFoundError
+from anki.models import NotetypeDict, NotetypeId
+from anki.notes import Note, NoteId
+from anki.utils import ids2str, split_fields
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from .sync_metrics import SyncMetrics
+
+type RemoteDeck = Dict[str, str]
+# hash of the card key -> hash of the card value and ID of the note, as of the last sync
+type DeckSnapshot = Dict[str, Tuple[str, NoteId]]
+
+CARD_KEY_FIELD: str = "Front"
+CARD_VALUE_FIELD: str = "Back"
+
+# every created, updated and deleted card, off unless enabled in the settings: a large sync would write a log line per row
+card_changes_logger: logging.Logger = logging.getLogger("goosheesy.card_changes")
+
+
+def set_card_change_logging(enabled: bool) -> None:
+    card_changes_logger.setLevel(logging.NOTSET if enabled else logging.WARNING)
+
+
+# line breaks of the Anki editor, which are new lines in the sheet
+HTML_LINE_BREAK_PATTERN: re.Pattern = re.compile(r"<br\s*/?>|</div>|</p>", re.IGNORECASE)
+HTML_TAG_PATTERN: re.Pattern = re.compile(r"<!--.*?-->|<[^>]*>", re.DOTALL)
+
+
+class TextNormalization:
+    """Differences of card keys and values ignored when the Anki deck is compared with the remote deck.
+       Notes are matched and compared by normalized text, the original remote text is written to the notes."""
+
+    def __init__(self, strip_html: bool = True, collapse_whitespace: bool = True, unicode_nfc: bool = True):
+        self.strip_html = strip_html
+        self.collapse_whitespace = collapse_whitespace
+        self.unicode_nfc = unicode_nfc
+
+    # tags and entities, e.g. <br> and &nbsp; added by the editor
+    strip_html: bool
+    # runs of spaces, tabs, new lines and non-breaking spaces are one space, leading and trailing ones are dropped
+    collapse_whitespace: bool
+    # composed and decomposed forms of the same characters are equal
+    unicode_nfc: bool
+
+    def get_key(self) -> Tuple[bool, bool, bool]:
+        return (self.strip_html, self.collapse_whitespace, self.unicode_nfc)
+
+    def normalize(self, text: str) -> str:
+        if self.strip_html and ("<" in text or "&" in text):
+            text = html.unescape(HTML_TAG_PATTERN.sub("", HTML_LINE_BREAK_PATTERN.sub("\n", text)))
+        if self.collapse_whitespace:
+            text = " ".join(text.split())
+        if self.unicode_nfc and not text.isascii():
+            text = unicodedata.normalize("NFC", text)
+        return text
+
+
+class NormalizedNoteCache:
+    """Normalized card keys and values of the notes, kept for the session and shared by all syncs.
+       An entry is used while the note has the same modification time and fields, so a note is normalized again only after it's edited."""
+
+    def __init__(self):
+        self.normalization = TextNormalization()
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    normalization: TextNormalization
+    # note ID -> modification time, card key, card value, normalized card key, normalized card value or None until it's needed
+    entries: Dict[NoteId, Tuple[int, str, str, str, Optional[str]]]
+    lock: threading.Lock
+
+    def set_normalization(self, normalization: TextNormalization) -> None:
+        with self.lock:
+            if not normalization.get_key() == self.normalization.get_key():
+                self.normalization = normalization
+                self.entries = {}
+
+    def get_normalized_key(self, note_id: NoteId, modified: int, card_key: str, card_value: str) -> str:
+        with self.lock:
+            entry = self.entries.get(note_id)
+            if entry is not None and entry[0] == modified and entry[1] == card_key and entry[2] == card_value:
+                return entry[3]
+
+            normalized_key: str = self.normalization.normalize(card_key)
+            self.entries[note_id] = (modified, card_key, card_value, normalized_key, None)
+            return normalized_key
+
+    def get_normalized_value(self, note_id: NoteId, modified: int, card_key: str, card_value: str) -> str:
+        with self.lock:
+            entry = self.entries.get(note_id)
+            if entry is not None and entry[0] == modified and entry[1] == card_key and entry[2] == card_value:
+                if entry[4] is not None:
+                    return entry[4]
+                normalized_key: str = entry[3]
+            else:
+                normalized_key = self.normalization.normalize(card_key)
+
+            normalized_value: str = self.normalization.normalize(card_value)
+            self.entries[note_id] = (modified, card_key, card_value, normalized_key, normalized_value)
+            return normalized_value
+
+    def normalize(self, text: str) -> str:
+        return self.normalization.normalize(text)
+
+
+_normalized_notes: NormalizedNoteCache = NormalizedNoteCache()
+
+
+def set_text_normalization(normalization: TextNormalization) -> None:
+    """Set the differences ignored by all following syncs, the cached normalized notes are dropped if they change"""
+
+    _normalized_notes.set_normalization(normalization)
+
+
+def normalize_card_text(text: str) -> str:
+    return _normalized_notes.normalize(text)
+
+
+class LocalNote:
+    """Anki note of the synced deck, reduced to the fields taking part in the sync"""
+
+    def __init__(self, note_id: NoteId, card_key: str, card_value: str, modified: int = 0):
+        self.note_id = note_id
+        self.card_key = card_key
+        self.card_value = card_value
+        self.modified = modified
+
+    note_id: NoteId
+    card_key: str
+    card_value: str
+    # modification time of the note, in seconds
+    modified: int
+
+    def get_normalized_key(self) -> str:
+        return _normalized_notes.get_normalized_key(self.note_id, self.modified, self.card_key, self.card_value)
+
+    def has_equivalent_value(self, card_value: str) -> bool:
+        """Returns True if the card value is the same as the one of the note, or differs only in the ignored ways"""
+
+        if card_value == self.card_value:
+            return True
+        normalized_value: str = _normalized_notes.get_normalized_value(self.note_id, self.modified, self.card_key, self.card_value)
+        return _normalized_notes.normalize(card_value) == normalized_value
+
+
+class NoteUpdate:
+    """Change of the card value for the existing Anki note"""
+
+    def __init__(self, note_id: NoteId, card_key: str, old_card_value: str, new_card_value: str):
+        self.note_id = note_id
+        self.card_key = card_key
+        self.old_card_value = old_card_value
+        self.new_card_value = new_card_value
+
+    note_id: NoteId
+    card_key: str
+    old_card_value: str
+    new_card_value: str
+
+
+class DeckDiff:
+    """Set of changes which makes the Anki deck equal to the remote deck"""
+
+    def __init__(self):
+        self.notes_to_add: List[Tuple[str, str]] = []
+        self.notes_to_update: List[NoteUpdate] = []
+        self.notes_to_remove: List[LocalNote] = []
+        self.duplicate_card_keys: List[str] = []
+        self.added_note_ids: List[NoteId] = []
+        self.equivalent_note_count = 0
+
+    notes_to_add: List[Tuple[str, str]]
+    notes_to_update: List[NoteUpdate]
+    notes_to_remove: List[LocalNote]
+    duplicate_card_keys: List[str]
+    # filled when the diff is applied, in the order of notes_to_add
+    added_note_ids: List[NoteId]
+    # notes left as they are, as their key or value differs from the remote card only in the ignored ways
+    equivalent_note_count: int
+
+    def is_empty(self) -> bool:
+        return not self.notes_to_add and not self.notes_to_update and not self.notes_to_remove
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "notes_to_add": [[card_key, card_value] for card_key, card_value in self.notes_to_add],
+            "notes_to_update": [
+                [note_update.note_id, note_update.card_key, note_update.old_card_value, note_update.new_card_value]
+                for note_update in self.notes_to_update],
+            "notes_to_remove": [
+                [local_note.note_id, local_note.card_key, local_note.card_value, local_note.modified]
+                for local_note in self.notes_to_remove],
+            "duplicate_card_keys": self.duplicate_card_keys,
+            "equivalent_note_count": self.equivalent_note_count,
+        }
+
+    @staticmethod
+    def from_json(diff_json: Dict[str, Any]) -> "DeckDiff":
+        diff: DeckDiff = DeckDiff()
+        diff.notes_to_add = [(card_key, card_value) for card_key, card_value in diff_json["notes_to_add"]]
+        diff.notes_to_update = [
+            NoteUpdate(NoteId(note_id), card_key, old_card_value, new_card_value)
+            for note_id, card_key, old_card_value, new_card_value in diff_json["notes_to_update"]]
+        diff.notes_to_remove = [
+            LocalNote(NoteId(note_id), card_key, card_value, modified)
+            for note_id, card_key, card_value, modified in diff_json["notes_to_remove"]]
+        diff.duplicate_card_keys = diff_json["duplicate_card_keys"]
+        diff.equivalent_note_count = diff_json["equivalent_note_count"]
+        return diff
+
+
+class DeckSyncException(Exception):
+    """Anki deck can't be synced, e.g. it doesn't exist"""
+
+
+class DeckSyncPlan:
+    """Changes for one Anki deck together with everything needed to apply them"""
+
+    def __init__(self, deck_name: str, deck_id: DeckId, notetype: NotetypeDict, diff: DeckDiff):
+        self.deck_name = deck_name
+        self.deck_id = deck_id
+        self.notetype = notetype
+        self.diff = diff
+        self.incremental = False
+        self.snapshot_rows: Optional[DeckSnapshot] = {}
+        self.removed_key_hashes: List[str] = []
+
+    deck_name: str
+    deck_id: DeckId
+    notetype: NotetypeDict
+    diff: DeckDiff
+    # True if the diff was computed from the snapshot of the previous sync, and the snapshot only needs the changed rows
+    incremental: bool
+    # rows to write into the snapshot once the plan is applied, None if the deck can't be described by a snapshot
+    snapshot_rows: Optional[DeckSnapshot]
+    removed_key_hashes: List[str]
+
+    def to_json(self) -> Dict[str, Any]:
+        """The note type is kept by its ID and looked up again when the plan is loaded"""
+
+        return {
+            "deck_name": self.deck_name,
+            "deck_id": self.deck_id,
+            "notetype_id": self.notetype["id"],
+            "diff": self.diff.to_json(),
+            "incremental": self.incremental,
+            "snapshot_rows": None if self.snapshot_rows is None else {
+                key_hash: [value_hash, note_id] for key_hash, (value_hash, note_id) in self.snapshot_rows.items()},
+            "removed_key_hashes": self.removed_key_hashes,
+        }
+
+    @staticmethod
+    def from_json(col: Collection, plan_json: Dict[str, Any]) -> "DeckSyncPlan":
+        notetype: NotetypeDict | None = col.models.get(NotetypeId(plan_json["notetype_id"]))
+        if notetype is None:
+            raise DeckSyncException(f"Failed to find Anki note type with ID: {plan_json['notetype_id']}")
+
+        plan: DeckSyncPlan = DeckSyncPlan(
+            plan_json["deck_name"], DeckId(plan_json["deck_id"]), notetype, DeckDiff.from_json(plan_json["diff"]))
+        plan.incremental = plan_json["incremental"]
+        snapshot_rows: Optional[Dict[str, List[Any]]] = plan_json["snapshot_rows"]
+        plan.snapshot_rows = None if snapshot_rows is None else {
+            key_hash: (value_hash, NoteId(note_id)) for key_hash, (value_hash, note_id) in snapshot_rows.items()}
+        plan.removed_key_hashes = plan_json["removed_key_hashes"]
+        return plan
+
+
+class DeckSyncResult:
+    """Outcome of syncing one sheet into one Anki deck"""
+
+    def __init__(self, spreadsheet_name: str, sheet_name: str, deck_name: str):
+        self.spreadsheet_name = spreadsheet_name
+        self.sheet_name = sheet_name
+        self.deck_name = deck_name
+        self.added_card_count = 0
+        self.updated_card_count = 0
+        self.removed_card_count = 0
+        self.duplicate_card_key_count = 0
+        self.skipped = False
+        self.error: Optional[str] = None
+        self.sync_seconds = 0.0
+
+    spreadsheet_name: str
+    sheet_name: str
+    deck_name: str
+    added_card_count: int
+    updated_card_count: int
+    removed_card_count: int
+    duplicate_card_key_count: int
+    skipped: bool
+    error: Optional[str]
+    # time of comparing and writing the deck, without fetching the sheet
+    sync_seconds: float
+
+    def set_diff(self, diff: DeckDiff) -> None:
+        self.added_card_count = len(diff.notes_to_add)
+        self.updated_card_count = len(diff.notes_to_update)
+        self.removed_card_count = len(diff.notes_to_remove)
+        self.duplicate_card_key_count = len(diff.duplicate_card_keys)
+
+    def set_error(self, error: Exception) -> None:
+        self.error = f"{type(error).__name__} - {error}"
+
+    def describe(self) -> str:
+        if self.error is not None:
+            return f"Failed to sync sheet '{self.spreadsheet_name}'-'{self.sheet_name}' with deck '{self.deck_name}': {self.error}"
+        if self.skipped:
+            return f"{self.deck_name}: sheet and deck are unchanged since the last sync, skipped"
+
+        message: str = (
+            f"{self.deck_name}: new cards added: {self.added_card_count}, updated cards: {self.updated_card_count}, "
+            f"deleted cards: {self.removed_card_count}")
+        if self.duplicate_card_key_count:
+            message += f", card keys used by several notes: {self.duplicate_card_key_count}"
+        return message
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "spreadsheet_name": self.spreadsheet_name,
+            "sheet_name": self.sheet_name,
+            "deck_name": self.deck_name,
+            "added_card_count": self.added_card_count,
+            "updated_card_count": self.updated_card_count,
+            "removed_card_count": self.removed_card_count,
+            "duplicate_card_key_count": self.duplicate_card_key_count,
+            "skipped": self.skipped,
+            "error": self.error,
+            "sync_seconds": round(self.sync_seconds, 3),
+        }
+
+    @staticmethod
+    def from_json(result_json: Dict[str, Any]) -> "DeckSyncResult":
+        result: DeckSyncResult = DeckSyncResult(result_json["spreadsheet_name"], result_json["sheet_name"], result_json["deck_name"])
+        result.added_card_count = result_json["added_card_count"]
+        result.updated_card_count = result_json["updated_card_count"]
+        result.removed_card_count = result_json["removed_card_count"]
+        result.duplicate_card_key_count = result_json["duplicate_card_key_count"]
+        result.skipped = result_json["skipped"]
+        result.error = result_json["error"]
+        result.sync_seconds = result_json["sync_seconds"]
+        return result
+
+
+def get_database(col: Collection) -> DBProxy:
+    if col.db is None:
+        raise DeckSyncException("Anki collection is closed")
+    return col.db
+
+
+def load_deck_notes(col: Collection, deck_id: DeckId) -> List[LocalNote]:
+    """Read all notes having cards in the specified deck, also in filtered decks, with one database query"""
+
+    # cards moved into a filtered deck keep their home deck in odid
+    rows: List[Sequence[Any]] = get_database(col).all(
+        "select distinct n.id, n.mid, n.flds, n.mod from notes n join cards c on c.nid = n.id where (c.did = ? or c.odid = ?)",
+        deck_id, deck_id)
+
+    local_notes: List[LocalNote] = read_local_notes(col, rows)
+    logging.debug("Loaded %s notes from the deck with ID: %s", len(local_notes), deck_id)
+    return local_notes
+
+
+def load_notes(col: Collection, note_ids: List[NoteId]) -> List[LocalNote]:
+    """Read the specified notes with one database query, IDs of deleted notes are ignored"""
+
+    if not note_ids:
+        return []
+
+    rows: List[Sequence[Any]] = get_database(col).all(f"select id, mid, flds, mod from notes where id in {ids2str(note_ids)}")
+    return read_local_notes(col, rows)
+
+
+def read_local_notes(col: Collection, rows: List[Sequence[Any]]) -> List[LocalNote]:
+    # field positions are resolved once per note type, not once per note
+    field_ordinals: Dict[NotetypeId, Optional[Tuple[int, int]]] = {}
+    local_notes: List[LocalNote] = []
+
+    for note_id, mid, fields, modified in rows:
+        notetype_id: NotetypeId = NotetypeId(mid)
+        if notetype_id not in field_ordinals:
+            field_ordinals[notetype_id] = get_sync_field_ordinals(col, notetype_id)
+
+        ordinals = field_ordinals[notetype_id]
+        if ordinals is None:
+            logging.warning("Skipping note without '%s' and '%s' fields, note ID: %s", CARD_KEY_FIELD, CARD_VALUE_FIELD, note_id)
+            continue
+
+        key_ordinal, value_ordinal = ordinals
+        field_values: List[str] = split_fields(fields)
+        local_notes.append(LocalNote(NoteId(note_id), field_values[key_ordinal], field_values[value_ordinal], modified))
+
+    return local_notes
+
+
+def get_deck_fingerprint(col: Collection, deck_name: str) -> Optional[str]:
+    """Returns a cheap summary of the deck notes which changes whenever a note of the deck is added, removed or edited.
+       It also changes with the text normalization, as the notes compare differently then."""
+
+    deck_id: DeckId | None = col.decks.id_for_name(deck_name)
+    if deck_id is None:
+        return None
+
+    # modification time has one second resolution, so the length of fields also catches edits made within the second of the sync
+    summary: Optional[Sequence[Any]] = get_database(col).first(
+        "select count(), coalesce(max(mod), 0), coalesce(sum(id), 0), coalesce(sum(length(flds)), 0) from notes "
+        "where id in (select nid from cards where did = ? or odid = ?)",
+        deck_id, deck_id)
+    if summary is None:
+        return None
+
+    note_count, last_modified, note_id_sum, fields_length = summary
+    normalization_flags: str = "".join(str(int(flag)) for flag in _normalized_notes.normalization.get_key())
+    return f"{note_count}:{last_modified}:{note_id_sum}:{fields_length}:{normalization_flags}"
+
+
+def get_sync_field_ordinals(col: Collection, notetype_id: NotetypeId) -> Optional[Tuple[int, int]]:
+    """Returns positions of the card key and card value fields in the note type, or None if the note type lacks them"""
+
+    notetype: NotetypeDict | None = col.models.get(notetype_id)
+    if notetype is None:
+        return None
+
+    field_map = col.models.field_map(notetype)
+    if CARD_KEY_FIELD not in field_map or CARD_VALUE_FIELD not in field_map:
+        return None
+
+    return field_map[CARD_KEY_FIELD][0], field_map[CARD_VALUE_FIELD][0]
+
+
+class DeckIndex:
+    """Index of the Anki deck notes by normalized card key, built once per deck sync from the bulk read of the deck"""
+
+    def __init__(self, local_notes: List[LocalNote]):
+        self.notes_by_card_key: Dict[str, LocalNote] = {}
+        self.duplicate_notes: List[LocalNote] = []
+
+        for local_note in local_notes:
+            normalized_key: str = local_note.get_normalized_key()
+            if normalized_key in self.notes_by_card_key:
+                self.duplicate_notes.append(local_note)
+            else:
+                self.notes_by_card_key[normalized_key] = local_note
+
+    # normalized card key -> note
+    notes_by_card_key: Dict[str, LocalNote]
+    duplicate_notes: List[LocalNote]
+
+    def find_note(self, normalized_key: str) -> Optional[LocalNote]:
+        return self.notes_by_card_key.get(normalized_key)
+
+    def find_note_id(self, normalized_key: str) -> Optional[NoteId]:
+        local_note: LocalNote | None = self.notes_by_card_key.get(normalized_key)
+        if local_note is None:
+            return None
+        return local_note.note_id
+
+    def all_notes(self) -> List[LocalNote]:
+        return list(self.notes_by_card_key.values()) + self.duplicate_notes
+
+    def duplicate_card_keys(self) -> List[str]:
+        return sorted({local_note.card_key for local_note in self.duplicate_notes})
+
+
+def normalize_remote_keys(remote_deck: RemoteDeck) -> Dict[str, str]:
+    """Returns the card keys of the remote deck by their normalized form. Of the keys with the same normalized form the last one is kept."""
+
+    remote_keys: Dict[str, str] = {}
+    for card_key in remote_deck:
+        remote_keys[_normalized_notes.normalize(card_key)] = card_key
+
+    if len(remote_keys) < len(remote_deck):
+        logging.warning(
+            "Found %s card keys of the remote deck which differ only in the ignored formatting, only the last of them is synced",
+            len(remote_deck) - len(remote_keys))
+    return remote_keys
+
+
+def compute_deck_diff(index: DeckIndex, remote_deck: RemoteDeck, remote_keys: Dict[str, str]) -> DeckDiff:
+    """Compare notes of the Anki deck with the remote deck by normalized card keys and values:
+          * The note is updated if its card value differs from the remote one
+          * The note is removed if its card key is absent in the remote deck
+          * The remote card is added if there is no note with its card key in the Anki deck
+       Notes sharing the same card key are all kept and updated, and their keys are reported.
+    """
+
+    diff: DeckDiff = DeckDiff()
+    diff.duplicate_card_keys = index.duplicate_card_keys()
+    if diff.duplicate_card_keys:
+        logging.warning(
+            "Found %s card keys shared by several notes in the Anki deck: %s", len(diff.duplicate_card_keys), diff.duplicate_card_keys)
+
+    for local_note in index.all_notes():
+        remote_card_key: str | None = remote_keys.get(local_note.get_normalized_key())
+        if remote_card_key is None:
+            diff.notes_to_remove.append(local_note)
+            continue
+
+        remote_card_value: str = remote_deck[remote_card_key]
+        if not local_note.has_equivalent_value(remote_card_value):
+            diff.notes_to_update.append(NoteUpdate(local_note.note_id, local_note.card_key, local_note.card_value, remote_card_value))
+        elif not remote_card_value == local_note.card_value or not remote_card_key == local_note.card_key:
+            diff.equivalent_note_count += 1
+
+    for normalized_key, card_key in remote_keys.items():
+        if index.find_note(normalized_key) is None:
+            diff.notes_to_add.append((card_key, remote_deck[card_key]))
+
+    return diff
+
+
+def merge_remote_decks(remote_decks: List[RemoteDeck]) -> RemoteDeck:
+    """Merge the sheets synced into the same Anki deck, given in the configuration order.
+       A card key present in several sheets gets the value from the first of them."""
+
+    if len(remote_decks) == 1:
+        return remote_decks[0]
+
+    merged_deck: RemoteDeck = {}
+    for remote_deck in reversed(remote_decks):
+        merged_deck.update(remote_deck)
+
+    shared_key_count: int = sum(len(remote_deck) for remote_deck in remote_decks) - len(merged_deck)
+    if shared_key_count:
+        logging.warning(
+            "Found %s card keys present in several sheets of the deck, the values from the first sheet in the sync config are used",
+            shared_key_count)
+    return merged_deck
+
+
+def count_changes_by_source(diff: DeckDiff, remote_decks: List[RemoteDeck]) -> List[Tuple[int, int]]:
+    """Returns the number of added and updated cards taken from each of the merged remote decks"""
+
+    # normalized card key -> index of the first remote deck which has it
+    card_sources: Dict[str, int] = {}
+    for source_index, remote_deck in enumerate(remote_decks):
+        for card_key in remote_deck:
+            card_sources.setdefault(normalize_card_text(card_key), source_index)
+
+    counts: List[List[int]] = [[0, 0] for _ in remote_decks]
+    for card_key, _ in diff.notes_to_add:
+        counts[card_sources.get(normalize_card_text(card_key), 0)][0] += 1
+    for note_update in diff.notes_to_update:
+        counts[card_sources.get(normalize_card_text(note_update.card_key), 0)][1] += 1
+    return [(added_count, updated_count) for added_count, updated_count in counts]
+
+
+def hash_text(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf8"), digest_size=16).hexdigest()
+
+
+def compute_incremental_deck_diff(
+        col: Collection,
+        snapshot: DeckSnapshot,
+        remote_deck: RemoteDeck) -> Optional[Tuple[DeckDiff, DeckSnapshot, List[str]]]:
+    """Compare the remote deck with the snapshot of the previous sync, which is valid only while the Anki deck is unchanged since then.
+       Only the notes of changed and removed rows are read from the collection.
+       Returns the diff together with the changed and removed rows of the snapshot,
+       or None if a new card key has the same normalized form as another card key and the deck has to be compared in full."""
+
+    rows_to_add: List[Tuple[str, str]] = []
+    rows_to_update: Dict[NoteId, Tuple[str, str]] = {}
+    remote_key_hashes: set[str] = set()
+
+    for card_key, card_value in remote_deck.items():
+        key_hash: str = hash_text(card_key)
+        remote_key_hashes.add(key_hash)
+        snapshot_row: Tuple[str, NoteId] | None = snapshot.get(key_hash)
+        if snapshot_row is None:
+            rows_to_add.append((card_key, card_value))
+        elif not snapshot_row[0] == hash_text(card_value):
+            rows_to_update[snapshot_row[1]] = (card_key, card_value)
+
+    # every note of the deck is in the snapshot, and the notes of the rows still in the sheet keep their card keys,
+    # so a new card key collides with a note only if it collides with another remote card key
+    if rows_to_add and has_normalized_key_collisions(remote_deck):
+        logging.info("New card keys differ from other card keys only in the ignored formatting, comparing the whole deck")
+        return None
+
+    removed_key_hashes: List[str] = [key_hash for key_hash in snapshot if key_hash not in remote_key_hashes]
+    removed_note_ids: set[NoteId] = {snapshot[key_hash][1] for key_hash in removed_key_hashes}
+
+    diff: DeckDiff = DeckDiff()
+    changed_rows: DeckSnapshot = {}
+    found_note_ids: set[NoteId] = set()
+
+    removed_notes: List[LocalNote] = []
+    for local_note in load_notes(col, list(rows_to_update) + list(removed_note_ids)):
+        found_note_ids.add(local_note.note_id)
+        if local_note.note_id in removed_note_ids:
+            removed_notes.append(local_note)
+            continue
+
+        card_key, card_value = rows_to_update[local_note.note_id]
+        changed_rows[hash_text(card_key)] = (hash_text(card_value), local_note.note_id)
+        if not local_note.has_equivalent_value(card_value):
+            diff.notes_to_update.append(NoteUpdate(local_note.note_id, card_key, local_note.card_value, card_value))
+        elif not card_value == local_note.card_value:
+            diff.equivalent_note_count += 1
+
+    # the snapshot may refer to a note which was deleted since, its row is synced as a new card
+    for note_id, remote_row in rows_to_update.items():
+        if note_id not in found_note_ids:
+            rows_to_add.append(remote_row)
+
+    # a row whose card key changed only in the ignored ways keeps the note of its old key
+    removed_notes_by_key: Dict[str, LocalNote] = {}
+    for local_note in removed_notes:
+        removed_notes_by_key.setdefault(local_note.get_normalized_key(), local_note)
+
+    matched_note_ids: set[NoteId] = set()
+    for card_key, card_value in rows_to_add:
+        matched_note: LocalNote | None = None
+        if removed_notes_by_key:
+            matched_note = removed_notes_by_key.pop(_normalized_notes.normalize(card_key), None)
+        if matched_note is None:
+            diff.notes_to_add.append((card_key, card_value))
+            continue
+
+        matched_note_ids.add(matched_note.note_id)
+        changed_rows[hash_text(card_key)] = (hash_text(card_value), matched_note.note_id)
+        if not matched_note.has_equivalent_value(card_value):
+            diff.notes_to_update.append(NoteUpdate(matched_note.note_id, matched_note.card_key, matched_note.card_value, card_value))
+        else:
+            diff.equivalent_note_count += 1
+
+    diff.notes_to_remove = [local_note for local_note in removed_notes if local_note.note_id not in matched_note_ids]
+    logging.debug(
+        "Computed incremental diff against the snapshot of %s rows, changed rows: %s",
+        len(snapshot), len(rows_to_add) + len(rows_to_update) + len(removed_key_hashes))
+    return diff, changed_rows, removed_key_hashes
+
+
+def has_normalized_key_collisions(remote_deck: RemoteDeck) -> bool:
+    normalized_keys: set[str] = set()
+    for card_key in remote_deck:
+        normalized_key: str = _normalized_notes.normalize(card_key)
+        if normalized_key in normalized_keys:
+            return True
+        normalized_keys.add(normalized_key)
+    return False
+
+
+def build_deck_snapshot(index: DeckIndex, remote_deck: RemoteDeck, remote_keys: Dict[str, str]) -> Optional[DeckSnapshot]:
+    """Snapshot rows of the remote cards which already have notes, the added notes are included after the diff is applied"""
+
+    # the snapshot maps a card key to a single note, so a deck with duplicate keys is always compared in full
+    if index.duplicate_notes or len(remote_keys) < len(remote_deck):
+        return None
+
+    snapshot: DeckSnapshot = {}
+    for normalized_key, card_key in remote_keys.items():
+        note_id: NoteId | None = index.find_note_id(normalized_key)
+        if note_id is not None:
+            snapshot[hash_text(card_key)] = (hash_text(remote_deck[card_key]), note_id)
+    return snapshot
+
+
+def apply_deck_diff(
+        col: Collection,
+        deck_id: DeckId,
+        notetype: NotetypeDict,
+        diff: DeckDiff,
+        metrics: Optional[SyncMetrics] = None) -> None:
+    """Apply the computed changes to the Anki deck, one bulk collection call per kind of change"""
+
+    if metrics is None:
+        metrics = SyncMetrics()
+    log_card_changes: bool = card_changes_logger.isEnabledFor(logging.INFO)
+
+    if diff.notes_to_remove:
+        with metrics.measure("write_remove"):
+            if log_card_changes:
+                for local_note in diff.notes_to_remove:
+                    card_changes_logger.info(
+                        "The card is absent in remote deck, deleting it from the Anki deck, card key: %s", local_note.card_key)
+            col.remove_notes([local_note.note_id for local_note in diff.notes_to_remove])
+
+    if diff.notes_to_update:
+        with metrics.measure("write_update"):
+            notes: List[Note] = []
+            for note_update in diff.notes_to_update:
+                if log_card_changes:
+                    card_changes_logger.info(
+                        "Updating description for the card: %s, before: %s, after: %s",
+                        note_update.card_key, note_update.old_card_value, note_update.new_card_value)
+                try:
+                    note: Note = col.get_note(note_update.note_id)
+                except NotFoundError:
+                    logging.warning("Skipping update of the deleted note, card key: %s", note_update.card_key)
+                    continue
+                note[CARD_VALUE_FIELD] = note_update.new_card_value
+                notes.append(note)
+            col.update_notes(notes)
+
+    if diff.notes_to_add:
+        with metrics.measure("write_add"):
+            requests: List[AddNoteRequest] = []
+            for card_key, card_value in diff.notes_to_add:
+                if log_card_changes:
+                    card_changes_logger.info("Creating new card: %s", card_key)
+                note = col.new_note(notetype)
+                note[CARD_KEY_FIELD] = card_key
+                note[CARD_VALUE_FIELD] = card_value
+                requests.append(AddNoteRequest(note=note, deck_id=deck_id))
+            col.add_notes(requests)
+            diff.added_note_ids = [request.note.id for request in requests]
+            logging.info("Added %s new cards to the deck with ID: %s", len(requests), deck_id)
+
+    metrics.add("notes_removed", len(diff.notes_to_remove))
+    metrics.add("notes_updated", len(diff.notes_to_update))
+    metrics.add("notes_added", len(diff.notes_to_add))
+    metrics.add("notes_equivalent", diff.equivalent_note_count)
+
+
+def plan_deck_sync(col: Collection, deck_name: str, remote_deck: RemoteDeck, snapshot: Optional[DeckSnapshot] = None) -> DeckSyncPlan:
+    """Look up the Anki deck and compute its changes. Only reads the collection, so it may run off the main thread.
+       The snapshot of the previous sync must only be passed if the deck wasn't changed since that sync."""
+
+    deck_id: DeckId | None = col.decks.id_for_name(deck_name)
+    if deck_id is None:
+        raise DeckSyncException(f"Failed to find Anki deck: {deck_name}")
+
+    notetype: NotetypeDict | None = col.models.by_name("Basic")
+    if notetype is None:
+        raise DeckSyncException("Failed to find Anki note type: Basic")
+
+    incremental_diff: Optional[Tuple[DeckDiff, DeckSnapshot, List[str]]] = None
+    if snapshot is not None:
+        incremental_diff = compute_incremental_deck_diff(col, snapshot, remote_deck)
+    if incremental_diff is not None:
+        diff, changed_rows, removed_key_hashes = incremental_diff
+        plan: DeckSyncPlan = DeckSyncPlan(deck_name, deck_id, notetype, diff)
+        plan.incremental = True
+        plan.snapshot_rows = changed_rows
+        plan.removed_key_hashes = removed_key_hashes
+        return plan
+
+    index: DeckIndex = DeckIndex(load_deck_notes(col, deck_id))
+    remote_keys: Dict[str, str] = normalize_remote_keys(remote_deck)
+    plan = DeckSyncPlan(deck_name, deck_id, notetype, compute_deck_diff(index, remote_deck, remote_keys))
+    plan.snapshot_rows = build_deck_snapshot(index, remote_deck, remote_keys)
+    return plan
+
+
+def apply_deck_sync_plan(col: Collection, plan: DeckSyncPlan, metrics: Optional[SyncMetrics] = None) -> None:
+    apply_deck_diff(col, plan.deck_id, plan.notetype, plan.diff, metrics)
+    if plan.snapshot_rows is not None:
+        for (card_key, card_value), note_id in zip(plan.diff.notes_to_add, plan.diff.added_note_ids):
+            plan.snapshot_rows[hash_text(card_key)] = (hash_text(card_value), note_id)
+    logging.info(
+        "Finished syncing deck: %s, new cards: %s, updated cards: %s, deleted cards: %s",
+        plan.deck_name, len(plan.diff.notes_to_add), len(plan.diff.notes_to_update), len(plan.diff.notes_to_remove))
@@ -0,0 +1,435 @@
+"""
+Credentials and HTTP transport of the Google API requests: the token kept in memory for the session,
+client-side rate limiting, the pool of metered HTTP transports and retries of failed requests.
+
+Google API modules are imported lazily inside the functions: the .pyd files of the cryptography module
+are locked while loaded and would prevent the add-on from uninstalling.
+
+"""
+
+import json
+import logging
+import os.path
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+APPLICATION_SCOPES: List[str] = [
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive.metadata",
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+    "https://www.googleapis.com/auth/spreadsheets"
+]
+
+# retries of rate limited requests and server errors, with exponential backoff between attempts
+MAX_REQUEST_ATTEMPTS: int = 6
+RETRY_BASE_DELAY_SECONDS: float = 1.0
+RETRY_MAX_DELAY_SECONDS: float = 32.0
+RETRYABLE_HTTP_STATUSES: List[int] = [429, 500, 502, 503, 504]
+# HTTP transports kept open for the session, each keeps a keep-alive connection to every Google API host it used
+DEFAULT_HTTP_POOL_SIZE: int = 8
+MAX_HTTP_POOL_SIZE: int = 32
+DEFAULT_HTTP_TIMEOUT_SECONDS: int = 60
+# the access token is refreshed in background this long before it expires, so that no sync waits for the refresh
+TOKEN_REFRESH_MARGIN_SECONDS: int = 5 * 60
+
+
+class NoCredentialsException(Exception):
+    """Application failed to get credentials for Google API"""
+
+    def __init__(self, *args, msg='No credentials for Google API', **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+def get_credentials_key(credentials) -> Tuple[str, ...]:
+    """Returns the identity of the credentials which stays the same while the access token is refreshed"""
+
+    client_id: str = getattr(credentials, "client_id", None) or ""
+    refresh_token: str = getattr(credentials, "refresh_token", None) or ""
+    scopes: List[str] = sorted(getattr(credentials, "scopes", None) or [])
+    return (client_id, refresh_token, *scopes)
+
+
+def get_file_mtime(file: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(file)
+    except OSError:
+        return None
+
+
+class CredentialsCache:
+    """Credentials of the token file kept in memory for the session and shared by all threads.
+       The token file is read again only when it changed on disk, and written only when the token changed."""
+
+    def __init__(self):
+        self.token_file = ""
+        self.credentials = None
+        self.saved_token_json = ""
+        self.saved_token_mtime = None
+        # the warm-up, the background refresh and the sync may all need the token, only one of them refreshes it at a time
+        self.lock = threading.Lock()
+
+    token_file: str
+    credentials: Any
+    saved_token_json: str
+    saved_token_mtime: Optional[float]
+    lock: threading.Lock
+
+    def load(self, token_file: str):
+        """Returns credentials with a valid access token, refreshing it if it expired, or None if the user has to log in"""
+
+        with self.lock:
+            if self.credentials is None or not self.token_file == token_file or not get_file_mtime(token_file) == self.saved_token_mtime:
+                self.read(token_file)
+
+            if self.credentials is None:
+                return None
+            if self.credentials.valid:
+                return self.credentials
+            if not self.credentials.expired or not self.credentials.refresh_token:
+                return None
+
+            self.refresh()
+            return self.credentials
+
+    def put(self, token_file: str, credentials) -> None:
+        with self.lock:
+            self.token_file = token_file
+            self.credentials = credentials
+            self.save()
+
+    def refresh_if_expiring(self, token_file: str, margin_seconds: float) -> bool:
+        """Refreshes the access token of the cached credentials if it expires within the margin, returns whether it was refreshed"""
+
+        with self.lock:
+            if self.credentials is None or not self.token_file == token_file or not self.credentials.refresh_token:
+                return False
+            # google-auth keeps the expiry as naive UTC time
+            expiry: Optional[datetime] = self.credentials.expiry
+            if expiry is not None and (expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds() > margin_seconds:
+                return False
+
+            self.refresh()
+            return True
+
+    def clear(self) -> None:
+        with self.lock:
+            self.token_file = ""
+            self.credentials = None
+            self.saved_token_json = ""
+            self.saved_token_mtime = None
+
+    def read(self, token_file: str) -> None:
+        # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+        import google.oauth2.credentials
+
+        previous_credentials = self.credentials if self.token_file == token_file else None
+        self.token_file = token_file
+        self.credentials = None
+        if not os.path.exists(token_file):
+            return
+
+        self.saved_token_mtime = get_file_mtime(token_file)
+        with open(token_file, "r", encoding="utf8") as token:
+            token_info: Dict[str, Any] = json.load(token)
+        self.credentials = google.oauth2.credentials.Credentials.from_authorized_user_info(token_info, APPLICATION_SCOPES)
+        self.saved_token_json = self.credentials.to_json()
+
+        # the cached services use the credentials object, so the token refreshed by another process is taken into it
+        if previous_credentials is not None and get_credentials_key(previous_credentials) == get_credentials_key(self.credentials):
+            previous_credentials.token = self.credentials.token
+            previous_credentials.expiry = self.credentials.expiry
+            self.credentials = previous_credentials
+        logging.debug("Loaded Google token from %s", token_file)
+
+    def refresh(self) -> None:
+        # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+        from google.auth.transport.requests import Request
+
+        refresh_start: float = time.perf_counter()
+        self.credentials.refresh(Request())
+        logging.info("Refreshed Google access token in %.3f s, it expires at %s UTC",
+                     time.perf_counter() - refresh_start, self.credentials.expiry)
+        self.save()
+
+    def save(self) -> None:
+        token_json: str = self.credentials.to_json()
+        if token_json == self.saved_token_json and get_file_mtime(self.token_file) == self.saved_token_mtime:
+            return
+
+        # the token file is replaced at once, so a crash or a concurrent reader never sees it half written
+        temporary_file: str = self.token_file + ".tmp"
+        with open(temporary_file, "w", encoding="utf8") as token:
+            token.write(token_json)
+        os.replace(temporary_file, self.token_file)
+
+        self.saved_token_json = token_json
+        self.saved_token_mtime = get_file_mtime(self.token_file)
+
+
+_credentials_cache: CredentialsCache = CredentialsCache()
+
+
+def load_saved_credentials(token_file: str):
+    """Returns credentials from the saved token, refreshing the access token if it expired.
+       Returns None if there is no usable token and the user has to log in."""
+
+    return _credentials_cache.load(token_file)
+
+
+def refresh_credentials_ahead(token_file: str) -> bool:
+    """Called periodically in background, refreshes the access token of the credentials in use shortly before it expires"""
+
+    return _credentials_cache.refresh_if_expiring(token_file, TOKEN_REFRESH_MARGIN_SECONDS)
+
+
+def clear_credentials() -> None:
+    """Forget the credentials kept in memory, the token file is read again on the next sync"""
+
+    _credentials_cache.clear()
+
+
+def get_credentials(credentials_file: str, token_file: str):
+    """Returns user authorization credentials (token) for Google API. Performs user authentication in browser if needed"""
+
+    # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+    import google.auth
+    import google.oauth2.credentials
+    import google.auth.external_account_authorized_user
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    type Credentials = google.auth.external_account_authorized_user.Credentials | google.oauth2.credentials.Credentials
+    creds: Optional[Credentials] = None
+
+    # TODO rewrite with OS keyring API access, both for credentials.json and token.json
+
+    # The token file stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    logging.debug("Token path: %s", token_file)
+
+    creds = load_saved_credentials(token_file)
+
+    # If there are no (valid) credentials available, let the user log in.
+    if not creds:
+        flow = InstalledAppFlow.from_client_secrets_file(credentials_file, APPLICATION_SCOPES)
+        creds = flow.run_local_server(port=0)
+
+        if not creds:
+            raise NoCredentialsException()
+
+        # Save the credentials for the next run
+        _credentials_cache.put(token_file, creds)
+
+    return creds
+
+
+class RequestStats:
+    """Counters of the requests made with the services"""
+
+    def __init__(self):
+        self.request_count = 0
+        self.received_bytes = 0
+        self.compressed_response_count = 0
+        self.retry_count = 0
+        self.throttle_wait_seconds = 0.0
+        self.connection_count = 0
+
+    request_count: int
+    # bytes after decompression
+    received_bytes: int
+    compressed_response_count: int
+    retry_count: int
+    throttle_wait_seconds: float
+    # new connections opened, requests on kept-alive connections skip the TCP and TLS handshakes
+    connection_count: int
+
+    def since(self, start: "RequestStats") -> "RequestStats":
+        """Returns the counters accumulated after the start counters were taken"""
+
+        stats: RequestStats = RequestStats()
+        stats.request_count = self.request_count - start.request_count
+        stats.received_bytes = self.received_bytes - start.received_bytes
+        stats.compressed_response_count = self.compressed_response_count - start.compressed_response_count
+        stats.retry_count = self.retry_count - start.retry_count
+        stats.throttle_wait_seconds = self.throttle_wait_seconds - start.throttle_wait_seconds
+        stats.connection_count = self.connection_count - start.connection_count
+        return stats
+
+
+class TokenBucket:
+    """Client-side rate limiter shared by all threads: allows bursts of up to capacity requests and refills at rate requests per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    rate: float
+    capacity: float
+    tokens: float
+    updated_at: float
+    lock: threading.Lock
+
+    @staticmethod
+    def for_quota(requests_per_minute: int) -> "TokenBucket":
+        # any minute admits at most the burst plus the refill, which together stay within the quota
+        return TokenBucket(requests_per_minute / 120, requests_per_minute / 2)
+
+    def acquire(self) -> float:
+        """Takes one token, waiting until it's available. Returns the time waited in seconds."""
+
+        with self.lock:
+            now: float = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # the token is reserved right away, so concurrent callers wait in turn
+            self.tokens -= 1
+            wait_seconds: float = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+
+class MeteredHttp:
+    """HTTP transport wrapper counting the requests made through it and the bytes of response bodies"""
+
+    def __init__(self, http: Any, count_response: Callable[[int, bool, bool], None]):
+        self.http = http
+        self.count_response = count_response
+
+    http: Any
+    # called with the length of the response body, whether it was compressed and whether a new connection was opened
+    count_response: Callable[[int, bool, bool], None]
+
+    def request(self, *args, **kwargs) -> Tuple[Any, bytes]:
+        open_connections: Set[Any] = set(self.http.connections.values())
+        response, content = self.http.request(*args, **kwargs)
+        # httplib2 decompresses the body and keeps the original encoding under this name
+        compressed: bool = response.get("-content-encoding") in ("gzip", "deflate")
+        opened_connection: bool = any(connection not in open_connections for connection in self.http.connections.values())
+        self.count_response(len(content or b""), compressed, opened_connection)
+        return response, content
+
+    def close(self) -> None:
+        self.http.close()
+
+
+class HttpTransportOptions:
+    """Size of the HTTP transport pool and the timeout of requests"""
+
+    def __init__(self, pool_size: int = DEFAULT_HTTP_POOL_SIZE, timeout_seconds: float = DEFAULT_HTTP_TIMEOUT_SECONDS):
+        self.pool_size = pool_size
+        self.timeout_seconds = timeout_seconds
+
+    pool_size: int
+    # httplib2 uses one socket timeout for connecting and for every read
+    timeout_seconds: float
+
+    def get_key(self) -> Tuple[int, float]:
+        return (self.pool_size, self.timeout_seconds)
+
+
+class HttpPool:
+    """Authorized HTTP transports shared by Drive and Sheets requests of all threads and all syncs of the session.
+       httplib2 keeps one keep-alive connection per host in every transport, so a transport taken from the pool
+       usually has its connection open, and the request skips the TCP and TLS handshakes.
+       A transport serves one request at a time, as httplib2 isn't thread-safe."""
+
+    def __init__(self, create_http: Callable[[], Any], size: int):
+        self.create_http = create_http
+        self.size = max(1, size)
+        # the most recently used transport is taken first, its connection is the least likely to be closed by the server
+        self.idle = queue.LifoQueue()
+        self.created_count = 0
+        self.lock = threading.Lock()
+
+    create_http: Callable[[], Any]
+    size: int
+    idle: queue.LifoQueue
+    created_count: int
+    lock: threading.Lock
+
+    @contextmanager
+    def acquire(self) -> Iterator[Any]:
+        """Takes an idle transport, creates a new one while the pool isn't full, or waits for one to be returned"""
+
+        http: Any = None
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if self.created_count < self.size:
+                    self.created_count += 1
+                    try:
+                        http = self.create_http()
+                    except Exception:
+                        # e.g. the credentials failed to refresh, the failed transport doesn't take a place in the pool
+                        self.created_count -= 1
+                        raise
+        if http is None:
+            http = self.idle.get()
+
+        try:
+            yield http
+        finally:
+            self.idle.put(http)
+
+    def close(self) -> None:
+        """Closes connections of the idle transports, they stay in the pool and connect again on the next request.
+           Connections of the transports in use are closed by the garbage collector."""
+
+        idle_transports: List[Any] = []
+        while True:
+            try:
+                idle_transports.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+        for http in idle_transports:
+            http.close()
+            self.idle.put(http)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Rate limit errors, server errors and dropped connections are worth retrying"""
+
+    # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        if error.resp.status in RETRYABLE_HTTP_STATUSES:
+            return True
+        # Drive reports exceeded rate limits with 403
+        return error.resp.status == 403 \
+            and any(reason in (error.content or b"") for reason in (b"rateLimitExceeded", b"userRateLimitExceeded"))
+
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def get_retry_delay(error: Exception, attempt: int) -> float:
+    """Exponential backoff with full jitter, not shorter than the Retry-After delay requested by the server"""
+
+    delay: float = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+    response = getattr(error, "resp", None)
+    retry_after: str | None = response.get("retry-after") if response is not None else None
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, min(RETRY_MAX_DELAY_SECONDS, float(retry_after)))
+
+    return delay
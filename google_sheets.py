@@ -0,0 +1,763 @@
+"""
+Google Sheets and Google Drive access for the add-on.
+Credentials and HTTP transports of the requests are in google_connection.py.
+
+Google API modules are imported lazily inside the functions: the .pyd files of the cryptography module
+are locked while loaded and would prevent the add-on from uninstalling.
+
+"""
+
+import csv
+import io
+import json
+import logging
+import os.path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import TYPE_CHECKING
+from .deck_sync import RemoteDeck
+from .google_connection import (
+    MAX_REQUEST_ATTEMPTS, HttpPool, HttpTransportOptions, MeteredHttp, RequestStats, TokenBucket,
+    get_credentials_key, get_retry_delay, is_retryable_error, load_saved_credentials)
+
+if TYPE_CHECKING:
+    from googleapiclient._apis.drive.v3.schemas import FileList
+    from googleapiclient._apis.drive.v3.resources import DriveResource
+    from googleapiclient._apis.drive.v3.schemas import File
+    from googleapiclient._apis.drive.v3.resources import FileListHttpRequest
+    from googleapiclient._apis.sheets.v4.resources import SheetsResource
+    from googleapiclient._apis.sheets.v4.resources import BatchUpdateSpreadsheetRequest
+    from googleapiclient._apis.sheets.v4.resources import SheetProperties
+    from googleapiclient._apis.sheets.v4.resources import AddSheetRequest
+    from googleapiclient._apis.sheets.v4.resources import AddSheetResponse
+else:
+    DriveResource = Any
+    SheetsResource = Any
+
+SPREADSHEET_ID_CACHE_TTL_SECONDS: float = 7 * 24 * 60 * 60
+# rows of a sheet requested at once, large sheets are read in several windows to keep responses small
+SHEET_ROWS_CHUNK_SIZE: int = 5000
+# documented per-user quotas:
+# https://developers.google.com/workspace/sheets/api/limits
+# https://developers.google.com/workspace/drive/api/guides/limits
+SHEETS_REQUESTS_PER_MINUTE: int = 60
+DRIVE_REQUESTS_PER_MINUTE: int = 12000
+# cells as shown in the sheet, or raw numbers and booleans which are shorter for numeric data
+VALUE_RENDER_OPTIONS: List[str] = ["FORMATTED_VALUE", "UNFORMATTED_VALUE"]
+# how the sheets of a spreadsheet are downloaded, set per spreadsheet with "fetch_mode" in import_config.json:
+# JSON from the Sheets values API, or CSV from the export endpoint of the spreadsheet, which is smaller and faster to parse
+FETCH_MODES: List[str] = ["values", "csv_export"]
+CSV_EXPORT_URL: str = "https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid={sheet_id}"
+
+
+def import_google_modules() -> None:
+    """Import the Google client modules ahead of the first sync, importing them is slow on the first use"""
+
+    # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+    import google.auth
+    import google.oauth2.credentials
+    import google.auth.transport.requests
+    import google_auth_oauthlib.flow
+    import google_auth_httplib2
+    import googleapiclient.discovery
+    import googleapiclient.errors
+    import httplib2
+
+
+class GoogleServices:
+    """Sheets and Drive service objects built for the specific credentials.
+       Service objects are shared by all threads, and requests are executed with HTTP transports taken from the pool.
+       Requests of all threads are rate limited together."""
+
+    def __init__(
+            self,
+            credentials,
+            credentials_key: Tuple[str, ...],
+            sheets: SheetsResource,
+            drive: DriveResource,
+            transport_options: HttpTransportOptions):
+        self.credentials = credentials
+        self.credentials_key = credentials_key
+        self.sheets = sheets
+        self.drive = drive
+        self.transport_options = transport_options
+        self.http_pool = HttpPool(self.create_http, transport_options.pool_size)
+        self.sheets_rate_limiter = TokenBucket.for_quota(SHEETS_REQUESTS_PER_MINUTE)
+        self.drive_rate_limiter = TokenBucket.for_quota(DRIVE_REQUESTS_PER_MINUTE)
+        self.stats = RequestStats()
+        self.stats_lock = threading.Lock()
+
+    credentials: Any
+    credentials_key: Tuple[str, ...]
+    sheets: SheetsResource
+    drive: DriveResource
+    transport_options: HttpTransportOptions
+    http_pool: HttpPool
+    sheets_rate_limiter: TokenBucket
+    drive_rate_limiter: TokenBucket
+    # totals since the services were built, a sync takes the difference between its start and end
+    stats: RequestStats
+    stats_lock: threading.Lock
+
+    def create_http(self) -> MeteredHttp:
+        # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+        import httplib2
+        import google_auth_httplib2
+
+        http = httplib2.Http(timeout=self.transport_options.timeout_seconds)
+        return MeteredHttp(google_auth_httplib2.AuthorizedHttp(self.credentials, http=http), self.count_response)
+
+    def get_rate_limiter(self, request: Any) -> TokenBucket:
+        if "sheets.googleapis.com" in request.uri:
+            return self.sheets_rate_limiter
+        return self.drive_rate_limiter
+
+    def execute(self, request: Any) -> Any:
+        """Execute the request within the rate limit, retrying it on rate limit and server errors"""
+
+        rate_limiter: TokenBucket = self.get_rate_limiter(request)
+
+        attempt: int = 0
+        while True:
+            throttle_wait_seconds: float = rate_limiter.acquire()
+            if throttle_wait_seconds > 0:
+                with self.stats_lock:
+                    self.stats.throttle_wait_seconds += throttle_wait_seconds
+
+            try:
+                # googleapiclient already asks for gzip responses, with the "(gzip)" user agent Google APIs require for it
+                with self.http_pool.acquire() as http:
+                    return request.execute(http=http)
+            except Exception as error:
+                attempt += 1
+                if attempt >= MAX_REQUEST_ATTEMPTS or not is_retryable_error(error):
+                    raise
+
+                delay: float = get_retry_delay(error, attempt - 1)
+                logging.warning("Request %s %s failed: %s - %s. Retry %s of %s in %.1f s",
+                                request.method, request.uri.split("?")[0], type(error).__name__, error,
+                                attempt, MAX_REQUEST_ATTEMPTS - 1, delay)
+                with self.stats_lock:
+                    self.stats.retry_count += 1
+                time.sleep(delay)
+
+    def export_sheet_csv(self, spreadsheet_id: str, sheet_id: int) -> bytes:
+        """Download the sheet as CSV from the export endpoint, with the same transports, rate limit and retries as API requests"""
+
+        # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+        from googleapiclient.http import HttpRequest
+
+        def check_content(response: Any, content: bytes) -> bytes:
+            # without access to the export the endpoint answers with an HTML page instead of an error status
+            content_type: str = response.get("content-type", "")
+            if not content_type.startswith("text/csv"):
+                raise CsvExportUnavailableException(f"Export returned {content_type or 'no content type'} instead of CSV")
+            return content
+
+        uri: str = CSV_EXPORT_URL.format(spreadsheet_id=spreadsheet_id, sheet_id=sheet_id)
+        return self.execute(HttpRequest(None, check_content, uri, method="GET", headers={"accept": "text/csv"}))
+
+    def count_response(self, content_length: int, compressed: bool, opened_connection: bool) -> None:
+        with self.stats_lock:
+            self.stats.request_count += 1
+            self.stats.received_bytes += content_length
+            self.stats.compressed_response_count += int(compressed)
+            self.stats.connection_count += int(opened_connection)
+
+    def get_request_stats(self) -> RequestStats:
+        """Returns a copy of the request counters"""
+
+        with self.stats_lock:
+            return self.stats.since(RequestStats())
+
+    def close(self) -> None:
+        """Closes the service objects and the idle transports of the pool"""
+
+        self.sheets.close()
+        self.drive.close()
+        self.http_pool.close()
+
+
+# service objects are cached for the whole Anki session and shared by all deck syncs
+_services: Optional[GoogleServices] = None
+_services_lock = threading.Lock()
+
+
+def build_service(service_name: str, version: str, credentials) -> Any:
+    """Build the service object from the discovery document bundled with googleapiclient, without fetching it over the network"""
+
+    # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+    from googleapiclient import discovery
+    from googleapiclient.discovery_cache import get_static_doc
+
+    document: str | None = get_static_doc(service_name, version)
+    if document is None:
+        logging.warning("No bundled discovery document for %s %s, fetching it", service_name, version)
+        return discovery.build(service_name, version, credentials=credentials, static_discovery=False)
+
+    return discovery.build_from_document(document, credentials=credentials)
+
+
+def get_google_services(credentials, transport_options: Optional[HttpTransportOptions] = None) -> GoogleServices:
+    """Returns cached Sheets and Drive service objects,
+       building them only on the first call or when credentials or transport options change.
+       Without transport options the cached services are returned with any options."""
+
+    global _services
+
+    credentials_key: Tuple[str, ...] = get_credentials_key(credentials)
+
+    with _services_lock:
+        if _services is not None and _services.credentials_key == credentials_key \
+                and (transport_options is None or transport_options.get_key() == _services.transport_options.get_key()):
+            return _services
+
+        if _services is not None:
+            _services.close()
+
+        build_start: float = time.perf_counter()
+        sheets_service: SheetsResource = build_service("sheets", "v4", credentials)
+        drive_service: DriveResource = build_service("drive", "v3", credentials)
+        logging.info("Built Google API service objects in %.3f s", time.perf_counter() - build_start)
+
+        _services = GoogleServices(credentials, credentials_key, sheets_service, drive_service, transport_options or HttpTransportOptions())
+        return _services
+
+
+def warm_up_google_services(token_file: str, transport_options: Optional[HttpTransportOptions] = None) -> bool:
+    """Import the Google client modules, load the saved token and build the service objects, so the first sync starts fast.
+       Never asks the user to log in, returns False if there is no usable token."""
+
+    warm_up_start: float = time.perf_counter()
+    import_google_modules()
+
+    credentials = load_saved_credentials(token_file)
+    if credentials is None:
+        logging.info("Imported Google client modules in %.3f s, no saved token to prepare services", time.perf_counter() - warm_up_start)
+        return False
+
+    get_google_services(credentials, transport_options)
+    logging.info("Prepared Google services in %.3f s", time.perf_counter() - warm_up_start)
+    return True
+
+
+def clear_google_services() -> None:
+    """Drop cached service objects so that they are rebuilt on the next sync"""
+
+    global _services
+
+    with _services_lock:
+        if _services is not None:
+            _services.close()
+        _services = None
+
+
+class SyncCancelledException(Exception):
+    """User cancelled the sync before the operation started"""
+
+    def __init__(self):
+        super().__init__("Sync cancelled")
+
+
+class SpreadsheetNotFoundException(Exception):
+    """No spreadsheet in Google Drive matches the configured spreadsheet name"""
+
+    def __init__(self, spreadsheet_name: str):
+        super().__init__(f"No spreadsheet found with name: {spreadsheet_name}")
+
+
+class AmbiguousSpreadsheetException(Exception):
+    """Several spreadsheets in Google Drive match the configured spreadsheet name"""
+
+    def __init__(self, spreadsheet_name: str, matching_names: List[str]):
+        super().__init__(f"Several spreadsheets match the name '{spreadsheet_name}': {', '.join(matching_names)}")
+
+
+class SheetNotFoundException(Exception):
+    """The spreadsheet has no sheet with the configured sheet name"""
+
+    def __init__(self, spreadsheet_name: str, sheet_name: str):
+        super().__init__(f"No sheet '{sheet_name}' found in spreadsheet: {spreadsheet_name}")
+
+
+class CsvExportUnavailableException(Exception):
+    """The export endpoint didn't return the sheet as CSV"""
+
+
+class SpreadsheetIdCache:
+    """Spreadsheet name to spreadsheet ID mapping persisted in a JSON file, entries expire after the TTL"""
+
+    def __init__(self, cache_file: str, ttl_seconds: float = SPREADSHEET_ID_CACHE_TTL_SECONDS):
+        self.cache_file = cache_file
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r", encoding="utf8") as data:
+                    self.entries = json.load(data)
+            except (OSError, ValueError) as error:
+                logging.warning("Ignoring unreadable spreadsheet ID cache %s: %s", cache_file, error)
+
+    cache_file: str
+    ttl_seconds: float
+    entries: Dict[str, Dict[str, Any]]
+    lock: threading.Lock
+
+    def get(self, spreadsheet_name: str) -> Optional[str]:
+        entry: Dict[str, Any] | None = self.entries.get(spreadsheet_name)
+        if entry is None:
+            return None
+        if time.time() - entry.get("resolved_at", 0) > self.ttl_seconds:
+            logging.debug("Cached ID of spreadsheet '%s' expired", spreadsheet_name)
+            return None
+        return entry.get("id")
+
+    def put(self, spreadsheet_name: str, spreadsheet_id: str) -> None:
+        with self.lock:
+            self.entries[spreadsheet_name] = {"id": spreadsheet_id, "resolved_at": time.time()}
+
+    def invalidate(self, spreadsheet_name: str) -> None:
+        with self.lock:
+            self.entries.pop(spreadsheet_name, None)
+
+    def save(self) -> None:
+        temporary_file: str = self.cache_file + ".tmp"
+        with self.lock:
+            with open(temporary_file, "w", encoding="utf8") as json_file:
+                json.dump(self.entries, json_file, indent=4)
+            os.replace(temporary_file, self.cache_file)
+
+
+def quote_drive_query_value(value: str) -> str:
+    """Escape the value for use inside the single-quoted string of a Drive search query"""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def list_spreadsheets(services: GoogleServices, name_substrings: List[str]) -> List[Tuple[str, str]]:
+    """List in the specified Google Drive account all Google Spreadsheets whose name contains any of the specified substrings.
+       Returns pairs of spreadsheet ID and spreadsheet name."""
+
+    # https://developers.google.com/workspace/drive/api/guides/mime-types
+    GOOGLE_SPREADSHEET_MIME_TYPE: str = "application/vnd.google-apps.spreadsheet"
+    # the largest page size allowed by Drive API
+    PAGE_SIZE: int = 1000
+
+    name_conditions: str = " or ".join(f"name contains '{quote_drive_query_value(name)}'" for name in name_substrings)
+    query: str = f"mimeType='{GOOGLE_SPREADSHEET_MIME_TYPE}' and 'me' in owners and trashed=false and ({name_conditions})"
+
+    spreadsheets: List[Tuple[str, str]] = []
+    next_page_token: str = ""
+
+    logging.debug("Starting search for spreadsheets with names: %s", name_substrings)
+    while True:
+        files: DriveResource.FilesResource = services.drive.files()
+        request: FileListHttpRequest = files.list(
+            pageToken=next_page_token,
+            pageSize=PAGE_SIZE, fields="nextPageToken, files(id, name)",
+            q=query)
+
+        results: FileList = services.execute(request)
+        next_page_token = results.get("nextPageToken")  # type: ignore
+        items = results.get("files", [])
+
+        logging.debug("Next chunk of files:")
+        for item in items:
+            spreadsheet_name: str = item['name']  # type: ignore
+            spreadsheet_id: str = item['id']  # type: ignore
+            logging.debug("Spreadsheet name: %s, spreadsheet ID: %s", spreadsheet_name, spreadsheet_id)
+            spreadsheets.append((spreadsheet_id, spreadsheet_name))
+
+        if not next_page_token:
+            break
+
+    return spreadsheets
+
+
+def match_spreadsheet(spreadsheet_name: str, spreadsheets: List[Tuple[str, str]]) -> str:
+    """Pick the spreadsheet for the configured name: the exact name match wins over the spreadsheets only containing the name"""
+
+    exact_matches: List[Tuple[str, str]] = [spreadsheet for spreadsheet in spreadsheets if spreadsheet[1] == spreadsheet_name]
+    if len(exact_matches) == 1:
+        return exact_matches[0][0]
+
+    candidates: List[Tuple[str, str]] = exact_matches
+    if not candidates:
+        candidates = [spreadsheet for spreadsheet in spreadsheets if spreadsheet_name.lower() in spreadsheet[1].lower()]
+
+    if not candidates:
+        raise SpreadsheetNotFoundException(spreadsheet_name)
+    if len(candidates) > 1:
+        raise AmbiguousSpreadsheetException(spreadsheet_name, [f"{name} ({spreadsheet_id})" for spreadsheet_id, name in candidates])
+
+    return candidates[0][0]
+
+
+def resolve_spreadsheet_ids(services: GoogleServices, spreadsheet_names: List[str], id_cache: SpreadsheetIdCache) -> None:
+    """Resolve IDs of all spreadsheets missing in the cache with one Drive listing and store them in the cache.
+       Names which are not found or ambiguous are reported in the log and left unresolved."""
+
+    unresolved_names: List[str] = sorted({name for name in spreadsheet_names if id_cache.get(name) is None})
+    if not unresolved_names:
+        return
+
+    spreadsheets: List[Tuple[str, str]] = list_spreadsheets(services, unresolved_names)
+    for spreadsheet_name in unresolved_names:
+        try:
+            id_cache.put(spreadsheet_name, match_spreadsheet(spreadsheet_name, spreadsheets))
+        except (SpreadsheetNotFoundException, AmbiguousSpreadsheetException) as error:
+            logging.warning("Failed to resolve spreadsheet ID: %s", error)
+
+    id_cache.save()
+
+
+def get_spreadsheet_id(services: GoogleServices, spreadsheet_name: str, id_cache: SpreadsheetIdCache) -> str:
+    """Returns the cached spreadsheet ID, looking it up in Google Drive if it's not cached or expired"""
+
+    spreadsheet_id: str | None = id_cache.get(spreadsheet_name)
+    if spreadsheet_id is not None:
+        return spreadsheet_id
+
+    spreadsheet_id = match_spreadsheet(spreadsheet_name, list_spreadsheets(services, [spreadsheet_name]))
+    id_cache.put(spreadsheet_name, spreadsheet_id)
+    id_cache.save()
+    return spreadsheet_id
+
+
+def get_drive_changes_start_token(services: GoogleServices) -> str:
+    """Returns the page token of the current position in the Drive changes feed"""
+
+    changes = services.drive.changes()
+    result = services.execute(changes.getStartPageToken(fields="startPageToken"))
+    return result["startPageToken"]
+
+
+def list_changed_file_ids(services: GoogleServices, page_token: str) -> Tuple[Set[str], str]:
+    """Returns IDs of the Drive files changed since the page token was taken, and the page token for the next poll"""
+
+    # the largest page size allowed by Drive API
+    PAGE_SIZE: int = 1000
+
+    changed_file_ids: Set[str] = set()
+    while True:
+        changes = services.drive.changes()
+        result = services.execute(changes.list(
+            pageToken=page_token, pageSize=PAGE_SIZE, spaces="drive", fields="nextPageToken, newStartPageToken, changes(fileId)"))
+        changed_file_ids.update(change["fileId"] for change in result.get("changes", []) if "fileId" in change)
+
+        # the last page carries the token for the changes made after this poll
+        if "newStartPageToken" in result:
+            return changed_file_ids, result["newStartPageToken"]
+        page_token = result["nextPageToken"]
+
+
+def is_not_found_error(error: Exception) -> bool:
+    # do lazy importing to mitigate the issue with .pyd files from cryptography module preventing the add-on from uninstalling
+    from googleapiclient.errors import HttpError
+
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+
+def get_sheet_range(sheet_name: str, columns: str = "A:B") -> str:
+    """Returns A1 notation of the columns range in the sheet, quoting the sheet name"""
+    quoted_sheet_name: str = sheet_name.replace("'", "''")
+    return f"'{quoted_sheet_name}'!{columns}"
+
+
+def get_sheet_window_range(sheet_name: str, first_row: int, row_count: int) -> str:
+    """Returns A1 notation of the window of rows in the card key and card value columns, e.g. 'Sheet'!A5001:B10000"""
+    return get_sheet_range(sheet_name, f"A{first_row}:B{first_row + row_count - 1}")
+
+
+def get_sheet_properties(services: GoogleServices, spreadsheet_id: str) -> Dict[str, Tuple[int, int]]:
+    """Returns the ID and the number of rows in the grid of every sheet, without the cells of the sheets"""
+
+    sheet: SheetsResource.SpreadsheetsResource = services.sheets.spreadsheets()
+    result = services.execute(sheet.get(spreadsheetId=spreadsheet_id, fields="sheets(properties(sheetId,title,gridProperties(rowCount)))"))
+    return {
+        sheet_properties["properties"]["title"]: (
+            sheet_properties["properties"].get("sheetId", 0),
+            sheet_properties["properties"].get("gridProperties", {}).get("rowCount", 0))
+        for sheet_properties in result.get("sheets", [])}
+
+
+class SheetReadOptions:
+    """How the cells of the sheets are requested"""
+
+    def __init__(
+            self,
+            value_render_option: str = "FORMATTED_VALUE",
+            chunk_row_count: int = SHEET_ROWS_CHUNK_SIZE,
+            csv_export_spreadsheet_names: Optional[Set[str]] = None):
+        self.value_render_option = value_render_option
+        self.chunk_row_count = chunk_row_count
+        self.csv_export_spreadsheet_names = csv_export_spreadsheet_names or set()
+
+    value_render_option: str
+    chunk_row_count: int
+    # spreadsheets downloaded as CSV, which always has formatted values
+    csv_export_spreadsheet_names: Set[str]
+
+    def get_read_mode(self, spreadsheet_name: str) -> str:
+        """How the cells of the spreadsheet are read, it is recorded with the sync state as the cell text depends on it"""
+
+        if spreadsheet_name in self.csv_export_spreadsheet_names:
+            # CSV export has formatted values regardless of the render option
+            return "csv_export"
+        return self.value_render_option
+
+
+def iter_sheet_rows(
+        services: GoogleServices,
+        spreadsheet_id: str,
+        sheet_row_counts: Dict[str, int],
+        read_options: SheetReadOptions) -> Iterator[Tuple[str, List[Any]]]:
+    """Yields (sheet name, row) for all rows of the specified sheets. Rows are read in windows of chunk_row_count rows,
+       the current window of every sheet is fetched with one batchGet request, so only one window per sheet is held in memory."""
+
+    chunk_row_count: int = read_options.chunk_row_count
+    first_row: int = 1
+    pending_sheet_names: List[str] = [sheet_name for sheet_name, row_count in sheet_row_counts.items() if row_count > 0]
+
+    while pending_sheet_names:
+        ranges: List[str] = [get_sheet_window_range(sheet_name, first_row, chunk_row_count) for sheet_name in pending_sheet_names]
+        sheet: SheetsResource.SpreadsheetsResource = services.sheets.spreadsheets()
+        result = services.execute(sheet.values().batchGet(
+            spreadsheetId=spreadsheet_id, ranges=ranges,
+            majorDimension="ROWS", valueRenderOption=read_options.value_render_option, dateTimeRenderOption="FORMATTED_STRING",
+            # ranges are matched to sheets by their order, their A1 notation isn't needed
+            fields="valueRanges(values)"))
+
+        # value ranges are returned in the order of the requested ranges, trailing empty rows of a window are omitted
+        for sheet_name, value_range in zip(pending_sheet_names, result.get("valueRanges", [])):
+            for row in value_range.get("values", []):
+                yield sheet_name, row
+
+        first_row += chunk_row_count
+        pending_sheet_names = [sheet_name for sheet_name in pending_sheet_names if sheet_row_counts[sheet_name] >= first_row]
+
+
+def iter_csv_rows(content: bytes) -> Iterator[List[str]]:
+    """Yields rows of the CSV export as they are decoded, without the trailing empty cells the values API omits as well"""
+
+    for row in csv.reader(io.TextIOWrapper(io.BytesIO(content), encoding="utf8", newline="")):
+        while row and not row[-1]:
+            row.pop()
+        yield row
+
+
+def get_cell_text(cell: Any) -> str:
+    """Returns the text of the cell value, unformatted values are numbers and booleans as well as strings"""
+
+    if isinstance(cell, str):
+        return cell
+    if isinstance(cell, bool):
+        return "TRUE" if cell else "FALSE"
+    if isinstance(cell, float) and cell.is_integer():
+        return str(int(cell))
+    return str(cell)
+
+
+def add_remote_card(deck: RemoteDeck, row: List[Any]) -> None:
+    """Gather card from the row of the sheet: the first column is the card key, the second one is the card value"""
+
+    if len(row) < 2:
+        logging.debug("Skipping not full line.")
+        return
+
+    CARD_KEY_COLUMN_INDEX = 0
+    CARD_VALUE_COLUMN_INDEX = 1
+
+    card_key: str = get_cell_text(row[CARD_KEY_COLUMN_INDEX])
+    card_value: str = get_cell_text(row[CARD_VALUE_COLUMN_INDEX])
+    deck[card_key] = card_value
+
+
+def parse_remote_deck(values: Iterable[List[str]]) -> RemoteDeck:
+    """Gather cards from the rows of the sheet"""
+
+    deck: RemoteDeck = {}
+    for row in values:
+        add_remote_card(deck, row)
+    return deck
+
+
+class SpreadsheetData:
+    """Sheets fetched from the spreadsheet, together with the Drive revision of the spreadsheet at the time of fetching"""
+
+    def __init__(self, spreadsheet_name: str, spreadsheet_id: str, version: str, modified_time: str, read_mode: str):
+        self.spreadsheet_name = spreadsheet_name
+        self.spreadsheet_id = spreadsheet_id
+        self.version = version
+        self.modified_time = modified_time
+        self.read_mode = read_mode
+        self.decks = {}
+        self.row_count = 0
+        self.exported_sheet_count = 0
+
+    spreadsheet_name: str
+    spreadsheet_id: str
+    version: str
+    modified_time: str
+    # read options of the spreadsheet, see SheetReadOptions.get_read_mode
+    read_mode: str
+    decks: Dict[str, RemoteDeck]
+    # rows received for all fetched sheets, including the incomplete ones
+    row_count: int
+    # sheets downloaded as CSV instead of with the values API
+    exported_sheet_count: int
+
+
+# picks the sheets which need to be fetched, knowing the current revision of the spreadsheet
+type SheetSelector = Callable[[SpreadsheetData, List[str]], List[str]]
+
+
+def get_spreadsheet_revision(services: GoogleServices, spreadsheet_id: str) -> Tuple[str, str]:
+    """Returns the Drive version and modification time of the spreadsheet, without reading its sheets"""
+
+    files: DriveResource.FilesResource = services.drive.files()
+    metadata: File = services.execute(files.get(fileId=spreadsheet_id, fields="version, modifiedTime"))
+    return metadata.get("version", ""), metadata.get("modifiedTime", "")
+
+
+def fetch_spreadsheet_by_id(
+        services: GoogleServices,
+        spreadsheet_name: str,
+        spreadsheet_id: str,
+        sheet_names: List[str],
+        select_sheets: Optional[SheetSelector],
+        read_options: SheetReadOptions) -> SpreadsheetData:
+    version, modified_time = get_spreadsheet_revision(services, spreadsheet_id)
+    spreadsheet: SpreadsheetData = SpreadsheetData(
+        spreadsheet_name, spreadsheet_id, version, modified_time, read_options.get_read_mode(spreadsheet_name))
+
+    if select_sheets is not None:
+        sheet_names = select_sheets(spreadsheet, sheet_names)
+    if not sheet_names:
+        logging.info("Spreadsheet '%s' is unchanged since the last sync, version: %s", spreadsheet_name, spreadsheet.version)
+        return spreadsheet
+
+    all_sheet_properties: Dict[str, Tuple[int, int]] = get_sheet_properties(services, spreadsheet_id)
+    sheet_ids: Dict[str, int] = {}
+    sheet_row_counts: Dict[str, int] = {}
+    for sheet_name in sheet_names:
+        if sheet_name not in all_sheet_properties:
+            raise SheetNotFoundException(spreadsheet_name, sheet_name)
+        sheet_ids[sheet_name], sheet_row_counts[sheet_name] = all_sheet_properties[sheet_name]
+        spreadsheet.decks[sheet_name] = {}
+
+    if spreadsheet_name in read_options.csv_export_spreadsheet_names:
+        try:
+            export_sheets(services, spreadsheet, sheet_ids)
+            return spreadsheet
+        except Exception as error:
+            if is_retryable_error(error):
+                raise
+            # e.g. the export is disabled for the spreadsheet, the values API is tried before reporting an error
+            logging.warning("Failed to export sheets of spreadsheet '%s' as CSV, reading them with the values API: %s - %s",
+                            spreadsheet_name, type(error).__name__, error)
+            spreadsheet.decks = {sheet_name: {} for sheet_name in sheet_names}
+            spreadsheet.row_count = 0
+            spreadsheet.exported_sheet_count = 0
+
+    # rows are parsed into decks as the windows arrive, not after the whole sheet is read
+    for sheet_name, row in iter_sheet_rows(services, spreadsheet_id, sheet_row_counts, read_options):
+        add_remote_card(spreadsheet.decks[sheet_name], row)
+        spreadsheet.row_count += 1
+
+    logging.debug("Fetched %s sheets of spreadsheet '%s', rows: %s", len(spreadsheet.decks), spreadsheet_name, spreadsheet.row_count)
+    return spreadsheet
+
+
+def export_sheets(services: GoogleServices, spreadsheet: SpreadsheetData, sheet_ids: Dict[str, int]) -> None:
+    """Download every sheet as CSV with one request and parse it into the deck of the sheet"""
+
+    for sheet_name, sheet_id in sheet_ids.items():
+        content: bytes = services.export_sheet_csv(spreadsheet.spreadsheet_id, sheet_id)
+        for row in iter_csv_rows(content):
+            add_remote_card(spreadsheet.decks[sheet_name], row)
+            spreadsheet.row_count += 1
+        spreadsheet.exported_sheet_count += 1
+
+    logging.debug("Exported %s sheets of spreadsheet '%s' as CSV, rows: %s",
+                  len(sheet_ids), spreadsheet.spreadsheet_name, spreadsheet.row_count)
+
+
+def fetch_spreadsheet(
+        services: GoogleServices,
+        spreadsheet_name: str,
+        sheet_names: List[str],
+        id_cache: SpreadsheetIdCache,
+        select_sheets: Optional[SheetSelector] = None,
+        read_options: Optional[SheetReadOptions] = None) -> SpreadsheetData:
+    """Go to Google Sheets spreadsheet and gather cards from the specified sheets, reading all of them together window by window.
+       The Drive revision of the spreadsheet is requested first, so select_sheets may skip sheets unchanged since the last sync."""
+
+    if read_options is None:
+        read_options = SheetReadOptions()
+
+    spreadsheet_id: str = get_spreadsheet_id(services, spreadsheet_name, id_cache)
+    try:
+        return fetch_spreadsheet_by_id(services, spreadsheet_name, spreadsheet_id, sheet_names, select_sheets, read_options)
+    except Exception as error:
+        if not is_not_found_error(error):
+            raise
+
+        # the cached ID is stale, e.g. the spreadsheet was re-created with the same name
+        logging.info("Spreadsheet '%s' not found by ID %s, resolving its ID again", spreadsheet_name, spreadsheet_id)
+        id_cache.invalidate(spreadsheet_name)
+        spreadsheet_id = get_spreadsheet_id(services, spreadsheet_name, id_cache)
+        return fetch_spreadsheet_by_id(services, spreadsheet_name, spreadsheet_id, sheet_names, select_sheets, read_options)
+
+
+def fetch_spreadsheets_concurrently(
+        services: GoogleServices,
+        spreadsheets: List[Tuple[str, List[str]]],
+        id_cache: SpreadsheetIdCache,
+        worker_count: int,
+        select_sheets: Optional[SheetSelector],
+        on_spreadsheet_fetched: Callable[[int], None],
+        should_cancel: Callable[[], bool],
+        read_options: Optional[SheetReadOptions] = None) -> List[SpreadsheetData | Exception]:
+    """Fetch sheets of all specified spreadsheets in parallel, with at most worker_count requests at a time.
+       Returns the fetched data for every spreadsheet, or the error which occurred while fetching the spreadsheet."""
+
+    fetched_count: int = 0
+    fetched_count_lock = threading.Lock()
+
+    def fetch(spreadsheet_name: str, sheet_names: List[str]) -> SpreadsheetData:
+        nonlocal fetched_count
+
+        try:
+            if should_cancel():
+                raise SyncCancelledException()
+            return fetch_spreadsheet(services, spreadsheet_name, sheet_names, id_cache, select_sheets, read_options)
+        finally:
+            with fetched_count_lock:
+                fetched_count += 1
+                on_spreadsheet_fetched(fetched_count)
+
+    results: List[SpreadsheetData | Exception] = []
+    with ThreadPoolExecutor(max_workers=max(1, worker_count), thread_name_prefix="goosheesy-fetch") as executor:
+        futures = [executor.submit(fetch, spreadsheet_name, sheet_names) for spreadsheet_name, sheet_names in spreadsheets]
+        for (spreadsheet_name, _), future in zip(spreadsheets, futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                # errors are kept per spreadsheet, so one failed spreadsheet doesn't abort fetching the others
+                if not isinstance(error, SyncCancelledException):
+                    logging.error("Failed to fetch sheets of spreadsheet '%s': %s - %s", spreadsheet_name, type(error).__name__, error)
+                results.append(error)
+
+    return results
@@ -0,0 +1,34 @@
+"""
+Helpers shared by the windows of the add-on.
+
+"""
+
+import os.path
+
+from PyQt6.QtGui import QIcon
+from PyQt6.QtWidgets import QMessageBox
+
+from .addon_files import get_addon_dir
+
+
+def get_icon() -> QIcon:
+    icon_path = os.path.join(get_addon_dir(), "icon.png")
+    return QIcon(icon_path)
+
+
+def show_message_box(icon: QMessageBox.Icon, title: str, message: str) -> None:
+    message_box = QMessageBox()
+    message_box.setIcon(icon)
+    message_box.setText(message)
+    message_box.setWindowTitle(title)
+    message_box.setWindowIcon(get_icon())
+    message_box.setStandardButtons(QMessageBox.StandardButton.Ok)
+    message_box.exec()
+
+
+def show_info(title: str, message: str) -> None:
+    return show_message_box(QMessageBox.Icon.Information, title, message)
+
+
+def show_error(title: str, message: str) -> None:
+    return show_message_box(QMessageBox.Icon.Critical, title, message)
@@ -0,0 +1,448 @@
+"""
+Steps of syncing the configured sheets into decks of a collection, free of the Anki GUI.
+
+The add-on runs them split between background threads and the main thread,
+the command-line sync and the benchmark run them one after another with sync_collection.
+All sheets mapped to the same deck are merged and synced into it together, with one diff and one write per deck.
+
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from types import SimpleNamespace
+from anki.collection import Collection
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from .deck_sync import (
+    DeckDiff, DeckSnapshot, DeckSyncException, DeckSyncPlan, DeckSyncResult, RemoteDeck, apply_deck_sync_plan, count_changes_by_source,
+    get_deck_fingerprint, merge_remote_decks, plan_deck_sync)
+from .google_connection import RequestStats
+from .google_sheets import (
+    GoogleServices, SheetReadOptions, SheetSelector, SpreadsheetData, SpreadsheetIdCache, SyncCancelledException,
+    fetch_spreadsheets_concurrently, resolve_spreadsheet_ids)
+from .sync_metrics import SyncMetrics
+from .sync_state import SnapshotStore, SyncStateStore
+
+# spreadsheet name and the settings of its sheets, as in the synchronization_map of import_config.json
+type SpreadsheetSettings = Tuple[str, List[Any]]
+
+
+def get_deck_group_key(deck_name: str) -> str:
+    # Anki deck names are case-insensitive
+    return deck_name.casefold()
+
+
+class DeckSheets:
+    """Fetched sheets synced into one Anki deck, in the configuration order, with the result of every sheet"""
+
+    def __init__(self, deck_name: str):
+        self.deck_name = deck_name
+        self.sheets = []
+        self.results = []
+
+    deck_name: str
+    sheets: List[Tuple[SpreadsheetData, Any]]
+    results: List[DeckSyncResult]
+
+    def add_sheet(self, spreadsheet: SpreadsheetData, sheet_settings: Any) -> None:
+        self.sheets.append((spreadsheet, sheet_settings))
+        self.results.append(DeckSyncResult(spreadsheet.spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name))
+
+    def get_remote_decks(self) -> List[RemoteDeck]:
+        return [spreadsheet.decks[sheet_settings.sheet_name] for spreadsheet, sheet_settings in self.sheets]
+
+    def get_snapshot_key(self) -> str:
+        """The snapshot describes the merged sheets, so it is kept for the whole set of sheets of the deck"""
+
+        sheet_keys: List[str] = [
+            SyncStateStore.get_key(spreadsheet.spreadsheet_id, sheet_settings.sheet_name, sheet_settings.deck_name)
+            for spreadsheet, sheet_settings in self.sheets]
+        if len(sheet_keys) == 1:
+            return sheet_keys[0]
+        return json.dumps(sheet_keys)
+
+    def get_snapshot_state(self, deck_fingerprint: Optional[str]) -> Optional[str]:
+        """The snapshot is stored with the state of the deck and the read options of the sheets,
+           as the same sheets read with other options have other cell text"""
+
+        if deck_fingerprint is None:
+            return None
+        return json.dumps([deck_fingerprint] + [spreadsheet.read_mode for spreadsheet, _ in self.sheets])
+
+    def to_json(self) -> Dict[str, Any]:
+        """Keeps the revisions of the sheets and their results, without the fetched cards"""
+
+        return {
+            "deck_name": self.deck_name,
+            "sheets": [
+                {
+                    "spreadsheet_name": spreadsheet.spreadsheet_name,
+                    "spreadsheet_id": spreadsheet.spreadsheet_id,
+                    "version": spreadsheet.version,
+                    "modified_time": spreadsheet.modified_time,
+                    "read_mode": spreadsheet.read_mode,
+                    "sheet_name": sheet_settings.sheet_name,
+                    "deck_name": sheet_settings.deck_name,
+                }
+                for spreadsheet, sheet_settings in self.sheets],
+            "results": [result.to_json() for result in self.results],
+        }
+
+    @staticmethod
+    def from_json(deck_sheets_json: Dict[str, Any]) -> "DeckSheets":
+        deck_sheets: DeckSheets = DeckSheets(deck_sheets_json["deck_name"])
+        for sheet_json in deck_sheets_json["sheets"]:
+            spreadsheet: SpreadsheetData = SpreadsheetData(
+                sheet_json["spreadsheet_name"],
+                sheet_json["spreadsheet_id"],
+                sheet_json["version"],
+                sheet_json["modified_time"],
+                sheet_json["read_mode"])
+            sheet_settings: SimpleNamespace = SimpleNamespace(sheet_name=sheet_json["sheet_name"], deck_name=sheet_json["deck_name"])
+            deck_sheets.sheets.append((spreadsheet, sheet_settings))
+        deck_sheets.results = [DeckSyncResult.from_json(result_json) for result_json in deck_sheets_json["results"]]
+        return deck_sheets
+
+
+def add_sheets_of_same_decks(
+        spreadsheets: List[SpreadsheetSettings],
+        all_spreadsheets: List[SpreadsheetSettings]) -> List[SpreadsheetSettings]:
+    """Returns the selected sheets together with all other configured sheets of their decks, in the configuration order.
+       Syncing only some sheets of a deck would delete the cards of the others."""
+
+    selected_sheets: Set[Tuple[str, str, str]] = {
+        (spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name)
+        for spreadsheet_name, sheets_settings in spreadsheets for sheet_settings in sheets_settings}
+    selected_decks: Set[str] = {get_deck_group_key(deck_name) for _, _, deck_name in selected_sheets}
+
+    expanded_spreadsheets: List[SpreadsheetSettings] = []
+    for spreadsheet_name, sheets_settings in all_spreadsheets:
+        expanded_sheets: List[Any] = [
+            sheet_settings for sheet_settings in sheets_settings if get_deck_group_key(sheet_settings.deck_name) in selected_decks]
+        if expanded_sheets:
+            expanded_spreadsheets.append((spreadsheet_name, expanded_sheets))
+
+    # sheets which are no longer in the sync config are synced as they were selected
+    configured_sheets: Set[Tuple[str, str, str]] = {
+        (spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name)
+        for spreadsheet_name, sheets_settings in expanded_spreadsheets for sheet_settings in sheets_settings}
+    if not selected_sheets <= configured_sheets:
+        return spreadsheets
+    return expanded_spreadsheets
+
+
+def fetch_remote_decks(
+        services: GoogleServices,
+        spreadsheets: List[SpreadsheetSettings],
+        id_cache: SpreadsheetIdCache,
+        worker_count: int,
+        select_sheets: Optional[SheetSelector],
+        on_spreadsheet_fetched: Callable[[int], None],
+        should_cancel: Callable[[], bool],
+        read_options: SheetReadOptions,
+        metrics: SyncMetrics) -> List[SpreadsheetData | Exception]:
+    """Fetch sheets of all specified spreadsheets in parallel. Spreadsheet IDs are resolved first with one Drive listing."""
+
+    start_stats: RequestStats = services.get_request_stats()
+
+    try:
+        with metrics.measure("spreadsheet_lookup"):
+            resolve_spreadsheet_ids(services, [spreadsheet_name for spreadsheet_name, _ in spreadsheets], id_cache)
+    except Exception as error:
+        # every spreadsheet fetch resolves its ID again and reports the error to the user
+        logging.error("Failed to resolve spreadsheet IDs: %s - %s", type(error).__name__, error)
+
+    sheet_names: List[Tuple[str, List[str]]] = [
+        (spreadsheet_name, list(dict.fromkeys(sheet_settings.sheet_name for sheet_settings in sheets_settings)))
+        for spreadsheet_name, sheets_settings in spreadsheets
+    ]
+    with metrics.measure("fetch"):
+        fetch_results: List[SpreadsheetData | Exception] = fetch_spreadsheets_concurrently(
+            services, sheet_names, id_cache, worker_count, select_sheets, on_spreadsheet_fetched, should_cancel, read_options)
+        if select_sheets is not None:
+            fetch_skipped_sheets_of_changed_decks(
+                services, spreadsheets, fetch_results, id_cache, worker_count, should_cancel, read_options)
+
+    stats: RequestStats = services.get_request_stats().since(start_stats)
+    metrics.add("http_requests", stats.request_count)
+    metrics.add("received_bytes", stats.received_bytes)
+    metrics.add("compressed_responses", stats.compressed_response_count)
+    metrics.add("retries", stats.retry_count)
+    metrics.add("throttle_wait_ms", round(stats.throttle_wait_seconds * 1000))
+    metrics.add("http_connections", stats.connection_count)
+    if stats.retry_count or stats.throttle_wait_seconds:
+        logging.info("Retried requests: %s, waited for rate limit: %.1f s", stats.retry_count, stats.throttle_wait_seconds)
+    metrics.add("rows_fetched", sum(fetch_result.row_count for fetch_result in fetch_results if isinstance(fetch_result, SpreadsheetData)))
+    metrics.add(
+        "sheets_exported_csv",
+        sum(fetch_result.exported_sheet_count for fetch_result in fetch_results if isinstance(fetch_result, SpreadsheetData)))
+    return fetch_results
+
+
+def fetch_skipped_sheets_of_changed_decks(
+        services: GoogleServices,
+        spreadsheets: List[SpreadsheetSettings],
+        fetch_results: List[SpreadsheetData | Exception],
+        id_cache: SpreadsheetIdCache,
+        worker_count: int,
+        should_cancel: Callable[[], bool],
+        read_options: SheetReadOptions) -> None:
+    """A deck is synced from all of its sheets, so unchanged sheets skipped while another sheet of their deck changed
+       are fetched again. Their decks are added to the fetch results, a failed fetch leaves them out."""
+
+    changed_decks: Set[str] = set()
+    for (_, sheets_settings), fetch_result in zip(spreadsheets, fetch_results):
+        for sheet_settings in sheets_settings:
+            if isinstance(fetch_result, SpreadsheetData) and sheet_settings.sheet_name in fetch_result.decks:
+                changed_decks.add(get_deck_group_key(sheet_settings.deck_name))
+
+    skipped_sheets: List[Tuple[SpreadsheetData, List[str]]] = []
+    for (_, sheets_settings), fetch_result in zip(spreadsheets, fetch_results):
+        if not isinstance(fetch_result, SpreadsheetData):
+            continue
+        sheet_names: List[str] = list(dict.fromkeys(
+            sheet_settings.sheet_name for sheet_settings in sheets_settings
+            if get_deck_group_key(sheet_settings.deck_name) in changed_decks and sheet_settings.sheet_name not in fetch_result.decks))
+        if sheet_names:
+            skipped_sheets.append((fetch_result, sheet_names))
+
+    if not skipped_sheets:
+        return
+
+    logging.info("Fetching %s unchanged sheets of changed decks", sum(len(sheet_names) for _, sheet_names in skipped_sheets))
+    refetch_results: List[SpreadsheetData | Exception] = fetch_spreadsheets_concurrently(
+        services, [(spreadsheet.spreadsheet_name, sheet_names) for spreadsheet, sheet_names in skipped_sheets],
+        id_cache, worker_count, None, lambda fetched_count: None, should_cancel, read_options)
+
+    for (spreadsheet, _), refetch_result in zip(skipped_sheets, refetch_results):
+        if isinstance(refetch_result, SpreadsheetData):
+            spreadsheet.decks.update(refetch_result.decks)
+            spreadsheet.row_count += refetch_result.row_count
+            spreadsheet.exported_sheet_count += refetch_result.exported_sheet_count
+
+
+def select_changed_sheets(
+        state_store: SyncStateStore,
+        spreadsheets: List[SpreadsheetSettings],
+        deck_fingerprints: Dict[str, Optional[str]],
+        spreadsheet: SpreadsheetData,
+        sheet_names: List[str]) -> List[str]:
+    """Called from fetching threads, picks the sheets which changed or whose decks changed since their last sync"""
+
+    changed_sheet_names: List[str] = []
+    changed_decks: Set[str] = set()
+    for spreadsheet_name, sheets_settings in spreadsheets:
+        if not spreadsheet_name == spreadsheet.spreadsheet_name:
+            continue
+        for sheet_settings in sheets_settings:
+            if not state_store.is_unchanged(
+                    spreadsheet.spreadsheet_id, sheet_settings.sheet_name, sheet_settings.deck_name,
+                    spreadsheet.version, spreadsheet.modified_time, spreadsheet.read_mode, deck_fingerprints.get(sheet_settings.deck_name)):
+                changed_decks.add(get_deck_group_key(sheet_settings.deck_name))
+
+        # other sheets of a changed deck are needed to sync it
+        for sheet_settings in sheets_settings:
+            if get_deck_group_key(sheet_settings.deck_name) in changed_decks:
+                changed_sheet_names.append(sheet_settings.sheet_name)
+
+    return [sheet_name for sheet_name in sheet_names if sheet_name in changed_sheet_names]
+
+
+def split_fetch_results(
+        spreadsheets: List[SpreadsheetSettings],
+        fetch_results: List[SpreadsheetData | Exception]) -> Tuple[List[DeckSyncResult], List[DeckSheets]]:
+    """Returns results of the sheets which failed to fetch or were skipped, and the fetched sheets grouped by deck.
+       A deck is synced only if all of its sheets were fetched, otherwise all of them fail or are skipped.
+       Decks with a cancelled fetch are in neither of them."""
+
+    # deck -> sheets of the deck with the result of their fetch, in the configuration order
+    deck_sheets: Dict[str, List[Tuple[str, Any, SpreadsheetData | Exception]]] = {}
+    for (spreadsheet_name, sheets_settings), fetch_result in zip(spreadsheets, fetch_results):
+        for sheet_settings in sheets_settings:
+            deck_key: str = get_deck_group_key(sheet_settings.deck_name)
+            deck_sheets.setdefault(deck_key, []).append((spreadsheet_name, sheet_settings, fetch_result))
+
+    results: List[DeckSyncResult] = []
+    pending_decks: List[DeckSheets] = []
+    for sheets in deck_sheets.values():
+        if any(isinstance(fetch_result, SyncCancelledException) for _, _, fetch_result in sheets):
+            continue
+
+        fetched: List[bool] = [
+            isinstance(fetch_result, SpreadsheetData) and sheet_settings.sheet_name in fetch_result.decks
+            for _, sheet_settings, fetch_result in sheets]
+        if all(fetched):
+            pending_deck: DeckSheets = DeckSheets(sheets[0][1].deck_name)
+            for _, sheet_settings, fetch_result in sheets:
+                pending_deck.add_sheet(fetch_result, sheet_settings)  # type: ignore[arg-type]
+            pending_decks.append(pending_deck)
+            continue
+
+        failed_sheet_names: List[str] = [
+            f"'{spreadsheet_name}'-'{sheet_settings.sheet_name}'"
+            for (spreadsheet_name, sheet_settings, fetch_result), sheet_fetched in zip(sheets, fetched)
+            if isinstance(fetch_result, Exception) or not sheet_fetched and any(fetched)]
+        for spreadsheet_name, sheet_settings, fetch_result in sheets:
+            result: DeckSyncResult = DeckSyncResult(spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name)
+            if isinstance(fetch_result, Exception):
+                result.set_error(fetch_result)
+            elif failed_sheet_names:
+                result.set_error(DeckSyncException(f"Deck is synced from several sheets, failed to fetch: {', '.join(failed_sheet_names)}"))
+            else:
+                result.skipped = True
+            results.append(result)
+
+    return results, pending_decks
+
+
+def plan_deck_sheets_sync(
+        col: Collection,
+        snapshot_store: Optional[SnapshotStore],
+        deck_sheets: DeckSheets,
+        force_full_sync: bool,
+        metrics: SyncMetrics) -> DeckSyncPlan:
+    """Computes the diff of the merged sheets and their deck, from the snapshot of the last sync if the deck didn't change since.
+       The results of the sheets get the planned changes."""
+
+    start_time: float = time.perf_counter()
+    remote_deck: RemoteDeck = merge_remote_decks(deck_sheets.get_remote_decks())
+    snapshot: Optional[DeckSnapshot] = None
+    if not force_full_sync and snapshot_store is not None:
+        try:
+            snapshot = snapshot_store.load(
+                deck_sheets.get_snapshot_key(), deck_sheets.get_snapshot_state(get_deck_fingerprint(col, deck_sheets.deck_name)))
+        except sqlite3.Error as error:
+            logging.error("Failed to load sync snapshot of the deck %s: %s", deck_sheets.deck_name, error)
+
+    with metrics.measure("diff"):
+        plan: DeckSyncPlan = plan_deck_sync(col, deck_sheets.deck_name, remote_deck, snapshot)
+    metrics.add("rows_diffed", len(remote_deck))
+    set_deck_sheets_diff(deck_sheets, plan)
+    deck_sheets.results[0].sync_seconds += time.perf_counter() - start_time
+    return plan
+
+
+def apply_deck_sheets_sync(
+        col: Collection,
+        state_store: SyncStateStore,
+        snapshot_store: Optional[SnapshotStore],
+        deck_sheets: DeckSheets,
+        plan: DeckSyncPlan,
+        metrics: SyncMetrics) -> None:
+    """Writes the planned changes to the deck, then records the state of the sheets and the deck for the next sync"""
+
+    start_time: float = time.perf_counter()
+    apply_deck_sync_plan(col, plan, metrics)
+
+    deck_fingerprint: Optional[str] = get_deck_fingerprint(col, deck_sheets.deck_name)
+    for spreadsheet, sheet_settings in deck_sheets.sheets:
+        state_store.record(
+            spreadsheet.spreadsheet_id, sheet_settings.sheet_name, sheet_settings.deck_name,
+            spreadsheet.version, spreadsheet.modified_time, spreadsheet.read_mode, deck_fingerprint)
+
+    if snapshot_store is not None:
+        save_snapshot(snapshot_store, deck_sheets, plan, deck_fingerprint)
+    deck_sheets.results[0].sync_seconds += time.perf_counter() - start_time
+
+
+def set_deck_sheets_diff(deck_sheets: DeckSheets, plan: DeckSyncPlan) -> None:
+    """Added and updated cards are counted for the sheet they were taken from.
+       Deleted cards and duplicate card keys belong to the whole deck, they are counted for its first sheet."""
+
+    if len(deck_sheets.results) == 1:
+        deck_sheets.results[0].set_diff(plan.diff)
+        return
+
+    change_counts: List[Tuple[int, int]] = count_changes_by_source(plan.diff, deck_sheets.get_remote_decks())
+    for result, (added_count, updated_count) in zip(deck_sheets.results, change_counts):
+        result.added_card_count = added_count
+        result.updated_card_count = updated_count
+    deck_sheets.results[0].removed_card_count = len(plan.diff.notes_to_remove)
+    deck_sheets.results[0].duplicate_card_key_count = len(plan.diff.duplicate_card_keys)
+
+
+def set_deck_sheets_error(deck_sheets: DeckSheets, error: Exception) -> None:
+    logging.error("Failed to sync deck %s: %s - %s", deck_sheets.deck_name, type(error).__name__, error)
+    for result in deck_sheets.results:
+        # the planned changes weren't made
+        result.set_diff(DeckDiff())
+        result.set_error(error)
+
+
+def save_snapshot(snapshot_store: SnapshotStore, deck_sheets: DeckSheets, plan: DeckSyncPlan, deck_fingerprint: Optional[str]) -> None:
+    try:
+        snapshot_store.update(
+            deck_sheets.get_snapshot_key(), deck_sheets.get_snapshot_state(deck_fingerprint),
+            plan.snapshot_rows, plan.removed_key_hashes, not plan.incremental)
+    except sqlite3.Error as error:
+        # the snapshot is written in one transaction, on failure the previous one stays and no longer matches the deck
+        logging.error("Failed to save sync snapshot of the deck %s: %s", deck_sheets.deck_name, error)
+
+
+def finish_results(spreadsheets: List[SpreadsheetSettings], results: List[DeckSyncResult], metrics: SyncMetrics) -> None:
+    """Counts the results in the metrics and sorts them in the configuration order.
+       Skipped and failed sheets are known before the synced ones."""
+
+    metrics.finish()
+    metrics.add("decks_synced", sum(1 for result in results if result.error is None and not result.skipped))
+    metrics.add("decks_skipped", sum(1 for result in results if result.skipped))
+    metrics.add("decks_failed", sum(1 for result in results if result.error is not None))
+
+    config_order: Dict[Tuple[str, str, str], int] = {}
+    for spreadsheet_name, sheets_settings in spreadsheets:
+        for sheet_settings in sheets_settings:
+            config_order.setdefault((spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name), len(config_order))
+    results.sort(key=lambda result: config_order.get((result.spreadsheet_name, result.sheet_name, result.deck_name), 0))
+
+
+def sync_collection(
+        col: Collection,
+        services: GoogleServices,
+        spreadsheets: List[SpreadsheetSettings],
+        id_cache: SpreadsheetIdCache,
+        state_store: SyncStateStore,
+        snapshot_store: Optional[SnapshotStore],
+        fetch_worker_count: int,
+        read_options: SheetReadOptions,
+        force_full_sync: bool,
+        metrics: SyncMetrics) -> List[DeckSyncResult]:
+    """Syncs all configured sheets into the decks of the collection in the calling thread and returns result of every deck.
+       Unless the full sync is forced, unchanged sheets are skipped and decks are compared from their snapshots."""
+
+    deck_names: List[str] = [sheet_settings.deck_name for _, sheets_settings in spreadsheets for sheet_settings in sheets_settings]
+    deck_fingerprints: Dict[str, Optional[str]] = {}
+    if not force_full_sync:
+        deck_fingerprints = {deck_name: get_deck_fingerprint(col, deck_name) for deck_name in deck_names}
+
+    select_sheets: Optional[SheetSelector] = None
+    if not force_full_sync:
+        select_sheets = lambda spreadsheet, sheet_names: select_changed_sheets(
+            state_store, spreadsheets, deck_fingerprints, spreadsheet, sheet_names)
+
+    fetch_results: List[SpreadsheetData | Exception] = fetch_remote_decks(
+        services, spreadsheets, id_cache, fetch_worker_count, select_sheets, lambda fetched_count: None, lambda: False, read_options,
+        metrics)
+    results, pending_decks = split_fetch_results(spreadsheets, fetch_results)
+
+    for deck_sheets in pending_decks:
+        results.extend(deck_sheets.results)
+        try:
+            plan: DeckSyncPlan = plan_deck_sheets_sync(col, snapshot_store, deck_sheets, force_full_sync, metrics)
+            apply_deck_sheets_sync(col, state_store, snapshot_store, deck_sheets, plan, metrics)
+        except Exception as error:
+            set_deck_sheets_error(deck_sheets, error)
+
+    try:
+        state_store.save()
+    except OSError as error:
+        logging.error("Failed to save sync state: %s", error)
+
+    finish_results(spreadsheets, results, metrics)
+    return results
@@ -0,0 +1,327 @@
+"""
+Import window: the configured sheets with the results of their last sync, synced all at once or by the selected rows.
+
+"""
+
+import logging
+import os
+from aqt import mw
+from aqt.qt import qconnect
+from anki.collection import Collection
+from PyQt6.QtGui import QBrush, QCloseEvent, QColor
+from PyQt6.QtWidgets import (
+    QLabel, QVBoxLayout, QWidget, QLineEdit, QPushButton, QHBoxLayout, QCheckBox, QTableView, QAbstractItemView, QHeaderView)
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel, QItemSelectionModel
+from .addon_config import AddonConfig, load_synchronization_map
+from .addon_files import SYNC_HISTORY_FILE, get_user_file, load_addon_config
+from .deck_sync import DeckSyncResult
+from .gui_utils import get_icon, show_info, show_error
+from .headless_sync import SpreadsheetSettings
+from .sync_plan import SyncPlan
+from .sync_runner import start_sync, sync_plan_listeners, sync_history_listeners
+from .sync_state import SyncHistory
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+
+class SheetMappingsModel(QAbstractTableModel):
+    """Configured sheets with their decks, whether the deck exists, the result of the last sync and the previewed changes.
+       Cells are computed only when the view asks for them, so only the visible rows are rendered."""
+
+    COLUMNS: List[str] = ["Spreadsheet", "Sheet", "Deck", "Last sync", "Result", "Time, s", "Preview"]
+    MISSING_DECK_BRUSH: QBrush = QBrush(QColor("red"))
+    FAILED_BRUSH: QBrush = QBrush(QColor("darkred"))
+
+    def __init__(self, spreadsheets: List[SpreadsheetSettings]):
+        super().__init__()
+        self.rows = [
+            (spreadsheet_name, sheet_settings) for spreadsheet_name, sheets_settings in spreadsheets for sheet_settings in sheets_settings]
+        self.deck_names = set()
+        self.history = SyncHistory(get_user_file(SYNC_HISTORY_FILE))
+        self.planned_results = {}
+
+    rows: List[Tuple[str, Any]]
+    # casefolded names, as Anki deck names are case-insensitive
+    deck_names: Set[str]
+    history: SyncHistory
+    # sheet key of SyncHistory -> planned changes of the sheet from the last preview
+    planned_results: Dict[str, DeckSyncResult]
+
+    def set_sync_plan(self, sync_plan: Optional[SyncPlan]):
+        self.beginResetModel()
+        self.planned_results = {} if sync_plan is None else {
+            SyncHistory.get_key(result.spreadsheet_name, result.sheet_name, result.deck_name): result for result in sync_plan.get_results()}
+        self.endResetModel()
+
+    def refresh(self, deck_names: List[str]):
+        """Takes the deck names from one snapshot of the collection decks and reloads the sync history"""
+
+        self.beginResetModel()
+        self.deck_names = {deck_name.casefold() for deck_name in deck_names}
+        self.history = SyncHistory(get_user_file(SYNC_HISTORY_FILE))
+        self.endResetModel()
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.ItemDataRole.DisplayRole) -> Any:
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+
+        spreadsheet_name, sheet_settings = self.rows[index.row()]
+        column: int = index.column()
+        deck_exists: bool = sheet_settings.deck_name.casefold() in self.deck_names
+        history_entry: Optional[Dict[str, Any]] = None
+        if 3 <= column <= 5 or role == Qt.ItemDataRole.ForegroundRole:
+            history_entry = self.history.get(spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name)
+        planned_result: Optional[DeckSyncResult] = None
+        if column == 6:
+            planned_result = self.planned_results.get(
+                SyncHistory.get_key(spreadsheet_name, sheet_settings.sheet_name, sheet_settings.deck_name))
+
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == 0:
+                return spreadsheet_name
+            if column == 1:
+                return sheet_settings.sheet_name
+            if column == 2:
+                return sheet_settings.deck_name if deck_exists else f"{sheet_settings.deck_name} (missing)"
+            if column == 6:
+                return "" if planned_result is None else self.describe_planned_result(planned_result)
+            if history_entry is None:
+                return "Never" if column == 3 else ""
+            if column == 3:
+                return history_entry["finished_at"]
+            if column == 4:
+                return self.describe_history_entry(history_entry)
+            return f"{history_entry.get('sync_seconds', 0.0):.2f}"
+
+        if role == Qt.ItemDataRole.ToolTipRole and column == 4 and history_entry is not None and history_entry["error"] is not None:
+            return history_entry["error"]
+        if role == Qt.ItemDataRole.ToolTipRole and column == 6 and planned_result is not None and planned_result.error is not None:
+            return planned_result.error
+
+        if role == Qt.ItemDataRole.ForegroundRole:
+            if not deck_exists:
+                return self.MISSING_DECK_BRUSH
+            if history_entry is not None and history_entry["error"] is not None:
+                return self.FAILED_BRUSH
+
+        return None
+
+    @staticmethod
+    def describe_history_entry(history_entry: Dict[str, Any]) -> str:
+        if history_entry["error"] is not None:
+            return "Failed"
+        if history_entry["skipped"]:
+            return "Unchanged"
+        return (
+            f"Added {history_entry['added_card_count']}, updated {history_entry['updated_card_count']}, "
+            f"deleted {history_entry['removed_card_count']}")
+
+    @staticmethod
+    def describe_planned_result(result: DeckSyncResult) -> str:
+        if result.error is not None:
+            return "Failed"
+        if result.skipped:
+            return "Unchanged"
+        return f"Add {result.added_card_count}, update {result.updated_card_count}, delete {result.removed_card_count}"
+
+
+class ImportWindow(QWidget):
+    """Table of the configured sheets, which can be filtered and synced all at once or by the selected rows"""
+
+    def __init__(self, config: AddonConfig, spreadsheets: List[SpreadsheetSettings]):
+        super().__init__()
+        self.config = config
+        self.spreadsheets = spreadsheets
+
+        self.setWindowTitle("Import from Google Sheets")
+        self.setWindowIcon(get_icon())
+        self.resize(900, 600)
+        layout = QVBoxLayout(self)
+
+        self.filter_textbox = QLineEdit()
+        self.filter_textbox.setPlaceholderText("Filter by spreadsheet, sheet or deck")
+        self.filter_textbox.setClearButtonEnabled(True)
+        layout.addWidget(self.filter_textbox)
+
+        self.model = SheetMappingsModel(spreadsheets)
+        self.proxy_model = QSortFilterProxyModel(self)
+        self.proxy_model.setSourceModel(self.model)
+        self.proxy_model.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        # the filter matches the spreadsheet, sheet and deck columns
+        self.proxy_model.setFilterKeyColumn(-1)
+        qconnect(self.filter_textbox.textChanged, self.proxy_model.setFilterFixedString)
+
+        self.table_view = QTableView()
+        self.table_view.setModel(self.proxy_model)
+        self.table_view.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table_view.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.table_view.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table_view.setSortingEnabled(True)
+        self.table_view.sortByColumn(-1, Qt.SortOrder.AscendingOrder)
+        # fixed row height, so the view doesn't measure the contents of every row
+        vertical_header: QHeaderView | None = self.table_view.verticalHeader()
+        if vertical_header is not None:
+            vertical_header.setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+            vertical_header.hide()
+        horizontal_header: QHeaderView | None = self.table_view.horizontalHeader()
+        if horizontal_header is not None:
+            horizontal_header.setStretchLastSection(True)
+        qconnect(self.table_view.doubleClicked, self.on_row_double_clicked)
+        layout.addWidget(self.table_view)
+
+        self.force_full_sync_checkbox = QCheckBox("Force full sync (also sync sheets and decks unchanged since the last sync)")
+        layout.addWidget(self.force_full_sync_checkbox)
+
+        self.preview_label = QLabel()
+        self.preview_label.setWordWrap(True)
+        self.preview_label.hide()
+        layout.addWidget(self.preview_label)
+
+        self.preview_button = QPushButton("Preview changes")
+        self.preview_button.setToolTip("Compare the selected sheets, or all sheets if none are selected, without changing the decks")
+        qconnect(self.preview_button.clicked, self.on_preview)
+        self.sync_selected_button = QPushButton("Sync selected")
+        qconnect(self.sync_selected_button.clicked, self.on_sync_selected)
+        self.sync_all_button = QPushButton("Sync all")
+        qconnect(self.sync_all_button.clicked, self.on_sync_all)
+
+        buttons_row = QHBoxLayout()
+        buttons_row.addWidget(self.preview_button)
+        buttons_row.addStretch()
+        buttons_row.addWidget(self.sync_selected_button)
+        buttons_row.addWidget(self.sync_all_button)
+        layout.addLayout(buttons_row)
+
+        self.refresh()
+        for column in range(3):
+            self.table_view.resizeColumnToContents(column)
+
+        sync_plan_listeners.append(self.show_sync_plan)
+        sync_history_listeners.append(self.refresh)
+
+    config: AddonConfig
+    spreadsheets: List[SpreadsheetSettings]
+    model: SheetMappingsModel
+    proxy_model: QSortFilterProxyModel
+    table_view: QTableView
+    preview_label: QLabel
+
+    def refresh(self):
+        col: Collection | None = mw.col
+        deck_names: List[str] = [] if col is None else [deck.name for deck in col.decks.all_names_and_ids()]
+        self.model.refresh(deck_names)
+
+    def get_selected_spreadsheets(self) -> List[SpreadsheetSettings]:
+        """Selected rows grouped by spreadsheet, in the configuration order"""
+
+        selection_model: QItemSelectionModel | None = self.table_view.selectionModel()
+        if selection_model is None:
+            return []
+        selected_rows: Set[int] = {self.proxy_model.mapToSource(index).row() for index in selection_model.selectedRows()}
+        selected_spreadsheets: Dict[str, List[Any]] = {}
+        for row_index, (spreadsheet_name, sheet_settings) in enumerate(self.model.rows):
+            if row_index in selected_rows:
+                selected_spreadsheets.setdefault(spreadsheet_name, []).append(sheet_settings)
+        return list(selected_spreadsheets.items())
+
+    def show_sync_plan(self, sync_plan: Optional[SyncPlan]):
+        self.model.set_sync_plan(sync_plan)
+        if sync_plan is None:
+            self.preview_label.hide()
+            return
+
+        if sync_plan.has_errors():
+            self.preview_label.setText(
+                f"Changes previewed at {sync_plan.planned_at}, some sheets failed. The next sync compares the sheets again.")
+        else:
+            self.preview_label.setText(
+                f"Changes previewed at {sync_plan.planned_at}. Syncing the same sheets applies them without fetching and comparing again, "
+                "unless a spreadsheet or a deck changed since.")
+        self.preview_label.show()
+
+    def on_preview(self):
+        spreadsheets: List[SpreadsheetSettings] = self.get_selected_spreadsheets() or self.spreadsheets
+        start_sync(self.config, spreadsheets, self.force_full_sync_checkbox.isChecked(), preview=True)
+
+    def on_sync_selected(self):
+        selected_spreadsheets: List[SpreadsheetSettings] = self.get_selected_spreadsheets()
+        if not selected_spreadsheets:
+            show_info("Nothing selected", "Select the sheets to sync in the table.")
+            return
+        start_sync(self.config, selected_spreadsheets, self.force_full_sync_checkbox.isChecked())
+
+    def on_sync_all(self):
+        start_sync(self.config, self.spreadsheets, self.force_full_sync_checkbox.isChecked())
+
+    def on_row_double_clicked(self, index: QModelIndex):
+        spreadsheet_name, sheet_settings = self.model.rows[self.proxy_model.mapToSource(index).row()]
+        start_sync(self.config, [(spreadsheet_name, [sheet_settings])], self.force_full_sync_checkbox.isChecked())
+
+    def closeEvent(self, event: Optional[QCloseEvent]):
+        global _import_window
+        _import_window = None
+        if self.show_sync_plan in sync_plan_listeners:
+            sync_plan_listeners.remove(self.show_sync_plan)
+            sync_history_listeners.remove(self.refresh)
+        if event is not None:
+            event.accept()
+
+
+# the open import window, refreshed when a sync finishes
+_import_window: Optional[ImportWindow] = None
+
+
+def goosheesy_import():
+    """Opens GUI window with configured decks for synchronization, executes process of syncing."""
+    global _import_window
+
+    if mw is None:
+        logging.error("mw is None.")
+        return
+
+    col: Collection | None = mw.col
+    if col is None:
+        logging.error("Collection mw.col is None.")
+        return
+
+    config: AddonConfig = load_addon_config()
+
+    if not os.path.exists(config.credentials_file) or not os.path.exists(config.sync_config_file):
+        show_error(
+            "Error - Configuration files missing or not exist",
+            "Configure sheets and decks first in the 'Settings for Google Sheets import' menu!")
+        return
+
+    # current_directory = os.getcwd()
+    # backup_dir = os.path.join(current_directory, "backups")
+    # logging.info("Starting creating database backup in %s", backup_dir)
+    # if not os.path.exists(backup_dir):
+    #     os.makedirs(backup_dir)
+    # col.create_backup(backup_folder=backup_dir, force=True, wait_for_completion=True)
+    # logging.info("Backup created.")
+
+    logging.info("Path to the Anki collections database file: %s", col.path)
+
+    spreadsheets: List[SpreadsheetSettings] = [
+        (spreadsheet_settings.spreadsheet_name, spreadsheet_settings.sheets)
+        for spreadsheet_settings in load_synchronization_map(config.sync_config_file)]
+
+    if _import_window is not None:
+        _import_window.close()
+    mw.importWidget = _import_window = ImportWindow(config, spreadsheets)
+    _import_window.show()
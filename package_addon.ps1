@@ -1,5 +1,19 @@
 Compress-Archive -Path `
     __init__.py, `
+    addon_config.py, `
+    addon_files.py, `
+    auto_sync.py, `
+    deck_sync.py, `
+    google_connection.py, `
+    google_sheets.py, `
+    gui_utils.py, `
+    headless_sync.py, `
+    import_window.py, `
+    sync_cli.py, `
+    sync_metrics.py, `
+    sync_plan.py, `
+    sync_runner.py, `
+    sync_state.py, `
     vendor/, `
     LICENSE, `
     version.txt, `
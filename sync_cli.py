@@ -0,0 +1,156 @@
+"""
+Command-line sync of Anki collections with Google Sheets, without the Anki GUI, e.g. for scheduled runs.
+
+It uses the settings, the sync config and the Google token of the add-on, so the add-on has to be set up
+and synced once in Anki first. Collections must not be open in Anki while they are synced.
+Requires the anki package and the packages from requirements.txt in the Python environment:
+    python sync_cli.py "~/.local/share/Anki2/User 1/collection.anki2" other/collection.anki2 --processes 2
+
+Collections are synced in parallel processes, one collection per process.
+A JSON summary with the result of every deck is printed to stdout, the log goes to stderr.
+Exit code is 1 if any collection or deck failed to sync.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os.path
+import sys
+import types
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import List
+
+ADDON_DIR: str = os.path.dirname(os.path.abspath(__file__))
+ADDON_PACKAGE: str = "goosheesy"
+USER_DATA_DIR: str = os.path.join(ADDON_DIR, "user_files")
+
+# the add-on modules are loaded without the add-on __init__.py, which needs the running Anki GUI
+if ADDON_PACKAGE not in sys.modules:
+    addon_package = types.ModuleType(ADDON_PACKAGE)
+    addon_package.__path__ = [ADDON_DIR]
+    sys.modules[ADDON_PACKAGE] = addon_package
+
+from anki.collection import Collection  # noqa: E402
+from goosheesy.addon_config import AddonConfig, load_sheet_read_options, load_synchronization_map, read_addon_config  # noqa: E402
+from goosheesy.deck_sync import DeckSyncResult, hash_text, set_card_change_logging, set_text_normalization  # noqa: E402
+from goosheesy.google_connection import load_saved_credentials  # noqa: E402
+from goosheesy.google_sheets import GoogleServices, SpreadsheetIdCache, get_google_services  # noqa: E402
+from goosheesy.headless_sync import SpreadsheetSettings, sync_collection  # noqa: E402
+from goosheesy.sync_metrics import SyncMetrics  # noqa: E402
+from goosheesy.sync_state import SnapshotStore, SyncStateStore  # noqa: E402
+
+
+class CliSyncException(Exception):
+    """Sync of the collection can't start"""
+
+
+def configure_logging(verbose: bool) -> None:
+    logging.basicConfig(
+        level=logging.INFO if verbose else logging.WARNING,
+        format="%(asctime)s [%(processName)-12.12s] [%(levelname)-5.5s]  %(message)s",
+        stream=sys.stderr)
+
+
+def get_collection_state_dir(state_dir: str, collection_file: str) -> str:
+    """Sync state and snapshots are kept per collection, as they record the state of its decks"""
+
+    collection_path: str = os.path.abspath(collection_file)
+    collection_name: str = os.path.splitext(os.path.basename(collection_path))[0]
+    return os.path.join(state_dir, f"{collection_name}-{hash_text(collection_path)[:16]}")
+
+
+def sync_collection_file(collection_file: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Runs in a worker process, syncs all configured sheets into the collection and returns its summary"""
+
+    metrics: SyncMetrics = SyncMetrics()
+    summary: Dict[str, Any] = {"collection": collection_file, "results": [], "metrics": None, "error": None}
+
+    try:
+        config: AddonConfig = read_addon_config(args.addon_config)
+        set_card_change_logging(config.log_card_changes)
+        set_text_normalization(config.get_text_normalization())
+        sync_config_file: str = args.sync_config or config.sync_config_file
+        if not sync_config_file:
+            raise CliSyncException(f"Sync config is neither set in {args.addon_config} nor passed with --sync-config")
+        spreadsheets: List[SpreadsheetSettings] = [
+            (spreadsheet_settings.spreadsheet_name, spreadsheet_settings.sheets)
+            for spreadsheet_settings in load_synchronization_map(sync_config_file)]
+
+        with metrics.measure("credentials"):
+            credentials = load_saved_credentials(args.token)
+        if credentials is None:
+            raise CliSyncException(f"No usable Google token in {args.token}, sync once in Anki to log in")
+        with metrics.measure("services"):
+            services: GoogleServices = get_google_services(credentials, config.get_transport_options())
+
+        collection_state_dir: str = get_collection_state_dir(args.state_dir, collection_file)
+        os.makedirs(collection_state_dir, exist_ok=True)
+
+        col: Collection = Collection(collection_file)
+        snapshot_store: SnapshotStore = SnapshotStore(os.path.join(collection_state_dir, "sync_snapshots.db"))
+        try:
+            results: List[DeckSyncResult] = sync_collection(
+                col, services, spreadsheets,
+                SpreadsheetIdCache(os.path.join(collection_state_dir, "spreadsheet_ids.json")),
+                SyncStateStore(os.path.join(collection_state_dir, "sync_state.json")),
+                snapshot_store,
+                config.fetch_worker_count, load_sheet_read_options(config, sync_config_file), args.force_full_sync, metrics)
+        finally:
+            snapshot_store.close()
+            col.close()
+
+        summary["results"] = [result.to_json() for result in results]
+        for result in results:
+            logging.info("%s: %s", collection_file, result.describe())
+        logging.info("%s: %s", collection_file, metrics.describe())
+    except Exception as error:
+        logging.error("Failed to sync collection %s: %s - %s", collection_file, type(error).__name__, error)
+        summary["error"] = f"{type(error).__name__} - {error}"
+        metrics.finish()
+
+    summary["metrics"] = metrics.to_json()
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sync Anki collections with Google Sheets without the Anki GUI")
+    parser.add_argument("collections", nargs="+", help="paths of the collection files, e.g. collection.anki2 of the Anki profile")
+    parser.add_argument("--addon-config", default=os.path.join(USER_DATA_DIR, "goosheesy.json"), help="settings of the add-on")
+    parser.add_argument("--sync-config", help="import_config.json to use instead of the one set in the add-on settings")
+    parser.add_argument("--token", default=os.path.join(USER_DATA_DIR, "token.json"), help="Google token saved by the add-on")
+    parser.add_argument(
+        "--state-dir", default=os.path.join(USER_DATA_DIR, "headless"), help="directory for the sync state of the collections")
+    parser.add_argument("--processes", type=int, default=1, help="number of collections synced in parallel")
+    parser.add_argument("--force-full-sync", action="store_true", help="sync unchanged sheets and compare whole decks")
+    parser.add_argument("--verbose", action="store_true", help="log every deck to stderr")
+    args = parser.parse_args()
+
+    configure_logging(args.verbose)
+
+    # the token is refreshed once here, so that the worker processes don't refresh and write it at the same time
+    try:
+        if load_saved_credentials(args.token) is None:
+            logging.warning("No usable Google token in %s", args.token)
+    except Exception as error:
+        logging.warning("Failed to refresh the Google token: %s - %s", type(error).__name__, error)
+
+    summaries: List[Dict[str, Any]]
+    process_count: int = max(1, min(args.processes, len(args.collections)))
+    if process_count == 1:
+        summaries = [sync_collection_file(collection_file, args) for collection_file in args.collections]
+    else:
+        # spawned processes don't inherit the threads and the open files of this one
+        with ProcessPoolExecutor(process_count, multiprocessing.get_context("spawn"), configure_logging, (args.verbose,)) as executor:
+            summaries = list(executor.map(sync_collection_file, args.collections, [args] * len(args.collections)))
+
+    failed: bool = any(
+        summary["error"] is not None or any(result["error"] is not None for result in summary["results"]) for summary in summaries)
+    print(json.dumps({"collections": summaries, "failed": failed}, indent=4))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Sync plan: changes of the synced decks computed in advance, to preview them before anything is written to the collection.
+
+The plan keeps the revisions of the spreadsheets and the state of the decks it was computed from.
+While none of them changed, the plan is applied as it is, without fetching the sheets and comparing the decks again.
+
+"""
+
+import json
+import logging
+import os.path
+from anki.collection import Collection
+from anki.decks import DeckId
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from .deck_sync import DeckSyncPlan, DeckSyncResult, TextNormalization, get_deck_fingerprint
+from .google_sheets import GoogleServices, SheetReadOptions, SpreadsheetData, get_spreadsheet_revision
+from .headless_sync import DeckSheets, SpreadsheetSettings
+
+# plans saved in another format are ignored
+SYNC_PLAN_FORMAT_VERSION: int = 2
+
+
+def get_sync_plan_key(
+        spreadsheets: List[SpreadsheetSettings],
+        force_full_sync: bool,
+        read_options: SheetReadOptions,
+        normalization: TextNormalization) -> str:
+    """Describes the sheets and the settings the plan is computed with, a plan is only applied by a sync with the same key"""
+
+    return json.dumps([
+        [[spreadsheet_name, [[sheet_settings.sheet_name, sheet_settings.deck_name] for sheet_settings in sheets_settings]]
+         for spreadsheet_name, sheets_settings in spreadsheets],
+        force_full_sync,
+        read_options.value_render_option,
+        sorted(read_options.csv_export_spreadsheet_names),
+        normalization.get_key(),
+    ])
+
+
+class PlannedDeck:
+    """Planned changes of one deck with its sheets, and the state of the deck they were computed from"""
+
+    def __init__(self, deck_sheets: DeckSheets, plan: DeckSyncPlan, deck_fingerprint: Optional[str]):
+        self.deck_sheets = deck_sheets
+        self.plan = plan
+        self.deck_fingerprint = deck_fingerprint
+
+    deck_sheets: DeckSheets
+    plan: DeckSyncPlan
+    deck_fingerprint: Optional[str]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"deck_sheets": self.deck_sheets.to_json(), "plan": self.plan.to_json(), "deck_fingerprint": self.deck_fingerprint}
+
+    @staticmethod
+    def from_json(col: Collection, planned_deck_json: Dict[str, Any]) -> "PlannedDeck":
+        return PlannedDeck(
+            DeckSheets.from_json(planned_deck_json["deck_sheets"]),
+            DeckSyncPlan.from_json(col, planned_deck_json["plan"]),
+            planned_deck_json["deck_fingerprint"])
+
+
+class SyncPlan:
+    """Planned changes of all synced decks, with the sheets which are unchanged or failed to fetch"""
+
+    def __init__(self, plan_key: str, planned_at: str):
+        self.plan_key = plan_key
+        self.planned_at = planned_at
+        self.spreadsheet_revisions = {}
+        self.deck_fingerprints = {}
+        self.results = []
+        self.decks = []
+
+    plan_key: str
+    planned_at: str
+    # spreadsheet ID -> Drive version and modification time of the spreadsheet when it was fetched
+    spreadsheet_revisions: Dict[str, Tuple[str, str]]
+    # state of the decks of the unchanged sheets, the planned decks keep their own
+    deck_fingerprints: Dict[str, Optional[str]]
+    # sheets which are unchanged or failed to fetch
+    results: List[DeckSyncResult]
+    decks: List[PlannedDeck]
+
+    def add_fetch_results(
+            self,
+            fetch_results: List[SpreadsheetData | Exception],
+            results: List[DeckSyncResult],
+            deck_fingerprints: Dict[str, Optional[str]]) -> None:
+        for fetch_result in fetch_results:
+            if isinstance(fetch_result, SpreadsheetData):
+                self.spreadsheet_revisions[fetch_result.spreadsheet_id] = (fetch_result.version, fetch_result.modified_time)
+
+        self.results = list(results)
+        for result in results:
+            if result.skipped:
+                self.deck_fingerprints[result.deck_name] = deck_fingerprints.get(result.deck_name)
+
+    def get_results(self) -> List[DeckSyncResult]:
+        return self.results + [result for planned_deck in self.decks for result in planned_deck.deck_sheets.results]
+
+    def has_errors(self) -> bool:
+        return any(result.error is not None for result in self.get_results())
+
+    def describe(self) -> List[str]:
+        """One line per deck with the number of cards to add, update and delete"""
+
+        lines: List[str] = [result.describe() for result in self.results]
+        for planned_deck in self.decks:
+            deck_results: List[DeckSyncResult] = planned_deck.deck_sheets.results
+            if deck_results[0].error is not None:
+                lines.extend(result.describe() for result in deck_results)
+                continue
+            lines.append(
+                f"{planned_deck.deck_sheets.deck_name}: cards to add: {sum(result.added_card_count for result in deck_results)}, "
+                f"to update: {sum(result.updated_card_count for result in deck_results)}, "
+                f"to delete: {sum(result.removed_card_count for result in deck_results)}")
+        return lines
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "format_version": SYNC_PLAN_FORMAT_VERSION,
+            "plan_key": self.plan_key,
+            "planned_at": self.planned_at,
+            "spreadsheet_revisions": {spreadsheet_id: list(revision) for spreadsheet_id, revision in self.spreadsheet_revisions.items()},
+            "deck_fingerprints": self.deck_fingerprints,
+            "results": [result.to_json() for result in self.results],
+            "decks": [planned_deck.to_json() for planned_deck in self.decks],
+        }
+
+    @staticmethod
+    def from_json(col: Collection, sync_plan_json: Dict[str, Any]) -> "SyncPlan":
+        sync_plan: SyncPlan = SyncPlan(sync_plan_json["plan_key"], sync_plan_json["planned_at"])
+        sync_plan.spreadsheet_revisions = {
+            spreadsheet_id: (version, modified_time)
+            for spreadsheet_id, (version, modified_time) in sync_plan_json["spreadsheet_revisions"].items()}
+        sync_plan.deck_fingerprints = sync_plan_json["deck_fingerprints"]
+        sync_plan.results = [DeckSyncResult.from_json(result_json) for result_json in sync_plan_json["results"]]
+        sync_plan.decks = [PlannedDeck.from_json(col, planned_deck_json) for planned_deck_json in sync_plan_json["decks"]]
+        return sync_plan
+
+    def save(self, plan_file: str) -> None:
+        temporary_file: str = plan_file + ".tmp"
+        with open(temporary_file, "w", encoding="utf8") as json_file:
+            json.dump(self.to_json(), json_file)
+        os.replace(temporary_file, plan_file)
+
+
+def load_sync_plan(col: Collection, plan_file: str, plan_key: str) -> Optional[SyncPlan]:
+    """Returns the saved plan if it was computed for the same sheets and settings, without errors,
+       and all of its decks are unchanged since. The spreadsheets are checked separately with are_spreadsheets_unchanged."""
+
+    if not os.path.exists(plan_file):
+        return None
+
+    try:
+        with open(plan_file, "r", encoding="utf8") as data:
+            sync_plan_json: Dict[str, Any] = json.load(data)
+        if sync_plan_json.get("format_version") != SYNC_PLAN_FORMAT_VERSION or sync_plan_json.get("plan_key") != plan_key:
+            logging.info("Sync plan %s was computed for other sheets or settings", plan_file)
+            return None
+        sync_plan: SyncPlan = SyncPlan.from_json(col, sync_plan_json)
+    except Exception as error:
+        logging.warning("Ignoring unreadable sync plan %s: %s - %s", plan_file, type(error).__name__, error)
+        return None
+
+    if sync_plan.has_errors():
+        # failed sheets are fetched again, the error may be gone
+        logging.info("Sync plan %s has failed sheets", plan_file)
+        return None
+
+    for planned_deck in sync_plan.decks:
+        deck_id: DeckId | None = col.decks.id_for_name(planned_deck.plan.deck_name)
+        if deck_id != planned_deck.plan.deck_id or get_deck_fingerprint(col, planned_deck.plan.deck_name) != planned_deck.deck_fingerprint:
+            logging.info("Deck %s changed since the sync was planned", planned_deck.plan.deck_name)
+            return None
+
+    for deck_name, deck_fingerprint in sync_plan.deck_fingerprints.items():
+        if deck_fingerprint is None or get_deck_fingerprint(col, deck_name) != deck_fingerprint:
+            logging.info("Deck %s changed since the sync was planned", deck_name)
+            return None
+
+    return sync_plan
+
+
+def are_spreadsheets_unchanged(services: GoogleServices, sync_plan: SyncPlan) -> bool:
+    """Requests the Drive revision of every planned spreadsheet, without reading the sheets"""
+
+    for spreadsheet_id, revision in sync_plan.spreadsheet_revisions.items():
+        if get_spreadsheet_revision(services, spreadsheet_id) != revision:
+            logging.info("Spreadsheet with ID %s changed since the sync was planned", spreadsheet_id)
+            return False
+    return True
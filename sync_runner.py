@@ -0,0 +1,532 @@
+"""
+Sync started from the GUI: the progress window and the runner syncing the sheets with Anki decks.
+
+"""
+
+import logging
+import os
+import sqlite3
+from aqt import mw
+from aqt.utils import tooltip
+from aqt.qt import qconnect
+from PyQt6.QtGui import QCloseEvent
+from PyQt6.QtWidgets import QLabel, QVBoxLayout, QWidget, QPushButton, QProgressBar
+from concurrent.futures import Future
+from datetime import datetime
+from .addon_config import AddonConfig, load_synchronization_map, load_sheet_read_options
+from .addon_files import (
+    GOOGLE_API_TOKEN_FILE, SPREADSHEET_ID_CACHE_FILE, SYNC_STATE_FILE, SNAPSHOT_DATABASE_FILE, SYNC_METRICS_FILE,
+    SYNC_HISTORY_FILE, SYNC_PLAN_FILE, get_user_file)
+from .deck_sync import DeckSyncPlan, DeckSyncResult, get_deck_fingerprint
+from .google_connection import get_credentials
+from .google_sheets import GoogleServices, SpreadsheetIdCache, get_google_services, SpreadsheetData, SheetSelector
+from .gui_utils import get_icon, show_info, show_error
+from .headless_sync import (
+    DeckSheets, SpreadsheetSettings, get_deck_group_key, add_sheets_of_same_decks, fetch_remote_decks, select_changed_sheets,
+    split_fetch_results, plan_deck_sheets_sync, apply_deck_sheets_sync, set_deck_sheets_error, finish_results)
+from .sync_metrics import SyncMetrics
+from .sync_plan import PlannedDeck, SyncPlan, get_sync_plan_key, load_sync_plan, are_spreadsheets_unchanged
+from .sync_state import SnapshotStore, SyncHistory, SyncStateStore
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+
+# the open import window shows the saved sync plan and the sync history, these are called on the main thread when they change
+sync_plan_listeners: List[Callable[[Optional[SyncPlan]], None]] = []
+sync_history_listeners: List[Callable[[], None]] = []
+
+
+def prefetch_remote_decks(
+        config: AddonConfig,
+        spreadsheets: List[SpreadsheetSettings],
+        select_sheets: Optional[SheetSelector],
+        on_spreadsheet_fetched: Callable[[int], None],
+        should_cancel: Callable[[], bool],
+        metrics: SyncMetrics) -> List[SpreadsheetData | Exception]:
+    """Fetch sheets of all specified spreadsheets in parallel, logging in to Google first if needed"""
+
+    with metrics.measure("credentials"):
+        credentials = get_credentials(config.credentials_file, get_user_file(GOOGLE_API_TOKEN_FILE))
+    with metrics.measure("services"):
+        services: GoogleServices = get_google_services(credentials, config.get_transport_options())
+    id_cache: SpreadsheetIdCache = SpreadsheetIdCache(get_user_file(SPREADSHEET_ID_CACHE_FILE))
+    return fetch_remote_decks(
+        services, spreadsheets, id_cache, config.fetch_worker_count, select_sheets, on_spreadsheet_fetched, should_cancel,
+        load_sheet_read_options(config, config.sync_config_file), metrics)
+
+
+def check_spreadsheets_unchanged(config: AddonConfig, sync_plan: SyncPlan, metrics: SyncMetrics) -> bool:
+    """Checks the Drive revisions of the spreadsheets of the previewed plan, logging in to Google first if needed"""
+
+    with metrics.measure("credentials"):
+        credentials = get_credentials(config.credentials_file, get_user_file(GOOGLE_API_TOKEN_FILE))
+    with metrics.measure("services"):
+        services: GoogleServices = get_google_services(credentials, config.get_transport_options())
+    return are_spreadsheets_unchanged(services, sync_plan)
+
+
+def discard_sync_plan() -> None:
+    plan_file: str = get_user_file(SYNC_PLAN_FILE)
+    try:
+        if os.path.exists(plan_file):
+            os.remove(plan_file)
+    except OSError as error:
+        logging.error("Failed to delete sync plan: %s", error)
+
+    for listener in sync_plan_listeners:
+        listener(None)
+
+
+class SyncProgressWindow(QWidget):
+    """Window showing progress of the current deck and of the whole sync, with the button to cancel the sync"""
+
+    DECK_PHASES: List[str] = ["Comparing with Anki deck", "Applying changes"]
+
+    def __init__(self, deck_count: int):
+        super().__init__()
+        self.cancel_requested = False
+        self.sync_finished = False
+
+        self.setWindowTitle("Syncing with Google Sheets")
+        self.setWindowIcon(get_icon())
+        layout = QVBoxLayout(self)
+
+        self.overall_label = QLabel()
+        layout.addWidget(self.overall_label)
+        self.overall_progress = QProgressBar()
+        self.overall_progress.setRange(0, deck_count)
+        layout.addWidget(self.overall_progress)
+
+        self.step_label = QLabel()
+        self.step_label.setMinimumWidth(500)
+        layout.addWidget(self.step_label)
+        self.step_progress = QProgressBar()
+        layout.addWidget(self.step_progress)
+
+        self.cancel_button = QPushButton("Cancel")
+        qconnect(self.cancel_button.clicked, self.on_cancel)
+        layout.addWidget(self.cancel_button)
+
+        self.set_finished_deck_count(0)
+
+    cancel_requested: bool
+    sync_finished: bool
+
+    def closeEvent(self, event: Optional[QCloseEvent]):
+        if event is None:
+            return
+        # closing the window while syncing works as the cancel button
+        if self.sync_finished:
+            event.accept()
+        else:
+            self.on_cancel()
+            event.ignore()
+
+    def close_finished(self):
+        self.sync_finished = True
+        self.close()
+
+    def on_cancel(self):
+        self.cancel_requested = True
+        self.cancel_button.setEnabled(False)
+        self.step_label.setText("Cancelling after the current step...")
+
+    def set_finished_deck_count(self, finished_deck_count: int):
+        self.overall_label.setText(f"Decks processed: {finished_deck_count} of {self.overall_progress.maximum()}")
+        self.overall_progress.setValue(finished_deck_count)
+
+    def set_step_text(self, text: str):
+        if self.cancel_requested:
+            return
+        self.step_label.setText(text)
+        self.step_progress.setRange(0, 0)
+
+    def set_fetched_spreadsheet_count(self, fetched_count: int, spreadsheet_count: int):
+        if self.cancel_requested:
+            return
+        self.step_label.setText(f"Fetching spreadsheets: {fetched_count} of {spreadsheet_count}")
+        self.step_progress.setRange(0, spreadsheet_count)
+        self.step_progress.setValue(fetched_count)
+
+    def set_deck_phase(self, deck_name: str, phase: int):
+        if self.cancel_requested:
+            return
+        self.step_label.setText(f"{deck_name}: {self.DECK_PHASES[phase]}...")
+        self.step_progress.setRange(0, len(self.DECK_PHASES))
+        self.step_progress.setValue(phase)
+
+
+class SyncRunner:
+    """Syncs the sheets with Anki decks: network requests and diffs run in background, collection writes run on the main thread.
+       All spreadsheets are fetched in parallel first, then decks are synced one after another.
+       A preview only plans the changes and saves the plan, the next sync of the same sheets applies it
+       without fetching and comparing again, unless a spreadsheet or a deck changed since.
+       Cancellation takes effect between the phases of the sync."""
+
+    def __init__(
+            self,
+            config: AddonConfig,
+            spreadsheets: List[SpreadsheetSettings],
+            force_full_sync: bool,
+            automatic: bool = False,
+            on_finished: Optional[Callable[[List[DeckSyncResult]], None]] = None,
+            preview: bool = False):
+        self.config = config
+        self.spreadsheets = spreadsheets
+        self.force_full_sync = force_full_sync
+        self.automatic = automatic
+        self.on_finished = on_finished
+        self.preview = preview
+        self.plan_key = None
+        self.sync_plan = None
+        self.previewed_deck_plans = {}
+        self.state_store = SyncStateStore(get_user_file(SYNC_STATE_FILE))
+        self.snapshot_store = None
+        self.metrics = SyncMetrics()
+        self.deck_fingerprints = {}
+        self.pending_decks = []
+        self.results = []
+        self.deck_count = sum(len(sheets_settings) for _, sheets_settings in spreadsheets)
+        self.window = SyncProgressWindow(self.deck_count)
+
+    config: AddonConfig
+    spreadsheets: List[SpreadsheetSettings]
+    force_full_sync: bool
+    # automatic sync runs without the progress window, and reports its results with a tooltip
+    automatic: bool
+    on_finished: Optional[Callable[[List[DeckSyncResult]], None]]
+    # the changes are only planned, nothing is written to the collection
+    preview: bool
+    # sheets and settings of the sync, None if they can't be read and plans are not used
+    plan_key: Optional[str]
+    # plan being built by the preview
+    sync_plan: Optional[SyncPlan]
+    # deck group key -> changes from the saved preview, applied without comparing the deck again
+    previewed_deck_plans: Dict[str, DeckSyncPlan]
+    state_store: SyncStateStore
+    snapshot_store: Optional[SnapshotStore]
+    metrics: SyncMetrics
+    deck_fingerprints: Dict[str, Optional[str]]
+    pending_decks: List[DeckSheets]
+    results: List[DeckSyncResult]
+    deck_count: int
+    window: SyncProgressWindow
+
+    def start(self):
+        try:
+            self.snapshot_store = SnapshotStore(get_user_file(SNAPSHOT_DATABASE_FILE))
+        except sqlite3.Error as error:
+            # without snapshots every deck is compared in full
+            logging.error("Failed to open sync snapshots: %s", error)
+
+        try:
+            self.plan_key = get_sync_plan_key(
+                self.spreadsheets,
+                self.force_full_sync,
+                load_sheet_read_options(self.config, self.config.sync_config_file),
+                self.config.get_text_normalization())
+        except Exception as error:
+            logging.error("Failed to read sync settings for the sync plan: %s - %s", type(error).__name__, error)
+
+        if self.preview:
+            self.window.setWindowTitle("Previewing changes from Google Sheets")
+        if not self.automatic:
+            self.window.show()
+
+        plan_key: Optional[str] = self.plan_key
+        if plan_key is not None and not self.preview and not self.automatic and os.path.exists(get_user_file(SYNC_PLAN_FILE)):
+            self.window.set_step_text("Checking previewed changes...")
+            mw.taskman.run_in_background(
+                lambda: load_sync_plan(mw.col, get_user_file(SYNC_PLAN_FILE), plan_key),
+                self.on_sync_plan_loaded)
+            return
+
+        self.start_fetching()
+
+    def on_sync_plan_loaded(self, future: Future):
+        try:
+            sync_plan: Optional[SyncPlan] = future.result()
+        except Exception as error:
+            logging.error("Failed to load sync plan: %s - %s", type(error).__name__, error)
+            sync_plan = None
+
+        if self.window.cancel_requested:
+            self.finish()
+            return
+        if sync_plan is None:
+            self.start_fetching()
+            return
+
+        mw.taskman.run_in_background(
+            lambda: check_spreadsheets_unchanged(self.config, sync_plan, self.metrics),
+            lambda future: self.on_sync_plan_checked(sync_plan, future),
+            uses_collection=False)
+
+    def on_sync_plan_checked(self, sync_plan: SyncPlan, future: Future):
+        try:
+            unchanged: bool = future.result()
+        except Exception as error:
+            logging.error("Failed to check spreadsheets of the sync plan: %s - %s", type(error).__name__, error)
+            unchanged = False
+
+        if self.window.cancel_requested:
+            self.finish()
+            return
+        if not unchanged:
+            self.start_fetching()
+            return
+
+        logging.info("Applying changes previewed at %s", sync_plan.planned_at)
+        self.metrics.add("previews_applied", 1)
+        self.results = list(sync_plan.results)
+        self.pending_decks = [planned_deck.deck_sheets for planned_deck in sync_plan.decks]
+        self.previewed_deck_plans = {
+            get_deck_group_key(planned_deck.deck_sheets.deck_name): planned_deck.plan for planned_deck in sync_plan.decks}
+        self.window.set_finished_deck_count(len(self.results))
+        self.sync_next_deck()
+
+    def start_fetching(self):
+        self.window.set_fetched_spreadsheet_count(0, len(self.spreadsheets))
+
+        if self.force_full_sync:
+            self.fetch_spreadsheets()
+            return
+
+        deck_names: List[str] = [sheet_settings.deck_name for _, sheets_settings in self.spreadsheets for sheet_settings in sheets_settings]
+        mw.taskman.run_in_background(
+            lambda: {deck_name: get_deck_fingerprint(mw.col, deck_name) for deck_name in deck_names},
+            self.on_deck_fingerprints_loaded)
+
+    def on_deck_fingerprints_loaded(self, future: Future):
+        try:
+            self.deck_fingerprints = future.result()
+        except Exception as error:
+            # without fingerprints nothing is skipped
+            logging.error("Failed to read state of decks: %s - %s", type(error).__name__, error)
+
+        self.fetch_spreadsheets()
+
+    def select_changed_sheets(self, spreadsheet: SpreadsheetData, sheet_names: List[str]) -> List[str]:
+        return select_changed_sheets(self.state_store, self.spreadsheets, self.deck_fingerprints, spreadsheet, sheet_names)
+
+    def fetch_spreadsheets(self):
+        def on_spreadsheet_fetched(fetched_count: int):
+            mw.taskman.run_on_main(lambda: self.window.set_fetched_spreadsheet_count(fetched_count, len(self.spreadsheets)))
+
+        select_sheets: Optional[SheetSelector] = None if self.force_full_sync else self.select_changed_sheets
+        mw.taskman.run_in_background(
+            lambda: prefetch_remote_decks(
+                self.config, self.spreadsheets, select_sheets, on_spreadsheet_fetched, lambda: self.window.cancel_requested, self.metrics),
+            self.on_remote_decks_fetched,
+            uses_collection=False)
+
+    def on_remote_decks_fetched(self, future: Future):
+        try:
+            fetch_results: List[SpreadsheetData | Exception] = future.result()
+        except Exception as error:
+            logging.error("Failed to fetch sheets: %s - %s", type(error).__name__, error)
+            fetch_results = [error] * len(self.spreadsheets)
+
+        self.results, self.pending_decks = split_fetch_results(self.spreadsheets, fetch_results)
+        if self.preview:
+            self.sync_plan = SyncPlan(self.plan_key or "", datetime.now().isoformat(sep=" ", timespec="seconds"))
+            self.sync_plan.add_fetch_results(fetch_results, self.results, self.deck_fingerprints)
+
+        self.window.set_finished_deck_count(len(self.results))
+        self.sync_next_deck()
+
+    def sync_next_deck(self):
+        if self.window.cancel_requested:
+            self.finish()
+            return
+
+        if not self.pending_decks:
+            self.finish()
+            return
+
+        deck_sheets: DeckSheets = self.pending_decks.pop(0)
+        self.results.extend(deck_sheets.results)
+        self.window.set_deck_phase(deck_sheets.deck_name, 0)
+
+        previewed_plan: Optional[DeckSyncPlan] = self.previewed_deck_plans.pop(get_deck_group_key(deck_sheets.deck_name), None)
+        if previewed_plan is not None:
+            # queued rather than called, so the window is repainted between the decks
+            mw.taskman.run_on_main(lambda: self.apply_deck(deck_sheets, previewed_plan))
+            return
+
+        # the diff runs on the collection thread, then the changes are written on the main thread
+        mw.taskman.run_in_background(
+            lambda: (
+                plan_deck_sheets_sync(mw.col, self.snapshot_store, deck_sheets, self.force_full_sync, self.metrics),
+                get_deck_fingerprint(mw.col, deck_sheets.deck_name)),
+            lambda future: self.on_deck_planned(deck_sheets, future))
+
+    def on_deck_planned(self, deck_sheets: DeckSheets, future: Future):
+        try:
+            plan, deck_fingerprint = future.result()
+        except Exception as error:
+            set_deck_sheets_error(deck_sheets, error)
+            if self.sync_plan is not None:
+                self.sync_plan.results.extend(deck_sheets.results)
+            self.window.set_finished_deck_count(len(self.results))
+            self.sync_next_deck()
+            return
+
+        if self.sync_plan is not None:
+            self.sync_plan.decks.append(PlannedDeck(deck_sheets, plan, deck_fingerprint))
+            self.window.set_finished_deck_count(len(self.results))
+            self.sync_next_deck()
+            return
+
+        self.apply_deck(deck_sheets, plan)
+
+    def apply_deck(self, deck_sheets: DeckSheets, plan: DeckSyncPlan):
+        try:
+            if self.window.cancel_requested:
+                for result in deck_sheets.results:
+                    self.results.remove(result)
+                self.finish()
+                return
+
+            self.window.set_deck_phase(deck_sheets.deck_name, 1)
+            self.window.repaint()
+            apply_deck_sheets_sync(mw.col, self.state_store, self.snapshot_store, deck_sheets, plan, self.metrics)
+        except Exception as error:
+            set_deck_sheets_error(deck_sheets, error)
+
+        self.window.set_finished_deck_count(len(self.results))
+        self.sync_next_deck()
+
+    def finish(self):
+        global _active_sync_runner
+        _active_sync_runner = None
+
+        self.window.close_finished()
+
+        try:
+            self.state_store.save()
+        except OSError as error:
+            logging.error("Failed to save sync state: %s", error)
+
+        if self.snapshot_store is not None:
+            self.snapshot_store.close()
+
+        finish_results(self.spreadsheets, self.results, self.metrics)
+        self.metrics.add("automatic_syncs", int(self.automatic))
+        self.metrics.add("previews", int(self.preview))
+        self.metrics.append_to(get_user_file(SYNC_METRICS_FILE))
+        logging.info("Sync metrics: %s", self.metrics.describe())
+
+        if self.preview:
+            self.finish_preview()
+            return
+
+        if not self.automatic:
+            # a manual sync makes the preview obsolete, whether it was applied or not
+            discard_sync_plan()
+        self.record_history()
+
+        lines: List[str] = [result.describe() for result in self.results]
+        not_synced_deck_count: int = self.deck_count - len(self.results)
+        if not_synced_deck_count:
+            lines.append(f"Sync cancelled, decks not synced: {not_synced_deck_count}")
+        lines.append(self.metrics.describe())
+
+        if self.on_finished is not None:
+            self.on_finished(self.results)
+
+        failed: bool = any(result.error is not None for result in self.results)
+        if self.automatic:
+            self.report_automatic_sync(failed)
+        elif failed:
+            show_error("Sync finished with errors", "\n".join(lines))
+        elif not_synced_deck_count:
+            show_info("Sync cancelled", "\n".join(lines))
+        else:
+            show_info("Sync finished", "\n".join(lines))
+
+    def finish_preview(self):
+        """Saves the plan of a complete preview for the next sync and shows it in the import window"""
+
+        not_planned_deck_count: int = self.deck_count - len(self.results)
+        if self.sync_plan is None or not_planned_deck_count:
+            show_info("Preview cancelled", f"Decks not compared: {not_planned_deck_count}")
+            return
+
+        try:
+            self.sync_plan.save(get_user_file(SYNC_PLAN_FILE))
+        except OSError as error:
+            logging.error("Failed to save sync plan: %s", error)
+
+        for listener in sync_plan_listeners:
+            listener(self.sync_plan)
+
+        lines: List[str] = self.sync_plan.describe()
+        lines.append(self.metrics.describe())
+        if self.sync_plan.has_errors():
+            show_error("Preview finished with errors", "\n".join(lines))
+        else:
+            lines.append("Sync the same sheets to apply these changes.")
+            show_info("Preview of the sync", "\n".join(lines))
+
+    def record_history(self):
+        history: SyncHistory = SyncHistory(get_user_file(SYNC_HISTORY_FILE))
+        finished_at: str = datetime.now().isoformat(sep=" ", timespec="seconds")
+        for result in self.results:
+            history.record(result.to_json(), finished_at)
+        try:
+            history.save()
+        except OSError as error:
+            logging.error("Failed to save sync history: %s", error)
+
+        for history_listener in sync_history_listeners:
+            history_listener()
+
+    def report_automatic_sync(self, failed: bool):
+        """Automatic sync doesn't interrupt the user with dialogs, it only shows decks which changed or failed"""
+
+        changed_results: List[DeckSyncResult] = [
+            result for result in self.results
+            if result.error is not None or result.added_card_count or result.updated_card_count or result.removed_card_count]
+        if not changed_results:
+            return
+
+        title: str = "Google Sheets sync finished with errors, see the log" if failed else "Google Sheets sync finished"
+        tooltip("<br>".join([title] + [result.describe() for result in changed_results]), period=5000)
+
+
+# only one sync runs at a time, the reference also keeps the runner alive while its background tasks run
+_active_sync_runner: Optional[SyncRunner] = None
+
+
+def start_sync(
+        config: AddonConfig,
+        spreadsheets: List[SpreadsheetSettings],
+        force_full_sync: bool,
+        automatic: bool = False,
+        on_finished: Optional[Callable[[List[DeckSyncResult]], None]] = None,
+        preview: bool = False):
+    global _active_sync_runner
+
+    if _active_sync_runner is not None:
+        if not automatic:
+            show_info("Sync in progress", "Wait until the current sync finishes or cancel it.")
+        return
+
+    # a deck is synced from all of its sheets, also when only some of them are selected
+    try:
+        all_spreadsheets: List[SpreadsheetSettings] = [
+            (spreadsheet_settings.spreadsheet_name, spreadsheet_settings.sheets)
+            for spreadsheet_settings in load_synchronization_map(config.sync_config_file)]
+        spreadsheets = add_sheets_of_same_decks(spreadsheets, all_spreadsheets)
+    except Exception as error:
+        logging.error("Failed to load sync config: %s - %s", type(error).__name__, error)
+
+    _active_sync_runner = SyncRunner(config, spreadsheets, force_full_sync, automatic, on_finished, preview)
+    _active_sync_runner.start()
+
+
+def is_sync_running() -> bool:
+    return _active_sync_runner is not None
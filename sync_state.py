@@ -0,0 +1,222 @@
+"""
+Local state of previous syncs, kept in the user files of the add-on.
+
+"""
+
+import json
+import logging
+import os.path
+import sqlite3
+import threading
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from anki.notes import NoteId
+from .deck_sync import DeckSnapshot
+
+
+class SyncStateStore:
+    """Drive revision of the spreadsheet, its read options and state of the Anki deck, recorded after each successful sheet sync.
+       When all of them are the same on the next sync, the sheet is neither downloaded nor compared with the deck."""
+
+    def __init__(self, state_file: str):
+        self.state_file = state_file
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(state_file):
+            try:
+                with open(state_file, "r", encoding="utf8") as data:
+                    self.entries = json.load(data)
+            except (OSError, ValueError) as error:
+                logging.warning("Ignoring unreadable sync state %s: %s", state_file, error)
+
+    state_file: str
+    entries: Dict[str, Dict[str, Any]]
+    lock: threading.Lock
+
+    @staticmethod
+    def get_key(spreadsheet_id: str, sheet_name: str, deck_name: str) -> str:
+        return json.dumps([spreadsheet_id, sheet_name, deck_name])
+
+    def is_unchanged(
+            self,
+            spreadsheet_id: str,
+            sheet_name: str,
+            deck_name: str,
+            version: str,
+            modified_time: str,
+            read_mode: str,
+            deck_fingerprint: str | None) -> bool:
+        if not version or deck_fingerprint is None:
+            return False
+
+        with self.lock:
+            entry: Dict[str, Any] | None = self.entries.get(self.get_key(spreadsheet_id, sheet_name, deck_name))
+
+        return entry is not None \
+            and entry.get("version") == version \
+            and entry.get("modified_time") == modified_time \
+            and entry.get("read_mode") == read_mode \
+            and entry.get("deck_fingerprint") == deck_fingerprint
+
+    def record(
+            self,
+            spreadsheet_id: str,
+            sheet_name: str,
+            deck_name: str,
+            version: str,
+            modified_time: str,
+            read_mode: str,
+            deck_fingerprint: str | None) -> None:
+        key: str = self.get_key(spreadsheet_id, sheet_name, deck_name)
+        with self.lock:
+            if deck_fingerprint is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = {
+                    "version": version, "modified_time": modified_time, "read_mode": read_mode, "deck_fingerprint": deck_fingerprint}
+
+    def save(self) -> None:
+        temporary_file: str = self.state_file + ".tmp"
+        with self.lock:
+            with open(temporary_file, "w", encoding="utf8") as json_file:
+                json.dump(self.entries, json_file, indent=4)
+            os.replace(temporary_file, self.state_file)
+
+
+class SyncHistory:
+    """Result of the last sync of every configured sheet with its deck, shown in the import window"""
+
+    def __init__(self, history_file: str):
+        self.history_file = history_file
+        self.entries = {}
+
+        if os.path.exists(history_file):
+            try:
+                with open(history_file, "r", encoding="utf8") as data:
+                    self.entries = json.load(data)
+            except (OSError, ValueError) as error:
+                logging.warning("Ignoring unreadable sync history %s: %s", history_file, error)
+
+    history_file: str
+    entries: Dict[str, Dict[str, Any]]
+
+    @staticmethod
+    def get_key(spreadsheet_name: str, sheet_name: str, deck_name: str) -> str:
+        return json.dumps([spreadsheet_name, sheet_name, deck_name])
+
+    def get(self, spreadsheet_name: str, sheet_name: str, deck_name: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(self.get_key(spreadsheet_name, sheet_name, deck_name))
+
+    def record(self, result_json: Dict[str, Any], finished_at: str) -> None:
+        """Keeps the result of DeckSyncResult.to_json with the time the sync finished"""
+
+        key: str = self.get_key(result_json["spreadsheet_name"], result_json["sheet_name"], result_json["deck_name"])
+        self.entries[key] = dict(result_json, finished_at=finished_at)
+
+    def save(self) -> None:
+        temporary_file: str = self.history_file + ".tmp"
+        with open(temporary_file, "w", encoding="utf8") as json_file:
+            json.dump(self.entries, json_file, indent=4)
+        os.replace(temporary_file, self.history_file)
+
+
+class DriveChangesCursor:
+    """Position in the Drive changes feed for the automatic sync, with the spreadsheets whose last sync didn't succeed"""
+
+    def __init__(self, cursor_file: str):
+        self.cursor_file = cursor_file
+        self.page_token = None
+        self.pending_spreadsheet_names = []
+
+        if os.path.exists(cursor_file):
+            try:
+                with open(cursor_file, "r", encoding="utf8") as data:
+                    cursor_json: Dict[str, Any] = json.load(data)
+                self.page_token = cursor_json.get("page_token")
+                self.pending_spreadsheet_names = cursor_json.get("pending_spreadsheet_names", [])
+            except (OSError, ValueError) as error:
+                logging.warning("Ignoring unreadable Drive changes cursor %s: %s", cursor_file, error)
+
+    cursor_file: str
+    page_token: Optional[str]
+    pending_spreadsheet_names: List[str]
+
+    def save(self) -> None:
+        temporary_file: str = self.cursor_file + ".tmp"
+        with open(temporary_file, "w", encoding="utf8") as json_file:
+            json.dump({"page_token": self.page_token, "pending_spreadsheet_names": self.pending_spreadsheet_names}, json_file, indent=4)
+        os.replace(temporary_file, self.cursor_file)
+
+
+class SnapshotStore:
+    """Rows of each synced sheet as of its last sync, reduced to hashes of the card key and value and the ID of the note.
+       The snapshot is stored together with the state of the Anki deck and the read options of the sheets
+       and is only used while both stay the same, then the next sync reads and compares only the notes of the rows changed in the sheet."""
+
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        self.lock = threading.Lock()
+        # the store is read by the diff running in background and written on the main thread
+        self.connection = sqlite3.connect(database_file, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("create table if not exists snapshots (sheet_key text primary key, deck_fingerprint text not null)")
+            self.connection.execute(
+                "create table if not exists snapshot_rows (sheet_key text not null, key_hash text not null, content_hash text not null, "
+                "note_id integer not null, primary key (sheet_key, key_hash)) without rowid")
+
+    database_file: str
+    lock: threading.Lock
+    connection: sqlite3.Connection
+
+    def load(self, sheet_key: str, deck_fingerprint: str | None) -> Optional[DeckSnapshot]:
+        """Returns the snapshot of the sheet, or None if there is none or the deck changed after it was taken"""
+
+        if deck_fingerprint is None:
+            return None
+
+        with self.lock:
+            snapshot_fingerprint: Tuple[str] | None = self.connection.execute(
+                "select deck_fingerprint from snapshots where sheet_key = ?", (sheet_key,)).fetchone()
+            if snapshot_fingerprint is None or not snapshot_fingerprint[0] == deck_fingerprint:
+                return None
+
+            rows = self.connection.execute("select key_hash, content_hash, note_id from snapshot_rows where sheet_key = ?", (sheet_key,))
+            return {key_hash: (content_hash, NoteId(note_id)) for key_hash, content_hash, note_id in rows}
+
+    def update(
+            self,
+            sheet_key: str,
+            deck_fingerprint: str | None,
+            rows: Optional[DeckSnapshot],
+            removed_key_hashes: List[str],
+            replace: bool) -> None:
+        """Writes the changed rows of the snapshot in one transaction, or drops the snapshot if rows are None"""
+
+        with self.lock, self.connection:
+            if rows is None or deck_fingerprint is None:
+                self.connection.execute("delete from snapshots where sheet_key = ?", (sheet_key,))
+                self.connection.execute("delete from snapshot_rows where sheet_key = ?", (sheet_key,))
+                return
+
+            if replace:
+                self.connection.execute("delete from snapshot_rows where sheet_key = ?", (sheet_key,))
+            else:
+                self.connection.executemany(
+                    "delete from snapshot_rows where sheet_key = ? and key_hash = ?",
+                    ((sheet_key, key_hash) for key_hash in removed_key_hashes))
+
+            self.connection.executemany(
+                "insert or replace into snapshot_rows (sheet_key, key_hash, content_hash, note_id) values (?, ?, ?, ?)",
+                ((sheet_key, key_hash, content_hash, note_id) for key_hash, (content_hash, note_id) in rows.items()))
+            self.connection.execute(
+                "insert or replace into snapshots (sheet_key, deck_fingerprint) values (?, ?)", (sheet_key, deck_fingerprint))
+
+        logging.debug("Saved snapshot of the sheet %s, written rows: %s, removed rows: %s", sheet_key, len(rows), len(removed_key_hashes))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
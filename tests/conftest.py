@@ -0,0 +1,35 @@
+import os.path
+import sys
+import types
+from typing import Iterator
+
+import pytest
+
+ADDON_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDON_PACKAGE: str = "goosheesy"
+
+# the add-on modules are loaded without the add-on __init__.py, which needs the running Anki GUI
+if ADDON_PACKAGE not in sys.modules:
+    addon_package = types.ModuleType(ADDON_PACKAGE)
+    addon_package.__path__ = [ADDON_DIR]
+    sys.modules[ADDON_PACKAGE] = addon_package
+    # pytest imports the add-on folder as the package of the tests under the folder name, it gets the same package
+    sys.modules.setdefault(os.path.basename(ADDON_DIR), addon_package)
+
+from anki.collection import Collection  # noqa: E402
+from goosheesy.deck_sync import TextNormalization, set_text_normalization  # noqa: E402
+
+
+@pytest.fixture
+def col(tmp_path) -> Iterator[Collection]:
+    collection: Collection = Collection(str(tmp_path / "collection.anki2"))
+    yield collection
+    collection.close()
+
+
+@pytest.fixture(autouse=True)
+def default_text_normalization() -> Iterator[None]:
+    # the normalization is shared by all syncs of the process, so every test starts and ends with the default one
+    set_text_normalization(TextNormalization())
+    yield
+    set_text_normalization(TextNormalization())
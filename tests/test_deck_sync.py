@@ -0,0 +1,154 @@
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from anki.collection import Collection
+from goosheesy.deck_sync import (
+    DeckDiff, DeckSnapshot, DeckSyncPlan, RemoteDeck, TextNormalization, apply_deck_sync_plan, get_deck_fingerprint, plan_deck_sync,
+    set_text_normalization)
+from goosheesy.sync_state import SnapshotStore
+
+DECK_NAME: str = "Test deck"
+
+
+def sync_deck(col: Collection, remote_deck: RemoteDeck) -> Optional[DeckSnapshot]:
+    """Syncs the deck by the full comparison and returns the snapshot for the next sync"""
+
+    col.decks.id(DECK_NAME)
+    plan: DeckSyncPlan = plan_deck_sync(col, DECK_NAME, remote_deck)
+    apply_deck_sync_plan(col, plan)
+    return plan.snapshot_rows
+
+
+def describe_diff(diff: DeckDiff) -> Tuple[List[Tuple[str, str]], Dict[int, str], List[int]]:
+    """Added cards, new values of the updated notes and removed notes, which both diffs must agree on"""
+
+    return (
+        sorted(diff.notes_to_add),
+        {note_update.note_id: note_update.new_card_value for note_update in diff.notes_to_update},
+        sorted(local_note.note_id for local_note in diff.notes_to_remove))
+
+
+def plan_both(col: Collection, snapshot: Optional[DeckSnapshot], remote_deck: RemoteDeck) -> Tuple[DeckSyncPlan, DeckSyncPlan]:
+    assert snapshot is not None
+    full_plan: DeckSyncPlan = plan_deck_sync(col, DECK_NAME, remote_deck)
+    incremental_plan: DeckSyncPlan = plan_deck_sync(col, DECK_NAME, remote_deck, snapshot)
+    return full_plan, incremental_plan
+
+
+def get_deck_cards(col: Collection) -> Dict[str, str]:
+    notes = [col.get_note(note_id) for note_id in col.find_notes(f'"deck:{DECK_NAME}"')]
+    return {note["Front"]: note["Back"] for note in notes}
+
+
+def test_added_removed_and_changed_rows(col: Collection):
+    snapshot = sync_deck(col, {"a": "1", "b": "2", "c": "3"})
+
+    full_plan, incremental_plan = plan_both(col, snapshot, {"a": "1", "b": "22", "d": "4"})
+
+    assert incremental_plan.incremental
+    assert describe_diff(incremental_plan.diff) == describe_diff(full_plan.diff)
+    added, updated, removed = describe_diff(incremental_plan.diff)
+    assert added == [("d", "4")]
+    assert list(updated.values()) == ["22"]
+    assert len(removed) == 1
+
+    apply_deck_sync_plan(col, incremental_plan)
+    assert get_deck_cards(col) == {"a": "1", "b": "22", "d": "4"}
+
+
+def test_snapshot_of_applied_incremental_diff(col: Collection):
+    snapshot = sync_deck(col, {"a": "1", "b": "2"})
+    _, incremental_plan = plan_both(col, snapshot, {"a": "11", "c": "3"})
+    apply_deck_sync_plan(col, incremental_plan)
+
+    assert snapshot is not None and incremental_plan.snapshot_rows is not None
+    snapshot.update(incremental_plan.snapshot_rows)
+    for key_hash in incremental_plan.removed_key_hashes:
+        del snapshot[key_hash]
+
+    full_plan, next_plan = plan_both(col, snapshot, {"a": "11", "c": "33", "d": "4"})
+    assert describe_diff(next_plan.diff) == describe_diff(full_plan.diff)
+
+
+def test_reordered_rows(col: Collection):
+    snapshot = sync_deck(col, {"a": "1", "b": "2", "c": "3"})
+
+    full_plan, incremental_plan = plan_both(col, snapshot, {"c": "3", "a": "1", "b": "2"})
+
+    assert incremental_plan.incremental
+    assert incremental_plan.diff.is_empty()
+    assert full_plan.diff.is_empty()
+
+
+def test_reordered_and_changed_rows(col: Collection):
+    snapshot = sync_deck(col, {"a": "1", "b": "2", "c": "3"})
+
+    full_plan, incremental_plan = plan_both(col, snapshot, {"c": "33", "b": "2", "e": "5", "a": "1"})
+
+    assert describe_diff(incremental_plan.diff) == describe_diff(full_plan.diff)
+
+
+def test_new_card_key_with_duplicate_normalized_key(col: Collection):
+    snapshot = sync_deck(col, {"a b": "1", "c": "3"})
+
+    # the new key differs from the existing one only in whitespace, so the deck is compared in full
+    full_plan, incremental_plan = plan_both(col, snapshot, {"a b": "1", "a  b": "2", "c": "3"})
+
+    assert not incremental_plan.incremental
+    assert describe_diff(incremental_plan.diff) == describe_diff(full_plan.diff)
+
+
+def test_card_key_changed_in_ignored_formatting(col: Collection):
+    snapshot = sync_deck(col, {"a b": "1", "c": "3"})
+
+    full_plan, incremental_plan = plan_both(col, snapshot, {"a  <b>b</b>": "1", "c": "3"})
+
+    assert incremental_plan.incremental
+    assert describe_diff(incremental_plan.diff) == describe_diff(full_plan.diff)
+    assert incremental_plan.diff.is_empty()
+    assert incremental_plan.diff.equivalent_note_count == 1
+
+
+def test_card_value_changed_in_ignored_formatting(col: Collection):
+    snapshot = sync_deck(col, {"a": "x y", "b": "2"})
+
+    full_plan, incremental_plan = plan_both(col, snapshot, {"a": "x&nbsp; y<br>", "b": "2"})
+
+    assert describe_diff(incremental_plan.diff) == describe_diff(full_plan.diff)
+    assert incremental_plan.diff.is_empty()
+
+
+def test_remote_deck_with_duplicate_normalized_keys_has_no_snapshot(col: Collection):
+    snapshot = sync_deck(col, {"a b": "1", "a  b": "2"})
+
+    assert snapshot is None
+
+
+def test_switched_normalization_flags(col: Collection, tmp_path):
+    snapshot = sync_deck(col, {"a": "x y", "b": "2"})
+    fingerprint: Optional[str] = get_deck_fingerprint(col, DECK_NAME)
+    snapshot_store: SnapshotStore = SnapshotStore(str(tmp_path / "snapshots.db"))
+    snapshot_store.update("sheet", fingerprint, snapshot, [], True)
+
+    # the same sheet now differs from the deck in whitespace, which was ignored before
+    remote_deck: RemoteDeck = {"a": "x  y", "b": "2"}
+    assert plan_deck_sync(col, DECK_NAME, remote_deck).diff.is_empty()
+
+    set_text_normalization(TextNormalization(collapse_whitespace=False))
+    switched_fingerprint: Optional[str] = get_deck_fingerprint(col, DECK_NAME)
+
+    # the snapshot taken with the other flags is not used, and the full comparison updates the note
+    assert not switched_fingerprint == fingerprint
+    assert snapshot_store.load("sheet", switched_fingerprint) is None
+    full_plan: DeckSyncPlan = plan_deck_sync(col, DECK_NAME, remote_deck)
+    assert list(describe_diff(full_plan.diff)[1].values()) == ["x  y"]
+
+    # a snapshot taken with the new flags agrees with the full comparison again
+    apply_deck_sync_plan(col, full_plan)
+    snapshot = sync_deck(col, remote_deck)
+    full_plan, incremental_plan = plan_both(col, snapshot, {"a": "x y", "b": "2 "})
+    assert describe_diff(incremental_plan.diff) == describe_diff(full_plan.diff)
+    assert len(incremental_plan.diff.notes_to_update) == 2
+    snapshot_store.close()
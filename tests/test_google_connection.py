@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+from goosheesy import google_connection
+from goosheesy.google_connection import TokenBucket
+
+
+class FakeClock:
+    """Monotonic time which only advances when the caller sleeps"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    now: float
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake_clock: FakeClock = FakeClock()
+    monkeypatch.setattr(google_connection, "time", SimpleNamespace(monotonic=fake_clock.monotonic, sleep=fake_clock.sleep))
+    return fake_clock
+
+
+def test_burst_up_to_capacity_does_not_wait(clock: FakeClock):
+    bucket: TokenBucket = TokenBucket(2.0, 3.0)
+
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert clock.now == 0.0
+
+
+def test_empty_bucket_waits_for_refill(clock: FakeClock):
+    bucket: TokenBucket = TokenBucket(2.0, 1.0)
+    bucket.acquire()
+
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_refill_is_limited_by_capacity(clock: FakeClock):
+    bucket: TokenBucket = TokenBucket(2.0, 2.0)
+    bucket.acquire()
+    bucket.acquire()
+    clock.now += 100.0
+
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, pytest.approx(0.5)]
+
+
+def test_quota_is_kept_in_any_minute(clock: FakeClock):
+    requests_per_minute: int = 60
+    bucket: TokenBucket = TokenBucket.for_quota(requests_per_minute)
+
+    request_times: List[float] = []
+    while clock.now < 180.0:
+        bucket.acquire()
+        request_times.append(clock.now)
+
+    for start in request_times:
+        assert sum(1 for request_time in request_times if start <= request_time < start + 60.0) <= requests_per_minute
@@ -0,0 +1,36 @@
+import pytest
+
+from goosheesy.google_sheets import AmbiguousSpreadsheetException, SpreadsheetNotFoundException, match_spreadsheet
+
+
+def test_exact_name_wins_over_names_containing_it():
+    spreadsheets = [("id1", "Words (old)"), ("id2", "Words"), ("id3", "More words")]
+
+    assert match_spreadsheet("Words", spreadsheets) == "id2"
+
+
+def test_single_name_containing_the_name_ignoring_case():
+    spreadsheets = [("id1", "English words"), ("id2", "Grammar")]
+
+    assert match_spreadsheet("WORDS", spreadsheets) == "id1"
+
+
+def test_exact_name_is_case_sensitive():
+    spreadsheets = [("id1", "words"), ("id2", "Grammar")]
+
+    assert match_spreadsheet("Words", spreadsheets) == "id1"
+
+
+def test_no_matching_name():
+    with pytest.raises(SpreadsheetNotFoundException):
+        match_spreadsheet("Words", [("id1", "Grammar")])
+
+
+def test_several_names_containing_the_name():
+    with pytest.raises(AmbiguousSpreadsheetException, match="id1"):
+        match_spreadsheet("Words", [("id1", "Words 1"), ("id2", "Words 2")])
+
+
+def test_several_exact_names():
+    with pytest.raises(AmbiguousSpreadsheetException):
+        match_spreadsheet("Words", [("id1", "Words"), ("id2", "Words"), ("id3", "Words 3")])
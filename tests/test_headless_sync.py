@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+from typing import List
+from typing import Tuple
+
+from goosheesy.headless_sync import SpreadsheetSettings, add_sheets_of_same_decks
+
+
+def sheet(sheet_name: str, deck_name: str) -> SimpleNamespace:
+    return SimpleNamespace(sheet_name=sheet_name, deck_name=deck_name)
+
+
+def describe(spreadsheets: List[SpreadsheetSettings]) -> List[Tuple[str, List[str]]]:
+    return [(spreadsheet_name, [sheet_settings.sheet_name for sheet_settings in sheets]) for spreadsheet_name, sheets in spreadsheets]
+
+
+ALL_SPREADSHEETS: List[SpreadsheetSettings] = [
+    ("sp1", [sheet("s1", "Words"), sheet("s2", "Grammar")]),
+    ("sp2", [sheet("s3", "Phrases"), sheet("s4", "words")]),
+    ("sp3", [sheet("s5", "Words")]),
+]
+
+
+def test_other_sheets_of_the_deck_are_added_in_configuration_order():
+    selected: List[SpreadsheetSettings] = [("sp3", [ALL_SPREADSHEETS[2][1][0]])]
+
+    # deck names are case-insensitive
+    assert describe(add_sheets_of_same_decks(selected, ALL_SPREADSHEETS)) == [("sp1", ["s1"]), ("sp2", ["s4"]), ("sp3", ["s5"])]
+
+
+def test_sheets_of_other_decks_are_not_added():
+    selected: List[SpreadsheetSettings] = [("sp1", [ALL_SPREADSHEETS[0][1][1]]), ("sp2", [ALL_SPREADSHEETS[1][1][0]])]
+
+    assert describe(add_sheets_of_same_decks(selected, ALL_SPREADSHEETS)) == [("sp1", ["s2"]), ("sp2", ["s3"])]
+
+
+def test_all_sheets_stay_the_same():
+    assert describe(add_sheets_of_same_decks(ALL_SPREADSHEETS, ALL_SPREADSHEETS)) == describe(ALL_SPREADSHEETS)
+
+
+def test_sheets_missing_in_the_sync_config_are_kept_as_selected():
+    selected: List[SpreadsheetSettings] = [("sp4", [sheet("s6", "Words")])]
+
+    assert add_sheets_of_same_decks(selected, ALL_SPREADSHEETS) is selected